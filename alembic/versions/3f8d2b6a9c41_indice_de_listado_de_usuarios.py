@@ -0,0 +1,27 @@
+"""Índice de listado de usuarios
+
+Revision ID: 3f8d2b6a9c41
+Revises: 7e3a9c5b12f8
+Create Date: 2026-10-18 16:02:11.487215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f8d2b6a9c41'
+down_revision = '7e3a9c5b12f8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Mismo orden que el listado de usuarios, para paginar por clave sin ordenar toda la escuela. rol_id puede ser
+    # nulo, el listado lo ordena como 0
+    op.create_index('usuario_listado_idx', 'usuario',
+                    ['escuela', sa.text('COALESCE(rol_id, 0) DESC'), 'deshabilitado', 'id'])
+
+
+def downgrade():
+    op.drop_index('usuario_listado_idx', 'usuario')
@@ -0,0 +1,42 @@
+"""Expiración de sesiones
+
+Revision ID: 4c8e2a71d5b3
+Revises: eb3f4cf15d9f
+Create Date: 2026-10-18 11:02:37.512904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4c8e2a71d5b3'
+down_revision = 'eb3f4cf15d9f'
+branch_labels = None
+depends_on = None
+
+# Igual al valor por defecto de session_ttl en app.py
+SESSION_TTL = 7 * 24 * 60 * 60
+
+
+def upgrade():
+    op.add_column('session', sa.Column('fecha_ultimo_acceso', sa.DateTime, nullable=False,
+                                       server_default=sa.text("(now() at time zone 'utc')")))
+    op.add_column('session', sa.Column('fecha_expiracion', sa.DateTime, nullable=False,
+                                       server_default=sa.text("(now() at time zone 'utc')")))
+
+    # Las sesiones existentes cuentan como accedidas al migrar y duran el session_ttl por defecto (7 días), para no
+    # cerrar la sesión de todos los usuarios al desplegar
+    op.execute('''
+        UPDATE session
+        SET fecha_expiracion = fecha_ultimo_acceso + interval '{} seconds'
+    '''.format(SESSION_TTL))
+
+    op.create_index('session_fecha_expiracion_idx', 'session', ['fecha_expiracion'])
+
+
+def downgrade():
+    op.drop_index('session_fecha_expiracion_idx', 'session')
+
+    op.drop_column('session', 'fecha_expiracion')
+    op.drop_column('session', 'fecha_ultimo_acceso')
@@ -0,0 +1,24 @@
+"""Versión de avatar
+
+Revision ID: 7e3a9c5b12f8
+Revises: d6b0f83c1e92
+Create Date: 2026-10-18 14:21:37.118540
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7e3a9c5b12f8'
+down_revision = 'd6b0f83c1e92'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('usuario', sa.Column('avatar_version', sa.String(64), nullable=True))
+
+
+def downgrade():
+    op.drop_column('usuario', 'avatar_version')
@@ -0,0 +1,56 @@
+"""Crear tabla resumen_asistencia
+
+Revision ID: a91d3f6e27c4
+Revises: 4c8e2a71d5b3
+Create Date: 2026-10-18 12:14:05.208331
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a91d3f6e27c4'
+down_revision = '4c8e2a71d5b3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('resumen_asistencia',
+                    sa.Column('alumno_id', sa.BigInteger, primary_key=True),
+                    sa.Column('horario_id', sa.Integer, primary_key=True),
+                    sa.Column('ciclo_acad_id', sa.Integer, primary_key=True),
+                    sa.Column('asistencias', sa.Integer, nullable=False, server_default=sa.DefaultClause('0')),
+                    sa.Column('total', sa.Integer, nullable=False, server_default=sa.DefaultClause('0')))
+
+    op.create_foreign_key('alumno_id_fk',
+                          'resumen_asistencia', 'usuario',
+                          ['alumno_id'], ['id'],
+                          ondelete='CASCADE', onupdate='CASCADE')
+
+    op.create_foreign_key('horario_id_fk',
+                          'resumen_asistencia', 'horario_profesor',
+                          ['horario_id'], ['id'],
+                          ondelete='CASCADE', onupdate='CASCADE')
+
+    op.create_foreign_key('ciclo_acad_id_fk',
+                          'resumen_asistencia', 'ciclo_academico',
+                          ['ciclo_acad_id'], ['id'],
+                          ondelete='CASCADE', onupdate='CASCADE')
+
+    op.create_index('resumen_asistencia_ciclo_acad_id_idx', 'resumen_asistencia', ['ciclo_acad_id', 'alumno_id'])
+
+    op.execute('''
+        INSERT INTO resumen_asistencia (alumno_id, horario_id, ciclo_acad_id, asistencias, total)
+        SELECT asistencia.alumno_id, asistencia.horario_id, horario_profesor.ciclo_id,
+               COUNT(CASE WHEN asistencia.asistio = TRUE THEN 1 ELSE NULL END), COUNT(true)
+        FROM asistencia
+        INNER JOIN horario_profesor
+                ON horario_profesor.id = asistencia.horario_id
+        GROUP BY asistencia.alumno_id, asistencia.horario_id, horario_profesor.ciclo_id
+    ''')
+
+
+def downgrade():
+    op.drop_table('resumen_asistencia')
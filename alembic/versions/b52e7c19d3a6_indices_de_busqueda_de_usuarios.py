@@ -0,0 +1,42 @@
+"""Índices de búsqueda de usuarios
+
+Revision ID: b52e7c19d3a6
+Revises: 3f8d2b6a9c41
+Create Date: 2026-10-18 17:10:45.902318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b52e7c19d3a6'
+down_revision = '3f8d2b6a9c41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+
+    # Las expresiones deben ser las mismas que usa la búsqueda para que el ILIKE use los índices
+    op.execute('''
+        CREATE INDEX usuario_nombre_completo_trgm_idx
+        ON usuario
+        USING gin ((nombres || ' ' || apellidos) gin_trgm_ops)
+    ''')
+    op.execute('''
+        CREATE INDEX usuario_correo_electronico_trgm_idx
+        ON usuario
+        USING gin (correo_electronico gin_trgm_ops)
+    ''')
+
+    # Orden de los resultados, para paginar por clave; los nombres nulos se ordenan como ''
+    op.create_index('usuario_busqueda_idx', 'usuario',
+                    ['escuela', sa.text("COALESCE(apellidos, '')"), sa.text("COALESCE(nombres, '')"), 'id'])
+
+
+def downgrade():
+    op.drop_index('usuario_busqueda_idx', 'usuario')
+    op.drop_index('usuario_correo_electronico_trgm_idx', 'usuario')
+    op.drop_index('usuario_nombre_completo_trgm_idx', 'usuario')
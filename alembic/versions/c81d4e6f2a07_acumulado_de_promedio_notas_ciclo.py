@@ -0,0 +1,45 @@
+"""Acumulado de promedio_notas_ciclo
+
+Revision ID: c81d4e6f2a07
+Revises: b52e7c19d3a6
+Create Date: 2026-10-18 18:24:37.615093
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c81d4e6f2a07'
+down_revision = 'b52e7c19d3a6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Suma exacta de nota * porcentaje / 100 (4 decimales), a la que se le suman las diferencias de cada nota que se
+    # registra o corrige; valor es este acumulado redondeado a 2 decimales
+    op.add_column('promedio_notas_ciclo',
+                  sa.Column('acumulado', sa.Numeric(scale=4, precision=6), nullable=False, server_default='0'))
+
+    op.execute('''
+        UPDATE promedio_notas_ciclo
+        SET acumulado = notas.acumulado,
+            valor = ROUND(notas.acumulado, 2)
+        FROM (
+            SELECT estructura_notas.ciclo_acad_id, nota_estudiante.estudiante_id,
+                   SUM(nota_estudiante.valor * nota.porcentaje / 100.0) as acumulado
+            FROM estructura_notas
+            INNER JOIN nota
+                    ON nota.id = estructura_notas.nota_id
+            INNER JOIN nota_estudiante
+                    ON nota_estudiante.nota_id = estructura_notas.nota_id
+            GROUP BY estructura_notas.ciclo_acad_id, nota_estudiante.estudiante_id
+        ) AS notas
+        WHERE promedio_notas_ciclo.ciclo_acad_id = notas.ciclo_acad_id AND
+              promedio_notas_ciclo.estudiante_id = notas.estudiante_id
+    ''')
+
+
+def downgrade():
+    op.drop_column('promedio_notas_ciclo', 'acumulado')
@@ -0,0 +1,32 @@
+"""Mover contenido de archivos a almacén
+
+Revision ID: d6b0f83c1e92
+Revises: a91d3f6e27c4
+Create Date: 2026-10-18 13:02:41.571903
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd6b0f83c1e92'
+down_revision = 'a91d3f6e27c4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('archivo', sa.Column('hash', sa.String(64), nullable=True))
+    op.add_column('archivo', sa.Column('tamano', sa.BigInteger, nullable=True))
+    op.alter_column('archivo', 'contenido', nullable=True)
+
+    op.create_index('archivo_hash_idx', 'archivo', ['hash'])
+
+
+def downgrade():
+    # Los archivos que ya se movieron al almacén deben devolverse a la columna contenido antes de bajar
+    op.drop_index('archivo_hash_idx', 'archivo')
+    op.alter_column('archivo', 'contenido', nullable=False)
+    op.drop_column('archivo', 'tamano')
+    op.drop_column('archivo', 'hash')
@@ -1,13 +1,15 @@
 import asyncio
 import asyncpg
+import logging
 
 from pathlib import Path
-from jinja2 import FileSystemLoader
+from jinja2 import FileSystemLoader, FileSystemBytecodeCache
 from aiohttp.web import Application, run_app, middleware, HTTPFound
 from aiohttp_jinja2 import setup as jinja_setup
 from aiohttp_session import setup as db_session_setup
 
-from utils import router, database_session, auth
+import config
+from utils import router, database_session, auth, storage, passwords, queries, school_terms, fragments
 from config import *
 
 
@@ -25,14 +27,31 @@ app = Application(middlewares=[unauthenticated_middleware])
 
 app.db = None
 
+# Almacén de archivos subidos
+app.blobs = storage.LocalBlobStore(getattr(config, 'blob_storage_path', 'storage/files'))
+
 
 # Temporal, cambiará bastante en base se desarrolle la abstracción de bd
 async def setup_connection_pool(app_: Application):
     if not app_.db:
         app_.db = await asyncpg.create_pool(dsn=db_dsn)
 
-# Registrar Jinja2
-jinja_setup(app, loader=FileSystemLoader(templates_path))
+# Caché de datos de identidad por usuario
+auth.auth_cache.ttl = getattr(config, 'auth_cache_ttl', auth.auth_cache.ttl)
+school_terms.calendar.ttl = getattr(config, 'school_term_cache_ttl', school_terms.calendar.ttl)
+
+# bcrypt fuera del loop
+passwords.hasher.configure(mode=getattr(config, 'password_executor', 'thread'),
+                           workers=getattr(config, 'password_workers', None),
+                           max_pending=getattr(config, 'password_queue_size', 256))
+
+# Registrar Jinja2, con los templates compilados en disco para no volver a compilarlos en cada arranque
+fragments.fragments.entries.ttl = getattr(config, 'fragment_cache_ttl', fragments.fragments.entries.ttl)
+fragments.fragments.entries.maxsize = getattr(config, 'fragment_cache_size', fragments.fragments.entries.maxsize)
+
+jinja_setup(app, loader=FileSystemLoader(templates_path),
+            bytecode_cache=FileSystemBytecodeCache(getattr(config, 'template_cache_path', None)),
+            extensions=[fragments.FragmentCacheExtension])
 
 # Registrar rutas de módulos
 router = router.Router(app)
@@ -44,10 +63,46 @@ static_resources_path = Path(static_resources_path)
 app.router.add_static('/', static_resources_path)
 
 
+async def log_query_stats(app_: Application):
+    for stats in queries.report()[:20]:
+        logging.getLogger('genesis.queries').info('%(name)s: %(calls)d llamadas, %(mean_ms).2f ms promedio, '
+                                                  '%(max_ms).2f ms máx., %(errors)d errores', stats)
+
+    logging.getLogger('genesis.passwords').info('%(completed)d operaciones completadas, %(rejected)d rechazadas, '
+                                                'máximo de %(peak)d pendientes de %(max_pending)d, %(workers)d '
+                                                'trabajadores', passwords.hasher.stats)
+
+app.on_cleanup.append(log_query_stats)
+
+
+def setup_session_storage(app_: Application) -> database_session.DatabaseStorage:
+    sweeper = database_session.SessionSweeper(app_.db,
+                                              interval=getattr(config, 'session_sweep_interval', 60 * 60),
+                                              batch_size=getattr(config, 'session_sweep_batch', 1000),
+                                              vacuum_threshold=getattr(config, 'session_vacuum_threshold', None))
+    app_.on_startup.append(sweeper.start)
+    app_.on_cleanup.append(sweeper.stop)
+
+    expiration = {'ttl': getattr(config, 'session_ttl', 7 * 24 * 60 * 60),
+                  'touch_interval': getattr(config, 'session_touch_interval', 600)}
+
+    if getattr(config, 'session_storage', 'database') != 'cached':
+        return database_session.DatabaseStorage(app_.db, **expiration)
+
+    storage = database_session.CachedDatabaseStorage(app_.db,
+                                                     cache_size=getattr(config, 'session_cache_size', 10000),
+                                                     flush_interval=getattr(config, 'session_flush_interval', 500),
+                                                     **expiration)
+    app_.on_startup.append(storage.start)
+    app_.on_cleanup.append(storage.stop)
+
+    return storage
+
+
 def main():
     loop = asyncio.get_event_loop()
     loop.run_until_complete(setup_connection_pool(app))
-    db_session_setup(app, database_session.DatabaseStorage(app.db))
+    db_session_setup(app, setup_session_storage(app))
     run_app(app, host=host, port=port)
 
 
@@ -0,0 +1,336 @@
+import asyncio
+from argparse import ArgumentParser
+from asyncpg import create_pool
+
+
+async def get_pool():
+    from config import db_dsn
+
+    return await create_pool(dsn=db_dsn)
+
+
+def get_blob_store():
+    import config
+    from utils.storage import LocalBlobStore
+
+    return LocalBlobStore(getattr(config, 'blob_storage_path', 'storage/files'))
+
+
+async def rebuild_attendance_summary(args):
+    from modules.attendance import AttendanceSummary
+
+    pool = await get_pool()
+
+    try:
+        status = await AttendanceSummary.rebuild(pool, args.school_term)
+    finally:
+        await pool.close()
+
+    print('resumen_asistencia: {} filas'.format(status.split()[-1]))
+
+
+async def recompute_final_grades(args):
+    from modules.grades import FinalGrade
+
+    pool = await get_pool()
+
+    try:
+        status = await FinalGrade.rebuild(pool, args.school_term)
+    finally:
+        await pool.close()
+
+    print('promedio_notas_ciclo: {} filas'.format(status.split()[-1]))
+
+
+async def migrate_files(args):
+    select_query = '''
+        SELECT id, contenido
+        FROM archivo
+        WHERE hash IS NULL AND
+              contenido IS NOT NULL
+        ORDER BY id
+        LIMIT $1
+    '''
+    update_statement = '''
+        UPDATE archivo
+        SET hash = $2,
+            tamano = $3,
+            contenido = NULL
+        WHERE id = $1
+    '''
+    pool = await get_pool()
+    blobs = get_blob_store()
+    total = 0
+
+    try:
+        while True:
+            async with pool.acquire() as connection:
+                files = await connection.fetch(select_query, args.batch_size)
+
+            if not files:
+                break
+
+            values = list()
+
+            for file in files:
+                content = bytes(file['contenido'])
+                values.append((file['id'], await blobs.put(content), len(content)))
+
+            # Se escribe en el almacén antes de vaciar contenido, así una interrupción no pierde archivos
+            async with pool.acquire() as connection:
+                async with connection.transaction():
+                    await connection.executemany(update_statement, values)
+
+            total += len(values)
+            print('archivo: {} movidos'.format(total))
+    finally:
+        await pool.close()
+
+
+async def migrate_avatars(args):
+    from base64 import b64decode
+    from utils.avatars import create_thumbnail
+
+    select_query = '''
+        SELECT id, avatar
+        FROM usuario
+        WHERE avatar IS NOT NULL AND
+              avatar_version IS NULL
+        ORDER BY id
+        LIMIT $1
+    '''
+    update_statement = '''
+        UPDATE usuario
+        SET avatar = NULL,
+            avatar_version = $2
+        WHERE id = $1
+    '''
+    pool = await get_pool()
+    blobs = get_blob_store()
+    total = 0
+
+    try:
+        while True:
+            async with pool.acquire() as connection:
+                users = await connection.fetch(select_query, args.batch_size)
+
+            if not users:
+                break
+
+            values = list()
+
+            for user in users:
+                try:
+                    thumbnail = await create_thumbnail(b64decode(bytes(user['avatar'])))
+                except (IOError, ValueError):
+                    # Imagen ilegible, se descarta
+                    values.append((user['id'], None))
+                    continue
+
+                values.append((user['id'], await blobs.put(thumbnail)))
+
+            async with pool.acquire() as connection:
+                async with connection.transaction():
+                    await connection.executemany(update_statement, values)
+
+            total += len(values)
+            print('usuario: {} avatares migrados'.format(total))
+    finally:
+        await pool.close()
+
+
+async def bench_routes(args):
+    from time import perf_counter
+    from aiohttp.web import Application
+    from aiohttp.test_utils import make_mocked_request
+
+    import config
+    from utils.router import Router
+
+    app = Application()
+    router = Router(app)
+    router.update(config.modules)
+    router.register()
+
+    results = list()
+
+    for path, view, methods in router.table():
+        sample = router.sample_path(path)
+        request = make_mocked_request(methods[0] if methods[0] != '*' else 'GET', sample, app=app)
+
+        start = perf_counter()
+
+        for _ in range(args.iterations):
+            await app.router.resolve(request)
+
+        results.append((sample, (perf_counter() - start) / args.iterations * 1e6))
+
+    # Lo que paga una ruta que no existe: recorrer todas las demás
+    request = make_mocked_request('GET', '/no-existe/1', app=app)
+    start = perf_counter()
+
+    for _ in range(args.iterations):
+        await app.router.resolve(request)
+
+    missing = (perf_counter() - start) / args.iterations * 1e6
+
+    for sample, elapsed in sorted(results, key=lambda r: r[1], reverse=True):
+        print('{:>8.2f} µs  {}'.format(elapsed, sample))
+
+    print('{} rutas, promedio {:.2f} µs, máximo {:.2f} µs, ruta inexistente {:.2f} µs'.format(
+        len(results), sum(r[1] for r in results) / len(results), max(r[1] for r in results), missing))
+
+
+class NullPool:
+    """
+        Pool que responde 0 a todas las consultas sin ir a la BD, para medir solo el costo del validador.
+    """
+    def acquire(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def fetchval(self, *args):
+        return 0
+
+
+async def bench_validator(args):
+    from time import perf_counter
+    from utils.validator import validator
+    from utils.legacy_validator import LegacyValidator
+    from modules.users import Registration, EditProfile
+
+    # Mismos campos y reglas que Registration.validate y EditProfile.validate
+    def registration(data: dict) -> list:
+        return [
+            ['Nombres', data['name'], 'len:4,64'],
+            ['Apellidos', data['last_name'], 'len:4,84'],
+            ['Correo electrónico', data['email'], 'len:14,128|email|unique:correo_electronico,usuario'],
+            ['Tipo de documento', data['id_type'], 'digits|len:1|custom', Registration._validate_document_type],
+            ['DNI o Carné de extranjería', data['id'], 'digits|custom|unique:id<int>,usuario',
+             Registration._validate_id],
+            ['Contraseña', data['password'], 'len:8,16|password'],
+            ['Repetir contraseña', data['repeat_password'], 'repeat'],
+            ['Escuela', data['school'], 'digits|len:1|custom', Registration._validate_school]
+        ]
+
+    def edit_profile(data: dict) -> list:
+        return [
+            ['Nombres', data['name'], 'len:8,64'],
+            ['Apellidos', data['last_name'], 'len:8,64'],
+            ['Dirección', data['address'], 'len:8,64'],
+            ['Email', data['email'], 'len:14,128|email|custom', EditProfile._validate_email, 1],
+            ['Teléfono', data['phone'], 'digits|len:9'],
+            ['Nacionalidad', data['nationality'], 'letters|len:2|custom', EditProfile._validate_nationality],
+            ['Distrito', data['district'], 'digits|len:1|custom', EditProfile._validate_district],
+            ['Sexo', data['gender'], 'digits|len:1|custom', EditProfile._validate_sex]
+        ]
+
+    forms = (
+        ('registro', registration({
+            'name': 'Juan Carlos', 'last_name': 'Pérez Rodríguez', 'email': 'juan.perez@example.com',
+            'id_type': '0', 'id': '12345678', 'password': 'abc12345', 'repeat_password': 'abc12345', 'school': '1'
+        })),
+        ('registro con errores', registration({
+            'name': 'Jo', 'last_name': 'Pérez Rodríguez', 'email': 'juan.perez', 'id_type': '3', 'id': '1234',
+            'password': 'abc12345', 'repeat_password': 'abc1234', 'school': 'x'
+        })),
+        ('perfil', edit_profile({
+            'name': 'Juan Carlos', 'last_name': 'Pérez Rodríguez', 'address': 'Av. La Fontana 1250',
+            'email': 'juan.perez@example.com', 'phone': '987654321', 'nationality': 'PE', 'district': '1',
+            'gender': '0'
+        })),
+        ('perfil con errores', edit_profile({
+            'name': 'Juan', 'last_name': 'Pérez Rodríguez', 'address': 'Av. La Fontana 1250',
+            'email': 'juan.perez@example', 'phone': '98765', 'nationality': 'PE', 'district': '99', 'gender': '0'
+        }))
+    )
+    dbi = NullPool()
+    legacy = LegacyValidator()
+
+    for name, elems in forms:
+        results = list()
+
+        for path in (legacy.interpret, validator.validate):
+            errors = await path(elems, dbi)
+            start = perf_counter()
+
+            for _ in range(args.iterations):
+                await path(elems, dbi)
+
+            results.append(((perf_counter() - start) / args.iterations * 1e6, errors))
+
+        (before, expected), (after, errors) = results
+
+        print('{:<22} {:>8.2f} µs -> {:>8.2f} µs  x{:.1f}  {}'.format(
+            name, before, after, before / after, 'mismos errores' if errors == expected else 'ERRORES DISTINTOS'))
+
+
+commands = {
+    'rebuild-attendance-summary': rebuild_attendance_summary,
+    'recompute-final-grades': recompute_final_grades,
+    'migrate-files': migrate_files,
+    'migrate-avatars': migrate_avatars,
+    'bench-routes': bench_routes,
+    'bench-validator': bench_validator
+}
+
+
+def get_parser() -> ArgumentParser:
+    parser = ArgumentParser(description='Tareas de mantenimiento de Genesis')
+    subparsers = parser.add_subparsers(dest='command')
+
+    _parser = subparsers.add_parser('rebuild-attendance-summary',
+                                    help='Recalcula resumen_asistencia a partir de la tabla asistencia')
+    _parser.add_argument('--school-term', type=int, default=None,
+                         help='Solo recalcular el ciclo académico indicado')
+
+    _parser = subparsers.add_parser('recompute-final-grades',
+                                    help='Recalcula promedio_notas_ciclo a partir de nota_estudiante y la estructura '
+                                         'de notas')
+    _parser.add_argument('--school-term', type=int, default=None,
+                         help='Solo recalcular el ciclo académico indicado')
+
+    _parser = subparsers.add_parser('migrate-files',
+                                    help='Mueve el contenido de la tabla archivo al almacén de archivos')
+    _parser.add_argument('--batch-size', type=int, default=50,
+                         help='Archivos leídos de la BD por lote')
+
+    _parser = subparsers.add_parser('migrate-avatars',
+                                    help='Convierte los avatares guardados en usuario.avatar a miniaturas en el '
+                                         'almacén de archivos')
+    _parser.add_argument('--batch-size', type=int, default=100,
+                         help='Usuarios leídos de la BD por lote')
+
+    _parser = subparsers.add_parser('bench-routes',
+                                    help='Mide cuánto cuesta resolver cada ruta registrada')
+    _parser.add_argument('--iterations', type=int, default=10000,
+                         help='Resoluciones por ruta')
+
+    _parser = subparsers.add_parser('bench-validator',
+                                    help='Compara validar con y sin planes compilados en los formularios de registro '
+                                         'y de perfil')
+    _parser.add_argument('--iterations', type=int, default=10000,
+                         help='Validaciones por formulario')
+
+    return parser
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+
+    if args.command not in commands:
+        parser.print_help()
+        return
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(commands[args.command](args))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,10 +3,60 @@ from datetime import datetime, timedelta
 from asyncpg.pool import PoolConnectionHolder
 from aiohttp.web import View, json_response, HTTPUnauthorized
 
+from utils.queries import fetch, fetchval, execute, cursor
+from utils.school_terms import calendar
+from utils.bulk import insert_many
 from utils.map import map_users, parse_data_key
 from utils.helpers import view, flatten, pass_user, permission_required, school_term_to_str, schedule_to_str
 
 
+class AttendanceSummary:
+    """
+        Mantiene resumen_asistencia, los totales de asistencias por (alumno, horario, ciclo académico), para que los
+        listados y reportes no tengan que recorrer todo el historial de asistencia.
+    """
+    @staticmethod
+    async def update(data: list, connection):
+        # data: [[alumno_id, horario_id, fecha_registro, observacion, asistio], ...], dentro de la misma transacción
+        # en la que se registran las asistencias
+        statement = '''
+            INSERT INTO resumen_asistencia (alumno_id, horario_id, ciclo_acad_id, asistencias, total)
+            SELECT registro.alumno_id, horario_profesor.id, horario_profesor.ciclo_id,
+                   COUNT(CASE WHEN registro.asistio = TRUE THEN 1 ELSE NULL END), COUNT(true)
+            FROM UNNEST($1::bigint[], $2::int[], $3::bool[]) AS registro (alumno_id, horario_id, asistio)
+            INNER JOIN horario_profesor
+                    ON horario_profesor.id = registro.horario_id
+            GROUP BY registro.alumno_id, horario_profesor.id, horario_profesor.ciclo_id
+            ON CONFLICT ON CONSTRAINT resumen_asistencia_pkey
+            DO UPDATE SET asistencias = resumen_asistencia.asistencias + EXCLUDED.asistencias,
+                          total = resumen_asistencia.total + EXCLUDED.total
+        '''
+        await execute(connection, statement, [r[0] for r in data], [r[1] for r in data], [r[4] for r in data])
+
+    @staticmethod
+    async def rebuild(dbi: PoolConnectionHolder, school_term: int = None):
+        statements = ('''
+            DELETE FROM resumen_asistencia
+            WHERE $1::int IS NULL OR
+                  ciclo_acad_id = $1
+        ''', '''
+            INSERT INTO resumen_asistencia (alumno_id, horario_id, ciclo_acad_id, asistencias, total)
+            SELECT asistencia.alumno_id, asistencia.horario_id, horario_profesor.ciclo_id,
+                   COUNT(CASE WHEN asistencia.asistio = TRUE THEN 1 ELSE NULL END), COUNT(true)
+            FROM asistencia
+            INNER JOIN horario_profesor
+                    ON horario_profesor.id = asistencia.horario_id
+            WHERE $1::int IS NULL OR
+                  horario_profesor.ciclo_id = $1
+            GROUP BY asistencia.alumno_id, asistencia.horario_id, horario_profesor.ciclo_id
+        ''')
+
+        async with dbi.acquire() as connection:
+            async with connection.transaction():
+                await execute(connection, statements[0], school_term)
+                return await execute(connection, statements[1], school_term)
+
+
 class StudentsList(View):
     @view('attendance.list')
     @permission_required('ver_listado_alumnos')
@@ -48,15 +98,7 @@ class StudentsList(View):
         return list(_g(await self._get_school_terms(user['escuela'])))
 
     async def _get_school_terms(self, school: int):
-        query = '''
-            SELECT id, fecha_comienzo, fecha_fin
-            FROM ciclo_academico
-            WHERE ciclo_academico.escuela = $1
-            ORDER BY id DESC
-            LIMIT 10
-        '''
-        async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetch(school)
+        return await calendar.recent(self.request.app.db, school)
 
     async def get_grades(self, school_term: int):
         query = '''
@@ -68,49 +110,20 @@ class StudentsList(View):
             ORDER BY estructura_notas.nota_id ASC
         '''
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetch(school_term)
+            return await fetch(connection, query, school_term)
 
     async def get_school_term(self, school: int, school_term: int = None):
         if school_term is None:
-            query = '''
-                SELECT id, fecha_comienzo, fecha_fin
-                FROM ciclo_academico
-                WHERE $1 >= fecha_comienzo AND
-                      $1 <= fecha_fin AND
-                      escuela = $2
-                LIMIT 1
-            '''
-        else:
-            query = '''
-                SELECT id, fecha_comienzo, fecha_fin
-                FROM ciclo_academico
-                WHERE id = $1 AND
-                      escuela = $2
-                LIMIT 1
-            '''
+            return await calendar.current(self.request.app.db, school)
 
-        async with self.request.app.db.acquire() as connection:
-            statement = await connection.prepare(query)
-            if school_term is None:
-                return await statement.fetchrow(datetime.utcnow(), school)
-            else:
-                return await statement.fetchrow(school_term, school)
+        return await calendar.get(self.request.app.db, school_term, school)
 
     async def get_students(self, school_term: int, school: int, student_role_id: int = 1, danger: int = 63,
                            amount: int = 1000):
         query = '''
             WITH alumno AS (
                 SELECT usuario.id, tipo_documento, nombres, apellidos, escuela,
-                    COALESCE(
-                        (SELECT CAST(COUNT(CASE WHEN asistio=true THEN 1 ELSE NULL END) / CAST(COUNT(*) AS FLOAT) * 100
-                        AS INT)
-                            FROM asistencia
-                            RIGHT JOIN ciclo_academico
-                                    ON ciclo_academico.fecha_comienzo <= asistencia.fecha_registro AND
-                                       ciclo_academico.fecha_fin >= asistencia.fecha_registro
-                       WHERE asistencia.alumno_id = usuario.id
-                       HAVING COUNT(*) >= 1),
-                    0) AS asistencia,
+                    COALESCE(CAST(resumen.asistencias / CAST(resumen.total AS FLOAT) * 100 AS INT), 0) AS asistencia,
                     proyecto.id as id_proyecto, COALESCE(proyecto.titulo, 'No registrado') as titulo_proyecto,
                     (
                         SELECT COUNT(true)
@@ -128,6 +141,11 @@ class StudentsList(View):
                 INNER JOIN matricula
                         ON matricula.estudiante_id = usuario.id AND
                            matricula.ciclo_acad_id = $1
+                LEFT JOIN (SELECT alumno_id, SUM(asistencias) as asistencias, SUM(total) as total
+                           FROM resumen_asistencia
+                           WHERE ciclo_acad_id = $1
+                           GROUP BY alumno_id) as resumen
+                       ON resumen.alumno_id = usuario.id
                 WHERE rol_id = $2 AND
                       escuela = $3 AND
                       nombres != '' AND
@@ -144,8 +162,7 @@ class StudentsList(View):
         '''
 
         async with self.request.app.db.acquire() as connection:
-            stmt = await connection.prepare(query)
-            return await stmt.fetch(school_term, student_role_id, school, amount, danger)
+            return await fetch(connection, query, school_term, student_role_id, school, amount, danger)
 
 
 class ReadAttendanceReport(View):
@@ -186,12 +203,17 @@ class ReadAttendanceReport(View):
         if not schedules:
             return json_response({'message': 'No hay horarios disponibles'}, status=400)
 
-        attendances = dict()
+        attendances = {schedule['id']: [] for schedule in schedules}
+        counts = dict()
 
-        for schedule in schedules:
-            attendances[schedule['id']] = await self.fetch_attendance_for_schedule(student_id,
-                                                                                   schedule['id'],
-                                                                                   self.request.app.db)
+        # Una sola pasada sobre las asistencias del estudiante en el ciclo, ya agrupadas por horario
+        for attendance in await self.fetch_attendances(student_id, school_term['id'], self.request.app.db):
+            attendances.setdefault(attendance['horario_id'], []).append({
+                'horario_id': attendance['horario_id'],
+                'fecha_registro': attendance['fecha_registro'],
+                'asistio': attendance['asistio']
+            })
+            counts[attendance['horario_id']] = attendance['asistidas'], attendance['total']
 
         result_data = flatten({
             'school_term': school_term,
@@ -204,25 +226,15 @@ class ReadAttendanceReport(View):
         total_amount, attended = 0, 0
 
         for _i, _s in enumerate(result_data['schedules']):
-            _ni = _i + 1
-            result_data['overall'][_ni] = list()
-
-            for _, _s_wa in result_data['attendances'].items():
-                if _s_wa:
-                    for _a in _s_wa:
-                        if _a['horario_id'] == _s['id']:
-                            total_amount += 1
-                            if _a['asistio']:
-                                attended += 1
-                                result_data['overall'][_ni].append(1)
-                            else:
-                                result_data['overall'][_ni].append(0)
+            _attended, _total = counts.get(_s['id'], (0, 0))
 
-        for _k, _overall in result_data['overall'].items():
-            if _overall:
-                result_data['overall'][_k] = int(round(sum(_overall) / len(_overall), 2) * 100)
+            total_amount += _total
+            attended += _attended
+
+            if _total:
+                result_data['overall'][_i + 1] = int(round(_attended / _total, 2) * 100)
             else:
-                result_data['overall'][_k] = 0
+                result_data['overall'][_i + 1] = 0
 
         if attended != 0 and total_amount != 0:
             result_data['overall']['average'] = int(round(attended / total_amount, 2) * 100)
@@ -233,16 +245,22 @@ class ReadAttendanceReport(View):
 
 
     @staticmethod
-    async def fetch_attendance_for_schedule(student: int, schedule: int, dbi: PoolConnectionHolder):
+    async def fetch_attendances(student: int, school_term: int, dbi: PoolConnectionHolder):
         query = '''
-            SELECT horario_id, fecha_registro, asistio
+            SELECT asistencia.horario_id, asistencia.fecha_registro, asistencia.asistio,
+                   COUNT(true) OVER (PARTITION BY asistencia.horario_id) as total,
+                   COUNT(CASE WHEN asistencia.asistio = TRUE THEN 1 ELSE NULL END)
+                        OVER (PARTITION BY asistencia.horario_id) as asistidas
             FROM asistencia
-            WHERE alumno_id = $1 AND
-                  horario_id = $2
+            INNER JOIN horario_profesor
+                    ON horario_profesor.id = asistencia.horario_id
+            WHERE asistencia.alumno_id = $1 AND
+                  horario_profesor.ciclo_id = $2
+            ORDER BY asistencia.horario_id ASC, asistencia.fecha_registro ASC
         '''
 
         async with dbi.acquire() as connection:
-            return await (await connection.prepare(query)).fetch(student, schedule)
+            return await fetch(connection, query, student, school_term)
 
     @staticmethod
     async def fetch_schedules(school_term: int, dbi: PoolConnectionHolder):
@@ -257,32 +275,15 @@ class ReadAttendanceReport(View):
             ORDER BY usuario.nombres ASC, usuario.apellidos ASC, dia_clase ASC, hora_comienzo ASC
         '''
         async with dbi.acquire() as connection:
-            return await (await connection.prepare(query)).fetch(school_term)
+            return await fetch(connection, query, school_term)
 
     @staticmethod
     async def fetch_school_term(school: int, dbi: PoolConnectionHolder):
-        query = '''
-            SELECT id, fecha_comienzo, fecha_fin
-            FROM ciclo_academico
-            WHERE $1 >= fecha_comienzo AND
-                  $1 <= fecha_fin AND
-                  escuela = $2
-            LIMIT 1
-        '''
-        async with dbi.acquire() as connection:
-            return await (await connection.prepare(query)).fetchrow(datetime.utcnow(), school)
+        return await calendar.current(dbi, school)
 
     @staticmethod
     async def school_term_exists(school_term: int, school: int, dbi: PoolConnectionHolder):
-        query = '''
-            SELECT true
-            FROM ciclo_academico
-            WHERE id = $1 AND
-                  escuela = $2
-            LIMIT 1
-        '''
-        async with dbi.acquire() as connection:
-            return await (await connection.prepare(query)).fetchval(school_term, school)
+        return await calendar.get(dbi, school_term, school) is not None
 
 
 class RegisterAttendance(View):
@@ -316,7 +317,7 @@ class RegisterAttendance(View):
 
         result = await self.register_attendance(data, self.request.app.db)
 
-        if isinstance(result, list):
+        if result:
             display_data.update({'result': True})
         else:
             display_data.update({'result': False})
@@ -325,13 +326,13 @@ class RegisterAttendance(View):
 
     async def can_register_attendance(self, teacher: int, school_term: int) -> Union[bool, int]:
         async with self.request.app.db.acquire() as connection:
-            schedules = await (await connection.prepare('''
+            schedules = await fetch(connection, '''
                 SELECT horario_profesor.dia_clase as dia, horario_profesor.hora_comienzo as comienzo,
                        horario_profesor.hora_fin as fin, horario_profesor.id
                 FROM horario_profesor
                 WHERE horario_profesor.ciclo_id = $1 AND
                       horario_profesor.profesor_id = $2
-            ''')).fetch(school_term, teacher)
+            ''', school_term, teacher)
 
             if not schedules:
                 return False
@@ -373,14 +374,14 @@ class RegisterAttendance(View):
         end_ = await self.get_datetime(end)
 
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare('''
+            return await fetchval(connection, '''
                 SELECT true
                 FROM asistencia
                 WHERE horario_id = $1 AND
                       fecha_registro >= $2 AND
                       fecha_registro <= $3
                 LIMIT 1
-            ''')).fetchval(schedule, start_, end_) or False
+            ''', schedule, start_, end_) or False
 
     @staticmethod
     async def get_datetime(time_: tuple):
@@ -420,41 +421,33 @@ class RegisterAttendance(View):
     async def register_attendance(data: list, dbi: PoolConnectionHolder):
         async with dbi.acquire() as connection:
             async with connection.transaction():
-                query = '''
-                    INSERT INTO asistencia (alumno_id, horario_id, fecha_registro, observacion, asistio)
-                    VALUES {0}
-                    RETURNING true;
-                '''.format(','.join(['({})'.format(
-                    ','.join(list(
-                        map(lambda x: '\''+str(x)+'\'' if not isinstance(x, str) else '\''+x+'\'', v)
-                    ))) for v in data]))
+                result = await insert_many(connection, 'asistencia',
+                                           ('alumno_id', 'horario_id', 'fecha_registro', 'observacion', 'asistio'),
+                                           data)
+
+                await AttendanceSummary.update(data, connection)
 
-                return await connection.fetch(query)
+                return result
 
     @staticmethod
     async def fetch_students(school: int,  dbi: PoolConnectionHolder):
+        school_term = await calendar.current(dbi, school, datetime.utcnow() - timedelta(hours=5))
+
+        if school_term is None:
+            return []
+
         query = '''
-            WITH ciclo_academico AS (
-                SELECT ciclo_academico.id
-                FROM ciclo_academico
-                WHERE ciclo_academico.fecha_comienzo <= $1 AND
-                      ciclo_academico.fecha_fin >= $1 AND
-                      ciclo_academico.escuela = $2
-                LIMIT 1
-            )
-            
             SELECT usuario.id, usuario.nombres, usuario.apellidos
             FROM usuario
             INNER JOIN matricula
                     ON matricula.estudiante_id = usuario.id AND
-                       matricula.ciclo_acad_id = (SELECT id FROM ciclo_academico)
+                       matricula.ciclo_acad_id = $1
             WHERE usuario.rol_id = 1 AND
-                  usuario.escuela = $2 AND
-                  matricula.ciclo_acad_id = (SELECT id FROM ciclo_academico)
+                  usuario.escuela = $2
             ORDER BY apellidos ASC
         '''
         async with dbi.acquire() as connection:
-            return await (await connection.prepare(query)).fetch(datetime.utcnow() - timedelta(hours=5), school)
+            return await fetch(connection, query, school_term['id'], school)
 
 
 class DetailedReport(View):
@@ -473,6 +466,9 @@ class DetailedReport(View):
                                                       schedule['hora_comienzo'],
                                                       schedule['hora_fin'])
 
+            # Totales de todos los pares (estudiante, horario) del ciclo, desde resumen_asistencia
+            attendance_totals = await self.fetch_attendance_totals(school_term)
+
             del school_term
 
             for i, student in enumerate(students):
@@ -480,10 +476,14 @@ class DetailedReport(View):
                 students[i]['total_attendances'] = 0
                 students[i]['total_non_attendances'] = 0
                 for schedule in schedules:
-                    attendances = await self.fetch_non_attendances(student['id'], schedule['id'])
-                    non_attendances = attendances['inasistencias_porcentaje'] or 0
-                    _non_attendances_amount = attendances['inasistencias'] or 0
-                    _total_attendances = attendances['total_asistencias'] or 0
+                    attendances = attendance_totals.get((student['id'], schedule['id']))
+                    _non_attendances_amount = attendances['inasistencias'] if attendances else 0
+                    _total_attendances = attendances['total_asistencias'] if attendances else 0
+
+                    if _non_attendances_amount:
+                        non_attendances = int(round(_non_attendances_amount / _total_attendances * 100))
+                    else:
+                        non_attendances = 0
 
                     students[i]['total_non_attendances'] += _non_attendances_amount
                     students[i]['total_attendances'] += _total_attendances
@@ -509,25 +509,25 @@ class DetailedReport(View):
                   horario_id = $2
         '''
         async with dbi.acquire() as connection:
-            return await (await connection.prepare(query)).fetch(student, schedule)
+            return await fetch(connection, query, student, schedule)
 
     async def get_students(self, school: int):
+        school_term = await calendar.current(self.request.app.db, school)
+
+        if school_term is None:
+            return []
+
         query = '''
             SELECT id, CASE WHEN tipo_documento = 0 THEN 'DNI' ELSE 'Carné de extranjería' END as tipo_documento,
                    nombres, apellidos, matricula.ciclo_acad_id
             FROM usuario
             INNER JOIN matricula
-                    ON matricula.ciclo_acad_id = (SELECT id
-                                                  FROM ciclo_academico
-                                                  WHERE escuela = $1 AND
-                                                        $2 >= fecha_comienzo AND
-                                                        $2 <= fecha_fin LIMIT 1) AND
+                    ON matricula.ciclo_acad_id = $1 AND
                        matricula.estudiante_id = usuario.id
         '''
 
         async with self.request.app.db.acquire() as connection:
-            stmt = await connection.prepare(query)
-            return await stmt.fetch(school, datetime.utcnow())
+            return await fetch(connection, query, school_term['id'])
 
     async def fetch_schedules(self, school_term: int):
         query = '''
@@ -541,35 +541,22 @@ class DetailedReport(View):
             ORDER BY usuario.nombres ASC, usuario.apellidos ASC, dia_clase ASC, hora_comienzo ASC
         '''
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetch(school_term)
+            return await fetch(connection, query, school_term)
 
-    async def fetch_non_attendances(self, student: int, schedule: int):
+    async def fetch_attendance_totals(self, school_term: int) -> dict:
         query = '''
-            WITH total_asistencias AS (
-                SELECT COUNT(true) as cant_asistencias
-                FROM asistencia
-                WHERE alumno_id = $1 AND
-                      horario_id = $2
-                LIMIT 1
-            ), inasistencias AS (
-                SELECT COUNT(true) as cant_inasistencias
-                FROM asistencia
-                WHERE alumno_id = $1 AND
-                      horario_id = $2 AND
-                      asistio = FALSE
-                HAVING COUNT(*) >= 1
-                LIMIT 1
-            )
-            SELECT CAST(
-                (SELECT CAST(cant_inasistencias AS FLOAT) FROM inasistencias) /
-                COALESCE((SELECT CAST(cant_asistencias AS FLOAT) FROM total_asistencias), 1) * 100
-            AS INT) as inasistencias_porcentaje,
-                  (SELECT cant_inasistencias FROM inasistencias) as inasistencias,
-                  (SELECT cant_asistencias FROM total_asistencias) as total_asistencias
-            LIMIT 1
+            SELECT alumno_id, horario_id, total as total_asistencias, total - asistencias as inasistencias
+            FROM resumen_asistencia
+            WHERE ciclo_acad_id = $1
         '''
+        totals = dict()
+
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetchrow(student, schedule)
+            async with connection.transaction():
+                async for row in cursor(connection, query, school_term):
+                    totals[row['alumno_id'], row['horario_id']] = row
+
+        return totals
 
 
 routes = {
@@ -1,7 +1,8 @@
-from aiohttp.web import View, StreamResponse, HTTPNotFound
+from aiohttp.web import View, HTTPNotFound
 
-from utils.map import parse_data_key
-from utils.helpers import pass_user, get_chunks, permission_required
+from utils.queries import fetchrow
+from utils.storage import send_file
+from utils.helpers import pass_user, permission_required
 
 
 class File(View):
@@ -13,33 +14,13 @@ class File(View):
         if not file:
             raise HTTPNotFound
 
-        headers = {
-            'Content-Type': parse_data_key(file['ext'], 'files'),
-            'Content-Disposition': 'attachment; filename={file}'.format(file=file['nombre'])
-        }
-
-        response = StreamResponse(status=200, reason='OK', headers=headers)
-
-        chunks = tuple(get_chunks(file['contenido']))
-
-        await response.prepare(self.request)
-
-        for i in range(0, len(chunks)):
-            try:
-                response.write(chunks[i])
-
-                await response.drain()
-            except Exception as e:
-                print(repr(e))
-
-        del file, chunks
-
-        return response
+        return await send_file(self.request, file)
 
     async def fetch_file(self, id_: int) -> dict:
         query = '''
             SELECT CONCAT(archivo.nombre, '.', archivo.ext) as nombre,
-                   archivo.contenido, archivo.ext
+                   archivo.hash, archivo.ext, archivo.fecha_subido,
+                   CASE WHEN archivo.hash IS NULL THEN archivo.contenido END as contenido
             FROM archivo
             INNER JOIN solicitud_autorizacion
                     ON solicitud_autorizacion.archivo_id = archivo.id
@@ -48,7 +29,7 @@ class File(View):
         '''
 
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetchrow(id_)
+            return await fetchrow(connection, query, id_)
 
 
 routes = {
@@ -1,49 +1,92 @@
+import io
+import re
+import csv
 from decimal import Decimal
 from datetime import datetime
 from typing import Union, Generator
 from asyncpg.pool import PoolConnectionHolder
 from aiohttp.web import View, json_response, HTTPNotFound, HTTPUnauthorized
 
+from utils.queries import fetch, fetchrow, fetchval, execute, copy_records
+from utils.school_terms import calendar
+from utils.fragments import fragments
+from utils.eligibility import eligible_projects, fetch_eligible_projects, invalidate_eligible_projects, PASSING_GRADE
 from utils.validator import validator
 from utils.map import map_users
 from utils.helpers import view, flatten, pass_user, permission_required, school_term_to_str
 
 
 class FinalGrade:
+    """
+        Mantiene promedio_notas_ciclo. Cada nota que se registra o corrige le suma al promedio del estudiante solo la
+        diferencia (nuevo - anterior) * porcentaje / 100, dentro de la misma transacción que escribe la nota, sobre
+        acumulado (4 decimales, exacto); valor es acumulado redondeado. rebuild recalcula todo un ciclo académico, para
+        cuando cambia la estructura de notas.
+    """
     @staticmethod
-    async def fetch_final_grade(student: int, school_term: int, dbi: PoolConnectionHolder = None):
-        query = '''
-            WITH ciclo_academico AS (
-                SELECT id
-                FROM ciclo_academico
-                WHERE ciclo_academico.id = $2
-                LIMIT 1
-            )
-            SELECT SUM(COALESCE(nota_estudiante.valor, 0.0) * nota.porcentaje / 100.0)
-            FROM estructura_notas
-            LEFT JOIN nota
-                   ON nota.id = estructura_notas.nota_id
-            LEFT JOIN nota_estudiante
-                   ON nota_estudiante.nota_id = estructura_notas.nota_id AND
-                      nota_estudiante.estudiante_id = $1
-            WHERE estructura_notas.ciclo_acad_id = (SELECT id from ciclo_academico) AND
-                  nota_estudiante.estudiante_id = $1
-            LIMIT 1
-        '''
-        async with dbi.acquire() as connection:
-            return await (await connection.prepare(query)).fetchval(student, school_term) or Decimal(0.0)
-
-    @staticmethod
-    async def update(student: int, school_term: int, dbi: PoolConnectionHolder = None,
-                     callback=None):
+    async def update(data: list, connection) -> list:
+        # data: [[estudiante_id, nota_id, diferencia], ...]; retorna los ciclos académicos afectados
         statement = '''
-            INSERT INTO promedio_notas_ciclo (ciclo_acad_id, estudiante_id, valor)
-            VALUES ($2, $1, $3)
+            INSERT INTO promedio_notas_ciclo (ciclo_acad_id, estudiante_id, acumulado, valor)
+            SELECT estructura_notas.ciclo_acad_id, cambio.estudiante_id,
+                   SUM(cambio.diferencia * nota.porcentaje / 100.0),
+                   ROUND(SUM(cambio.diferencia * nota.porcentaje / 100.0), 2)
+            FROM UNNEST($1::bigint[], $2::int[], $3::numeric[]) AS cambio (estudiante_id, nota_id, diferencia)
+            INNER JOIN estructura_notas
+                    ON estructura_notas.nota_id = cambio.nota_id
+            INNER JOIN nota
+                    ON nota.id = cambio.nota_id
+            GROUP BY estructura_notas.ciclo_acad_id, cambio.estudiante_id
             ON CONFLICT ON CONSTRAINT promedio_notas_ciclo_pkey
-            DO UPDATE SET valor = $3
+            DO UPDATE SET acumulado = promedio_notas_ciclo.acumulado + EXCLUDED.acumulado,
+                          valor = ROUND(promedio_notas_ciclo.acumulado + EXCLUDED.acumulado, 2)
+            RETURNING ciclo_acad_id
         '''
+        records = await fetch(connection, statement, [r[0] for r in data], [r[1] for r in data], [r[2] for r in data])
+
+        return list({record['ciclo_acad_id'] for record in records})
+
+    @staticmethod
+    async def rebuild(dbi: PoolConnectionHolder, school_term: int = None):
+        statements = ('''
+            DELETE FROM promedio_notas_ciclo
+            WHERE $1::int IS NULL OR
+                  ciclo_acad_id = $1
+        ''', '''
+            INSERT INTO promedio_notas_ciclo (ciclo_acad_id, estudiante_id, acumulado, valor)
+            SELECT estructura_notas.ciclo_acad_id, nota_estudiante.estudiante_id,
+                   SUM(nota_estudiante.valor * nota.porcentaje / 100.0),
+                   ROUND(SUM(nota_estudiante.valor * nota.porcentaje / 100.0), 2)
+            FROM estructura_notas
+            INNER JOIN nota
+                    ON nota.id = estructura_notas.nota_id
+            INNER JOIN nota_estudiante
+                    ON nota_estudiante.nota_id = estructura_notas.nota_id
+            WHERE $1::int IS NULL OR
+                  estructura_notas.ciclo_acad_id = $1
+            GROUP BY estructura_notas.ciclo_acad_id, nota_estudiante.estudiante_id
+        ''')
+
         async with dbi.acquire() as connection:
-            await connection.execute(statement, student, school_term, await callback(student, school_term, dbi=dbi))
+            async with connection.transaction():
+                await execute(connection, statements[0], school_term)
+                status = await execute(connection, statements[1], school_term)
+
+        FinalGrade.invalidate(school_term)
+
+        return status
+
+    @staticmethod
+    def invalidate(*school_terms: int):
+        # Después de confirmar la transacción: reportes y proyectos aptos muestran los promedios
+        for school_term in school_terms:
+            fragments.invalidate('class_report', school_term)
+            fragments.invalidate('eligible_projects', school_term)
+
+        if None in school_terms:
+            eligible_projects.clear()
+        else:
+            invalidate_eligible_projects(*school_terms)
 
 
 class ClassGrades(View):
@@ -89,7 +132,7 @@ class ClassGrades(View):
                                    'Puedes seleccionar un ciclo académico previo en el selector superior.',
                         'school_terms': await self.get_school_terms(user)}
 
-        students = await self.fetch_students(school_term['id'])
+        students = await self.fetch_grade_matrix(school_term['id'])
 
         if not students:
             # No se encontraron estudiantes, por lo tanto informamos al usuario que no se encontraron estudiantes
@@ -130,21 +173,14 @@ class ClassGrades(View):
 
         students = map_users(students)
 
-        async def map_student(student: dict) -> dict:
-            grades = await self.fetch_grades(school_term['id'], student['id'])
-            grades = flatten(grades, {})
-            grades = list(map(lambda x: float(x['valor']) if x['valor'] is not None else '-', grades))
-            final_grade = await self.fetch_final_grade(school_term['id'], student['id'])
-
-            if final_grade is None:
-                final_grade = '-'
+        # Cada fila trae las notas del estudiante en el mismo orden que los encabezados, más su promedio final
+        for student in students:
+            grades = [float(grade) if grade is not None else '-' for grade in student.pop('notas') or []]
+            final_grade = student.pop('promedio')
 
-            grades.append(final_grade)
+            grades.append(final_grade if final_grade is not None else '-')
 
-            return {**student, 'grades': grades}
-
-        for _student_i, _student in enumerate(students):
-            students[_student_i] = await map_student(_student)
+            student['grades'] = grades
 
         return {'headers': headers,
                 'students': students,
@@ -163,70 +199,43 @@ class ClassGrades(View):
             ORDER BY nota.id ASC
         '''
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetch(school_term)
+            return await fetch(connection, query, school_term)
 
-    async def fetch_final_grade(self, school_term: int, student_id: int):
+    async def fetch_grade_matrix(self, school_term: int):
+        # Obtener los estudiantes de un ciclo académico junto a todas sus notas y su promedio final
         query = '''
-            SELECT valor
-            FROM promedio_notas_ciclo
-            WHERE ciclo_acad_id = $1 AND
-                  estudiante_id = $2
-            LIMIT 1
-        '''
-        async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetchval(school_term, student_id)
-
-    async def fetch_grades(self, school_term: int, student_id: int):
-        query = '''
-            SELECT nota_estudiante.valor
-            FROM estructura_notas
-            LEFT JOIN nota
-                   ON nota.id = estructura_notas.nota_id
-            LEFT JOIN nota_estudiante
-                   ON nota_estudiante.nota_id = estructura_notas.nota_id AND
-                      nota_estudiante.estudiante_id = $2
-            WHERE ciclo_acad_id = $1
-            ORDER BY nota.id ASC
-        '''
-        async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetch(school_term, student_id)
-
-    async def fetch_students(self, school_term: int):
-        # Obtener los estudiantes de un ciclo académico
-        query = '''
-            SELECT usuario.id, usuario.tipo_documento, usuario.nombres, usuario.apellidos, usuario.escuela
+            WITH notas AS (
+                SELECT matricula.estudiante_id,
+                       ARRAY_AGG(nota_estudiante.valor ORDER BY estructura_notas.nota_id ASC) as notas
+                FROM matricula
+                INNER JOIN estructura_notas
+                        ON estructura_notas.ciclo_acad_id = matricula.ciclo_acad_id
+                LEFT JOIN nota_estudiante
+                       ON nota_estudiante.nota_id = estructura_notas.nota_id AND
+                          nota_estudiante.estudiante_id = matricula.estudiante_id
+                WHERE matricula.ciclo_acad_id = $1
+                GROUP BY matricula.estudiante_id
+            )
+            SELECT usuario.id, usuario.tipo_documento, usuario.nombres, usuario.apellidos, usuario.escuela,
+                   notas.notas, promedio_notas_ciclo.valor as promedio
             FROM usuario
             INNER JOIN matricula
                     ON matricula.estudiante_id = usuario.id AND
                        matricula.ciclo_acad_id = $1
+            LEFT JOIN notas
+                   ON notas.estudiante_id = usuario.id
+            LEFT JOIN promedio_notas_ciclo
+                   ON promedio_notas_ciclo.estudiante_id = usuario.id AND
+                      promedio_notas_ciclo.ciclo_acad_id = $1
         '''
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetch(school_term)  # fetch = list
+            return await fetch(connection, query, school_term)  # fetch = list
 
     async def school_term_exists(self, school_term: int, school: int):
-        # Retornará verdadero si existe el ciclo académico
-        query = '''
-            SELECT true
-            FROM ciclo_academico
-            WHERE id = $1 AND
-                  escuela = $2
-            LIMIT 1
-        '''
-        async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetchval(school_term, school)  # fetchval = valor
+        return await calendar.get(self.request.app.db, school_term, school) is not None
 
     async def fetch_school_term(self, school: int):
-        # Retornará el ciclo académico en este preciso momento
-        query = '''
-            SELECT id, fecha_comienzo, fecha_fin
-            FROM ciclo_academico
-            WHERE $1 >= fecha_comienzo AND
-                  $1 <= fecha_fin AND
-                  escuela = $2
-            LIMIT 1
-        '''
-        async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetchrow(datetime.utcnow(), school)  # fetchrow = dict
+        return await calendar.current(self.request.app.db, school)
 
     async def get_school_terms(self, user: dict):
 
@@ -237,15 +246,7 @@ class ClassGrades(View):
         return list(_g(await self._get_school_terms(user['escuela'])))
 
     async def _get_school_terms(self, school: int):
-        query = '''
-            SELECT id, fecha_comienzo, fecha_fin
-            FROM ciclo_academico
-            WHERE ciclo_academico.escuela = $1
-            ORDER BY id DESC
-            LIMIT 10
-        '''
-        async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetch(school)
+        return await calendar.recent(self.request.app.db, school)
 
 
 class ReadGradeReport(View):
@@ -337,7 +338,7 @@ class ReadGradeReport(View):
                 LIMIT 1
             '''
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetchval(school_term, student_id)
+            return await fetchval(connection, query, school_term, student_id)
 
     async def fetch_grades(self, school_term: int, student_id: int):
         query = '''
@@ -355,7 +356,7 @@ class ReadGradeReport(View):
             ORDER BY nota.id ASC
         '''
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetch(school_term, student_id)
+            return await fetch(connection, query, school_term, student_id)
 
     async def fetch_student(self, student_id: int):
         query = '''
@@ -367,30 +368,13 @@ class ReadGradeReport(View):
             LIMIT 1
         '''
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetchrow(student_id)
+            return await fetchrow(connection, query, student_id)
 
     async def school_term_exists(self, school_term: int, school: int):
-        query = '''
-                SELECT true
-                FROM ciclo_academico
-                WHERE id = $1 AND
-                      escuela = $2
-                LIMIT 1
-            '''
-        async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetchval(school_term, school)
+        return await calendar.get(self.request.app.db, school_term, school) is not None
 
     async def fetch_school_term(self, school: int):
-        query = '''
-                SELECT id, fecha_comienzo, fecha_fin
-                FROM ciclo_academico
-                WHERE $1 >= fecha_comienzo AND
-                      $1 <= fecha_fin AND
-                      escuela = $2
-                LIMIT 1
-            '''
-        async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetchrow(datetime.utcnow(), school)
+        return await calendar.current(self.request.app.db, school)
 
 
 class AssignGrade(View):
@@ -434,9 +418,7 @@ class AssignGrade(View):
                 return json_response({'error': 'Esta nota ya ha sido asignada, no se puede cambiar'}, status=400)
 
             await self.create(grade_id, student_id, Decimal(data['score']))
-
-            await FinalGrade.update(student_id, school_term['id'], dbi=self.request.app.db,
-                                    callback=FinalGrade.fetch_final_grade)  # Actualizar promedio final
+            FinalGrade.invalidate(school_term['id'])
 
         return json_response({'success': 'Se ha registrado la nota exitosamente'})
 
@@ -451,10 +433,11 @@ class AssignGrade(View):
         query = '''
             INSERT INTO nota_estudiante (nota_id, estudiante_id, valor)
             VALUES ($1, $2, $3)
-            RETURNING true
         '''
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetchval(grade_id, student_id, score)
+            async with connection.transaction():
+                await execute(connection, query, grade_id, student_id, score)
+                await FinalGrade.update([[student_id, grade_id, score]], connection)  # Actualizar promedio final
 
     async def _assigned(self, grade_id: int, student_id: int):
         query = '''
@@ -465,7 +448,7 @@ class AssignGrade(View):
             LIMIT 1
         '''
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetchval(grade_id, student_id) or False
+            return await fetchval(connection, query, grade_id, student_id) or False
 
     async def _get_grade(self, school_term: int, grade_id: int):
         query = '''
@@ -476,7 +459,7 @@ class AssignGrade(View):
             LIMIT 1
         '''
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetchval(school_term, grade_id)
+            return await fetchval(connection, query, school_term, grade_id)
 
     async def _get_student(self, school_term: int, value: int) -> int:
         query = '''
@@ -488,19 +471,10 @@ class AssignGrade(View):
                   usuario.id = $2
         '''
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetchval(school_term, value)
+            return await fetchval(connection, query, school_term, value)
 
     async def fetch_school_term(self, school: int):
-        query = '''
-                SELECT id, fecha_comienzo, fecha_fin
-                FROM ciclo_academico
-                WHERE $1 >= fecha_comienzo AND
-                      $1 <= fecha_fin AND
-                      escuela = $2
-                LIMIT 1
-            '''
-        async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetchrow(datetime.utcnow(), school)
+        return await calendar.current(self.request.app.db, school)
 
     @staticmethod
     async def _validate_score(name: str, value: str, *args):
@@ -542,9 +516,7 @@ class UpdateGrade(View):
             return json_response({'message': errors}, status=400)
 
         await self.update(grade_id, student_id, Decimal(data['score']))
-
-        await FinalGrade.update(student_id, grade['ciclo_acad_id'], dbi=self.request.app.db,
-                                callback=FinalGrade.fetch_final_grade)  # Actualizar promedio final
+        FinalGrade.invalidate(grade['ciclo_acad_id'])
 
         return json_response({'message': 'Se actualizó la nota exitosamente'})
 
@@ -555,14 +527,28 @@ class UpdateGrade(View):
         ], self.request.app.db)
 
     async def update(self, grade: int, student: int, score: Decimal):
-        query = '''
+        queries = ('''
+            SELECT valor
+            FROM nota_estudiante
+            WHERE nota_id = $1 AND
+                  estudiante_id = $2
+            FOR UPDATE
+        ''', '''
             UPDATE nota_estudiante
             SET valor = $3
             WHERE nota_id = $1 AND
                   estudiante_id = $2
-        '''
+        ''')
         async with self.request.app.db.acquire() as connection:
-            return await connection.execute(query, grade, student, score)
+            async with connection.transaction():
+                # La nota anterior se lee bloqueada, así dos correcciones a la vez no suman la misma diferencia
+                previous = await fetchval(connection, queries[0], grade, student)
+
+                if previous is None:
+                    return
+
+                await execute(connection, queries[1], grade, student, score)
+                await FinalGrade.update([[student, grade, score - previous]], connection)  # Actualizar promedio final
 
     async def fetch_grade(self, grade: int, student: int):
         query = '''
@@ -581,19 +567,10 @@ class UpdateGrade(View):
             LIMIT 1;
         '''
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetchrow(grade, student)
+            return await fetchrow(connection, query, grade, student)
 
     async def fetch_current_school_term(self, school: int):
-        query = '''
-            SELECT id, fecha_comienzo, fecha_fin
-            FROM ciclo_academico
-                WHERE $1 >= fecha_comienzo AND
-                      $1 <= fecha_fin AND
-                      escuela = $2
-                LIMIT 1
-        '''
-        async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetchrow(datetime.utcnow(), school)
+        return await calendar.current(self.request.app.db, school)
 
     @staticmethod
     async def _validate_score(name: str, value: str, *args):
@@ -603,6 +580,206 @@ class UpdateGrade(View):
             return '{} debe de estar en el rango de 0 a 20'.format(name)
 
 
+class BulkAssignGrades(View):
+    """
+        Registro de notas de toda la clase en un solo request, para el ciclo académico actual. Acepta la grilla
+        estudiante x nota como:
+        - formulario: campos score-<estudiante_id>-<nota_id>
+        - JSON: {"<estudiante_id>": {"<nota_id>": puntaje, ...}, ...}
+        - CSV (text/csv): cabecera student_id,<nota_id>,<nota_id>... y una fila por estudiante
+        Las celdas vacías se ignoran y las notas ya registradas se corrigen. Si alguna celda no es válida, no se
+        registra ninguna.
+    """
+    max_cells = 5000
+    max_id = 2 ** 31 - 1
+    id_format = re.compile(r'[1-9][0-9]{0,9}')
+    form_key = re.compile(r'^score-([0-9]+)-([0-9]+)$')
+
+    @pass_user
+    @permission_required('asignar_notas')
+    async def post(self, user: dict):
+        school_term = await calendar.current(self.request.app.db, user['escuela'])
+
+        if not school_term:
+            return json_response({'error': 'No se encontro un ciclo academico para esta fecha'}, status=400)
+
+        if not school_term['fecha_comienzo'] <= datetime.utcnow() < school_term['fecha_fin']:
+            return json_response({'error': 'No se pueden registrar notas fuera de las fechas del ciclo académico'},
+                                 status=400)
+
+        try:
+            cells = await self.read_cells()
+        except ValueError:
+            return json_response({'error': 'No se pudo leer la grilla de notas'}, status=400)
+
+        if not cells:
+            return json_response({'error': 'No se envió ninguna nota'}, status=400)
+
+        if len(cells) > self.max_cells:
+            return json_response({'error': 'No se pueden registrar más de {} notas a la vez'.format(self.max_cells)},
+                                 status=400)
+
+        records, errors = self.parse_cells(cells)
+
+        if not errors:
+            errors = await self.validate(school_term['id'], records)
+
+        if errors:
+            return json_response({'error': errors}, status=400)
+
+        created, updated = await self.save(records)
+        FinalGrade.invalidate(school_term['id'])
+
+        return json_response({'success': 'Se han registrado las notas exitosamente',
+                              'created': created,
+                              'updated': updated})
+
+    async def read_cells(self) -> list:
+        # [(estudiante_id, nota_id, puntaje), ...] tal como llegaron, sin las celdas vacías
+        if self.request.content_type == 'application/json':
+            data = await self.request.json()
+
+            if not isinstance(data, dict) or not all(isinstance(v, dict) for v in data.values()):
+                raise ValueError
+
+            cells = [(s, g, v) for s, row in data.items() for g, v in row.items()]
+        elif self.request.content_type == 'text/csv':
+            rows = csv.reader(io.StringIO(await self.request.text()))
+            header = next(rows, None)
+
+            if not header or header[0].strip() != 'student_id':
+                raise ValueError
+
+            cells = [(row[0], g, v) for row in rows if row for g, v in zip(header[1:], row[1:])]
+        else:
+            data = await self.request.post()
+            cells = list()
+
+            for key, value in data.items():
+                match = self.form_key.match(key)
+
+                if match:
+                    cells.append((match.group(1), match.group(2), value))
+
+        return [(str(s).strip(), str(g).strip(), str(v).strip()) for s, g, v in cells
+                if v is not None and str(v).strip() != '']
+
+    @classmethod
+    def parse_cells(cls, cells: list) -> tuple:
+        records = dict()
+        errors = list()
+
+        for student, grade, score in cells:
+            name = 'Estudiante {}, nota {}'.format(student, grade)
+
+            # Mismo formato que los ids en las rutas, y dentro del rango de integer
+            if not (cls.id_format.fullmatch(student) and cls.id_format.fullmatch(grade)) or \
+                    int(student) > cls.max_id or int(grade) > cls.max_id:
+                errors.append('{}: el estudiante y la nota deben ser números'.format(name))
+                continue
+
+            try:
+                value = Decimal(score)
+            except ArithmeticError:
+                errors.append('{} debe de ser un número'.format(name))
+                continue
+
+            # nota_estudiante.valor es numeric(4, 2)
+            if not value.is_finite() or not 0 <= value <= 20 or value != value.quantize(Decimal('0.01')):
+                errors.append('{} debe de estar en el rango de 0 a 20, con hasta 2 decimales'.format(name))
+                continue
+
+            key = (int(student), int(grade))
+
+            if key in records:
+                errors.append('{} se envió más de una vez'.format(name))
+                continue
+
+            records[key] = value
+
+        return [(s, g, v) for (s, g), v in records.items()], errors
+
+    async def validate(self, school_term: int, records: list) -> list:
+        queries = ('''
+            SELECT estudiante_id
+            FROM matricula
+            WHERE ciclo_acad_id = $1 AND
+                  estudiante_id = ANY($2::bigint[])
+        ''', '''
+            SELECT nota_id
+            FROM estructura_notas
+            WHERE ciclo_acad_id = $1 AND
+                  nota_id = ANY($2::int[])
+        ''')
+        students = {r[0] for r in records}
+        grades = {r[1] for r in records}
+
+        async with self.request.app.db.acquire() as connection:
+            students -= {r['estudiante_id'] for r in await fetch(connection, queries[0], school_term, list(students))}
+            grades -= {r['nota_id'] for r in await fetch(connection, queries[1], school_term, list(grades))}
+
+        return ['No se encontro al estudiante {}'.format(s) for s in sorted(students)] + \
+               ['No se encontro la nota {}'.format(g) for g in sorted(grades)]
+
+    async def save(self, records: list) -> tuple:
+        # La tabla temporal se crea una vez por conexión y se vacía al terminar cada transacción; si se eliminara en
+        # cada request, las sentencias preparadas que la usan quedarían invalidadas en las siguientes
+        queries = ('''
+            CREATE TEMPORARY TABLE IF NOT EXISTS carga_notas (
+                estudiante_id bigint NOT NULL,
+                nota_id int NOT NULL,
+                valor numeric(4, 2) NOT NULL
+            ) ON COMMIT DELETE ROWS
+        ''', '''
+            SELECT nota_estudiante.valor
+            FROM nota_estudiante
+            INNER JOIN carga_notas
+                    ON carga_notas.nota_id = nota_estudiante.nota_id AND
+                       carga_notas.estudiante_id = nota_estudiante.estudiante_id
+            FOR UPDATE OF nota_estudiante
+        ''', '''
+            WITH anterior AS (
+                SELECT nota_estudiante.nota_id, nota_estudiante.estudiante_id, nota_estudiante.valor
+                FROM nota_estudiante
+                INNER JOIN carga_notas
+                        ON carga_notas.nota_id = nota_estudiante.nota_id AND
+                           carga_notas.estudiante_id = nota_estudiante.estudiante_id
+            ), escritas AS (
+                INSERT INTO nota_estudiante (nota_id, estudiante_id, valor)
+                SELECT nota_id, estudiante_id, valor
+                FROM carga_notas
+                ON CONFLICT ON CONSTRAINT nota_estudiante_pkey
+                DO UPDATE SET valor = EXCLUDED.valor
+                WHERE nota_estudiante.valor <> EXCLUDED.valor
+                RETURNING nota_id, estudiante_id, valor
+            )
+            SELECT escritas.estudiante_id, escritas.nota_id,
+                   escritas.valor - COALESCE(anterior.valor, 0.0) as diferencia, anterior.valor IS NULL as nueva
+            FROM escritas
+            LEFT JOIN anterior
+                   ON anterior.nota_id = escritas.nota_id AND
+                      anterior.estudiante_id = escritas.estudiante_id
+        ''')
+        async with self.request.app.db.acquire() as connection:
+            async with connection.transaction():
+                await execute(connection, queries[0])
+                await copy_records(connection, 'carga_notas', ('estudiante_id', 'nota_id', 'valor'), records)
+
+                # Las notas que ya existen se bloquean antes de leer su valor anterior, así una corrección a la vez
+                # no se descuenta dos veces del promedio
+                await execute(connection, queries[1])
+                changes = await fetch(connection, queries[2])
+
+                if changes:
+                    # Un solo UPSERT para los promedios de todos los estudiantes afectados
+                    await FinalGrade.update([[c['estudiante_id'], c['nota_id'], c['diferencia']] for c in changes],
+                                            connection)
+
+        created = sum(1 for c in changes if c['nueva'])
+
+        return created, len(changes) - created
+
+
 class EligibleProjects(View):
     @view('projects.eligible_projects')
     @permission_required('gestionar_proyectos')
@@ -612,47 +789,15 @@ class EligibleProjects(View):
         if not school_term:
             return {'error': 'No hay un ciclo académico registrado'}
 
-        projects = flatten(await self.fetch_projects(school_term['id']), {})
-
-        for i, project in enumerate(projects):
-            projects[i]['members'] = flatten(await self.fetch_members(project['id'], school_term['id']), {})
-
-        return {'projects': projects}
-
-    async def fetch_members(self, project: int, school_term: int):
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare('''
-                SELECT COALESCE(promedio_notas_ciclo.valor, 0.0) as promedio,
-                       usuario.nombres, usuario.apellidos
-                FROM integrante_proyecto
-                LEFT JOIN usuario
-                       ON usuario.id = integrante_proyecto.usuario_id
-                LEFT JOIN promedio_notas_ciclo
-                       ON promedio_notas_ciclo.estudiante_id = integrante_proyecto.usuario_id AND
-                          promedio_notas_ciclo.ciclo_acad_id = $2
-                WHERE integrante_proyecto.proyecto_id = $1 AND
-                      integrante_proyecto.aceptado = TRUE
-            ''')).fetch(project, school_term)
-
-    async def fetch_projects(self, school_term: int):
-        async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare('''
-                SELECT *
-                FROM proyecto
-                WHERE ciclo_acad_id = $1
-            ''')).fetch(school_term)
+            projects = await fetch_eligible_projects(connection, school_term['id'])
+
+        return {'projects': projects,
+                'passing_grade': PASSING_GRADE,
+                'school_term_id': school_term['id']}
 
     async def fetch_current_school_term(self, school: int):
-        query = '''
-            SELECT id, fecha_comienzo, fecha_fin
-            FROM ciclo_academico
-                WHERE $1 >= fecha_comienzo AND
-                      $1 <= fecha_fin AND
-                      escuela = $2
-                LIMIT 1
-        '''
-        async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetchrow(datetime.utcnow(), school)
+        return await calendar.current(self.request.app.db, school)
 
 
 class GetAssignedGrades(View):
@@ -668,27 +813,24 @@ class GetAssignedGrades(View):
         return json_response({'grades': grades})
 
     async def get_grades(self, school: int, student: int):
+        school_term = await calendar.current(self.request.app.db, school)
+
+        if school_term is None:
+            return []
+
         query = '''
-            WITH ciclo_academico AS (
-                SELECT id
-                FROM ciclo_academico
-                WHERE ciclo_academico.escuela = $1 AND
-                      ciclo_academico.fecha_comienzo <= $2 AND
-                      ciclo_academico.fecha_fin >= $2
-                LIMIT 1
-            )
             SELECT estructura_notas.nota_id as id, nota.descripcion as descripcion
             FROM estructura_notas
             LEFT JOIN nota
                    ON nota.id = estructura_notas.nota_id
             RIGHT JOIN nota_estudiante
                     ON nota_estudiante.nota_id = estructura_notas.nota_id
-            WHERE estructura_notas.ciclo_acad_id = (SELECT id FROM ciclo_academico) AND
-                  nota_estudiante.estudiante_id = $3
+            WHERE estructura_notas.ciclo_acad_id = $1 AND
+                  nota_estudiante.estudiante_id = $2
             ORDER BY estructura_notas.nota_id ASC
         '''
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetch(school, datetime.utcnow(), student)
+            return await fetch(connection, query, school_term['id'], student)
 
 
 routes = {
@@ -700,6 +842,7 @@ routes = {
             'school-term-{school_term:[1-9][0-9]*}/{student_id:[1-9][0-9]*}': ReadGradeReport
         },
         'assign': AssignGrade,
+        'assign-bulk': BulkAssignGrades,
         'update/{grade_id:[1-9][0-9]*}/student-{student_id:[1-9][0-9]*}': UpdateGrade,
         'assigned-grades/{student:[1-9][0-9]*}': GetAssignedGrades
     },
@@ -1,20 +1,40 @@
+import json
 from html import escape
 from typing import Generator
 from datetime import datetime, timedelta
 from asyncpg.pool import PoolConnectionHolder
-from aiohttp.web import View, HTTPNotFound, json_response, StreamResponse, HTTPUnauthorized, HTTPFound
+from aiohttp.web import View, HTTPNotFound, json_response, HTTPUnauthorized, HTTPFound
 
 
+from utils.queries import fetch, fetchrow, fetchval, execute
 from utils.validator import validator
+from utils.storage import send_file
+from utils.upload import Upload, UploadTooLarge, UnsupportedType, receive
+from utils.auth import invalidate_auth_data
+from utils.school_terms import calendar
+from utils.bulk import insert_many
+from utils.fragments import fragments
+from utils.eligibility import eligible_projects, invalidate_eligible_projects
 from utils.map import data_map, parse_data_key
 from utils.helpers import view, permission_required, flatten, school_term_to_str, pass_user, check_form_data,\
-    get_chunks, humanize_datetime
+    humanize_datetime
 
 
 _datetime = '%m/%d/%Y %I:%M %p'
 _special_datetime = '%H:%M horas del día {} %d de {} de %Y'
 
 
+def invalidate_project_fragments(school_term: int = None):
+    # Listado de proyectos y proyectos aptos; sin ciclo académico se invalidan los de todos los ciclos
+    fragments.invalidate('projects_list', school_term)
+    fragments.invalidate('eligible_projects', school_term)
+
+    if school_term is None:
+        eligible_projects.clear()
+    else:
+        invalidate_eligible_projects(school_term)
+
+
 class Project(View):
     async def check_permissions(self, user: dict):
         if user['permissions']['crear_proyecto'] and self.request.match_info['project'] != 'my-project':
@@ -121,7 +141,7 @@ class Project(View):
             WHERE presentacion_id = $1
         '''
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetch(project)
+            return await fetch(connection, query, project)
 
     async def fetch_decision_panel(self, school: int):
         query = '''
@@ -134,7 +154,7 @@ class Project(View):
                   usuario.escuela = $1
         '''
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetch(school)
+            return await fetch(connection, query, school)
 
     async def fetch_reviewers(self, school: int):
         query = '''
@@ -147,7 +167,7 @@ class Project(View):
                   rol_usuario.revisar_proyectos = true
         '''
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetch(school)
+            return await fetch(connection, query, school)
 
     async def fetch_pending_reviews(self, user: int, school: int):
         query = '''
@@ -163,15 +183,16 @@ class Project(View):
             LEFT JOIN proyecto
                    ON proyecto.id = observacion_proyecto.proyecto_id
             WHERE observacion_proyecto.usuario_id = $1 AND
-                  proyecto.ciclo_acad_id = (SELECT id FROM ciclo_academico
-                                            WHERE ciclo_academico.fecha_comienzo <= $2 AND
-                                                  ciclo_academico.fecha_fin >= $2 AND
-                                                  ciclo_academico.escuela = $3
-                                            LIMIT 1) AND
+                  proyecto.ciclo_acad_id = $2 AND
                   observacion_proyecto.finalizado = false
         '''
+        school_term = await calendar.current(self.request.app.db, school)
+
+        if not school_term:
+            return []
+
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetch(user, datetime.utcnow(), school)
+            return await fetch(connection, query, user, school_term['id'])
 
     async def fetch_project_reviews(self, project: int):
         query = '''
@@ -185,7 +206,7 @@ class Project(View):
             ORDER BY observacion_proyecto.id DESC
         '''
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetch(project)
+            return await fetch(connection, query, project)
 
     async def fetch_review_by_id(self, project: int, review: int):
         query = '''
@@ -204,41 +225,16 @@ class Project(View):
             LIMIT 1
         '''
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetchrow(project, review)
+            return await fetchrow(connection, query, project, review)
 
     async def fetch_current_school_term(self, school: int):
-        query = '''
-            SELECT *
-            FROM ciclo_academico
-            WHERE $1 >= fecha_comienzo AND
-                  $1 <= fecha_fin AND
-                  escuela = $2
-            LIMIT 1
-        '''
-        async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetchrow(datetime.utcnow(), school)
+        return await calendar.current(self.request.app.db, school)
 
     async def school_term(self, st_id: int, school: int):
-        query = '''
-            SELECT *
-            FROM ciclo_academico
-            WHERE id = $1 AND
-                  escuela = $2
-            LIMIT 1
-        '''
-        async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetchrow(st_id, school)
+        return await calendar.get(self.request.app.db, st_id, school)
 
     async def fetch_school_term(self, st_id: int, school: int):
-        query = '''
-            SELECT *
-            FROM ciclo_academico
-            WHERE id = $1 AND
-                  escuela = $2
-            LIMIT 1
-        '''
-        async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetchrow(st_id, school)
+        return await calendar.get(self.request.app.db, st_id, school)
 
     async def fetch_project(self, student: int, school_term: int):
         query = '''
@@ -252,7 +248,7 @@ class Project(View):
             LIMIT 1
         '''
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetchrow(school_term, student)
+            return await fetchrow(connection, query, school_term, student)
 
     async def fetch_project_by_id(self, project: int, school: int):
         query = '''
@@ -267,7 +263,7 @@ class Project(View):
         '''
 
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetchrow(project, school)
+            return await fetchrow(connection, query, project, school)
 
     async def fetch_fellas(self, school_term: int):
         query = '''
@@ -284,7 +280,7 @@ class Project(View):
                  (integrante_proyecto.aceptado = false OR integrante_proyecto.aceptado IS NULL)
         '''
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetch(school_term)
+            return await fetch(connection, query, school_term)
 
     async def fetch_members(self, project: int):
         query = '''
@@ -297,7 +293,7 @@ class Project(View):
                   integrante_proyecto.aceptado = true
         '''
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetch(project)
+            return await fetch(connection, query, project)
 
     async def fetch_review(self, project: int, author: int, review: int,
                            is_published: bool = True, is_empty: bool = True):
@@ -317,7 +313,7 @@ class Project(View):
         '''.format(_is_empty_q)
 
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetchrow(project, author, review, is_published)
+            return await fetchrow(connection, query, project, author, review, is_published)
 
     async def fetch_invites(self, user: int, school_term: int):
         query = '''
@@ -339,7 +335,7 @@ class Project(View):
                   integrante_proyecto.aceptado = FALSE
         '''
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetch(user, school_term)
+            return await fetch(connection, query, user, school_term)
 
     async def fetch_invite(self, project: int, student: int):
         query = '''
@@ -350,7 +346,7 @@ class Project(View):
             LIMIT 1
         '''
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetchrow(project, student)
+            return await fetchrow(connection, query, project, student)
 
 
 class ProjectsList(View):
@@ -366,40 +362,28 @@ class ProjectsList(View):
             return {'error': 'No se encontró un ciclo académico',
                     'now': humanize_datetime(datetime.utcnow() - timedelta(hours=5), with_time=False)}
 
-        projects = await self.fetch_projects(school_term)
-        students_counter = [0]
-
-        async def enrichen_project(project_: dict, counter: list):
-            _project = flatten(project_, {})
+        projects = list()
+        students_counter = 0
 
-            _project['members'] = flatten(await self.fetch_members(_project['id']), {})
-            _project['reviewed'] = await self.fetch_reviews_count(_project['id'])
-            _project['decision_panel'] = flatten(await self.fetch_decision_panel(_project['id']), {})
+        for project in await self.fetch_projects(school_term):
+            project = dict(project)
+            project['members'] = json.loads(project['members'])
+            project['decision_panel'] = json.loads(project['decision_panel'])
 
-            presentation_date = await self.fetch_presentation_date(_project['id'])
-            if presentation_date:
-                _project['presentation_date'] = humanize_datetime(presentation_date)
-                _project['pdate_no_time'] = humanize_datetime(presentation_date, with_time=False)
+            if project['presentation_date']:
+                project['pdate_no_time'] = humanize_datetime(project['presentation_date'], with_time=False)
+                project['presentation_date'] = humanize_datetime(project['presentation_date'])
             else:
-                _project['presentation_date'] = None
-                _project['pdate_no_time'] = None
-
-            counter[0] += len(_project['members'])
-
-            return _project
+                project['pdate_no_time'] = None
 
-        _projects = []
+            students_counter += len(project['members'])
+            projects.append(project)
 
-        for project in projects:
-            _projects.append(await enrichen_project(project, students_counter))
-
-        del projects
-
-        return {'projects': _projects,
+        return {'projects': projects,
                 'school_terms': await self.get_school_terms(user),
                 'current_school_term_id': school_term,
                 'now': humanize_datetime(datetime.utcnow() - timedelta(hours=5), with_time=False),
-                'students_counter': students_counter[0]}
+                'students_counter': students_counter}
 
     async def get_school_terms(self, user: dict):
 
@@ -410,87 +394,56 @@ class ProjectsList(View):
         return list(_g(await self._get_school_terms(user['escuela'])))
 
     async def _get_school_terms(self, school: int):
-        query = '''
-            SELECT id, fecha_comienzo, fecha_fin
-            FROM ciclo_academico
-            WHERE ciclo_academico.escuela = $1
-            ORDER BY id DESC
-            LIMIT 10
-        '''
-        async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetch(school)
-
-    async def fetch_members(self, project: int):
-        query = '''
-            SELECT usuario_id, nombres, apellidos
-            FROM integrante_proyecto
-            LEFT JOIN usuario
-                   ON usuario.id = integrante_proyecto.usuario_id
-            WHERE integrante_proyecto.proyecto_id = $1 AND
-                  integrante_proyecto.aceptado = true
-        '''
-        async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetch(project)
-
-    async def fetch_reviews_count(self, project: int):
-        query = '''
-            SELECT COUNT(true) 
-            FROM observacion_proyecto 
-            WHERE proyecto_id = $1
-        '''
-        async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetchval(project)
-
-    async def fetch_decision_panel(self, project: int):
-        query = '''
-            SELECT jurado_id, nombres, apellidos
-            FROM jurado_presentacion
-            LEFT JOIN usuario
-                   ON usuario.id = jurado_presentacion.jurado_id
-            WHERE presentacion_id = $1
-        '''
-        async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetch(project)
-
-    async def fetch_presentation_date(self, project: int):
-        query = '''
-            SELECT fecha 
-            FROM presentacion_proyecto 
-            WHERE proyecto_id = $1
-        '''
-        async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetchval(project)
+        return await calendar.recent(self.request.app.db, school)
 
     async def fetch_school_term(self, school: int, school_term: int = None):
         if school_term is None:
-            query = '''
-                    SELECT id
-                    FROM ciclo_academico
-                    WHERE $1 >= fecha_comienzo AND
-                          $1 <= fecha_fin AND
-                          escuela = $2
-                    LIMIT 1
-            '''
+            school_term = await calendar.current(self.request.app.db, school)
         else:
-            query = '''
-                SELECT id
-                FROM ciclo_academico
-                WHERE id = $1 AND
-                      escuela = $2
-                LIMIT 1
-            '''
+            school_term = await calendar.get(self.request.app.db, school_term, school)
 
-        async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetchval(school_term or datetime.utcnow(), school)
+        return school_term['id'] if school_term else None
 
     async def fetch_projects(self, school_term: int):
+        # Integrantes, cantidad de observaciones, jurado y fecha de sustentación de todos los proyectos del ciclo
         query = '''
-            SELECT id, titulo, ciclo_acad_id
+            SELECT proyecto.id, proyecto.titulo, proyecto.ciclo_acad_id,
+                   COALESCE(integrantes.lista, '[]') as members,
+                   COALESCE(observaciones.total, 0) as reviewed,
+                   COALESCE(jurado.lista, '[]') as decision_panel,
+                   presentacion_proyecto.fecha as presentation_date
             FROM proyecto
-            WHERE ciclo_acad_id = $1            
+            LEFT JOIN LATERAL (
+                SELECT json_agg(json_build_object('usuario_id', integrante_proyecto.usuario_id,
+                                                  'nombres', usuario.nombres,
+                                                  'apellidos', usuario.apellidos)) as lista
+                FROM integrante_proyecto
+                LEFT JOIN usuario
+                       ON usuario.id = integrante_proyecto.usuario_id
+                WHERE integrante_proyecto.proyecto_id = proyecto.id AND
+                      integrante_proyecto.aceptado = true
+            ) as integrantes ON true
+            LEFT JOIN LATERAL (
+                SELECT COUNT(true) as total
+                FROM observacion_proyecto
+                WHERE observacion_proyecto.proyecto_id = proyecto.id
+            ) as observaciones ON true
+            LEFT JOIN LATERAL (
+                SELECT json_agg(json_build_object('jurado_id', jurado_presentacion.jurado_id,
+                                                  'nombres', usuario.nombres,
+                                                  'apellidos', usuario.apellidos)) as lista
+                FROM jurado_presentacion
+                LEFT JOIN usuario
+                       ON usuario.id = jurado_presentacion.jurado_id
+                WHERE jurado_presentacion.presentacion_id = proyecto.id
+            ) as jurado ON true
+            LEFT JOIN presentacion_proyecto
+                   ON presentacion_proyecto.proyecto_id = proyecto.id
+            WHERE proyecto.ciclo_acad_id = $1
+            ORDER BY proyecto.id ASC
         '''
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetch(school_term)
+            return await fetch(connection, query, school_term)
 
 
 class CreateProject(Project):
@@ -564,7 +517,13 @@ class CreateProject(Project):
         '''.format(with_partner)
 
         async with self.request.app.db.acquire() as connection:
-            return await connection.execute(query, *query_params)
+            status = await execute(connection, query, *query_params)
+
+        # has_project del autor e invitaciones del compañero
+        invalidate_auth_data(user, *query_params[6:])
+        invalidate_project_fragments(school_term)
+
+        return status
 
     async def validate(self, data: dict, students: list):
         validation_groups = [
@@ -645,6 +604,8 @@ class SingleReview(Project):
 
         await self.update(review['id'], body)
 
+        invalidate_auth_data(user['id'])
+
         del body
 
         return json_response({'message': 'Se registró la observación de tesis exitosamente'})
@@ -656,7 +617,7 @@ class SingleReview(Project):
 
     async def update(self, review: int, body: str):
         async with self.request.app.db.acquire() as connection:
-            return await connection.execute('''
+            return await execute(connection, '''
                     UPDATE observacion_proyecto
                     SET contenido = $2,
                         finalizado = true
@@ -731,7 +692,7 @@ class EditProjectSettings(Project):
 
     async def update(self, data: dict, project: int):
         async with self.request.app.db.acquire() as connection:
-            return await connection.execute('''
+            status = await execute(connection, '''
                 UPDATE proyecto
                 SET titulo = $1,
                     linea_investigacion = $2,
@@ -739,18 +700,22 @@ class EditProjectSettings(Project):
                 WHERE id = $4
             ''', data['title'], data['line_of_research'], data['description'], project)
 
+        invalidate_project_fragments()
+
+        return status
+
     @staticmethod
     async def _validate_title(name: str, value: str, pos: int, elems: list, dbi: PoolConnectionHolder, project: int,
                               school_term: int):
         async with dbi.acquire() as connection:
-            in_use = await (await connection.prepare('''
+            in_use = await fetchval(connection, '''
                 SELECT true
                 FROM proyecto
                 WHERE proyecto.titulo = $1 AND
                       proyecto.id != $2 AND
                       proyecto.ciclo_acad_id = $3
                 LIMIT 1
-            ''')).fetchval(value, project, school_term) or False
+            ''', value, project, school_term) or False
 
         if in_use:
             return '{} `{}` ya se encuentra en uso'.format(name, value)
@@ -798,7 +763,7 @@ class ProjectFiles(Project):
             ORDER BY archivo.fecha_subido DESC
         '''
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetch(project)
+            return await fetch(connection, query, project)
 
 
 class UploadFile(Project):
@@ -842,59 +807,32 @@ class UploadFile(Project):
             display_data.update({'error': 'No se recibieron los parámetros necesarios.'})
             return display_data
 
-        if file.headers['Content-Type'] not in data_map['files'].values():
+        try:
+            upload = await receive(file, 7 * 1024 * 1024, data_map['files'].values())
+        except UnsupportedType:
             display_data.update({'error': 'El archivo debe de ser un PDF o Windows Office Doc.'})
             return display_data
-
-        file_size = 0
-        _file = None
-        size_error = False
-
-        while True:
-            chunk = await file.read_chunk()
-
-            if not chunk:
-                break
-
-            if _file is None:
-                _file = chunk
-            else:
-                _file = _file + chunk
-
-            file_size += len(chunk)
-
-            if file_size > 7 * 1024 * 1024:
-                size_error = True
-                break
-
-        if size_error:
-            del _file, file_size
+        except UploadTooLarge:
             display_data.update({'error': 'El archivo no puede pesar más de 7MiB'})
             return display_data
 
-        description = await reader.next()
+        with upload:
+            description = await reader.next()
 
-        if description is None:
-            del _file, file_size, size_error
-            display_data.update({'error': 'No se recibieron los parámetros necesarios.'})
-            return display_data
-
-        description = await description.text()
-        desc_error = await self.validate_description(description)
+            if description is None:
+                display_data.update({'error': 'No se recibieron los parámetros necesarios.'})
+                return display_data
 
-        if desc_error:
-            del _file, file_size, size_error
-            display_data.update({'error': desc_error[0]})
-            return display_data
+            description = await description.text()
+            desc_error = await self.validate_description(description)
 
-        file_details = file.filename.rsplit('.', 1)
+            if desc_error:
+                display_data.update({'error': desc_error[0]})
+                return display_data
 
-        if _file is not None:
-            _file = bytearray(_file)
-        else:
-            _file = bytearray()
+            file_details = file.filename.rsplit('.', 1)
 
-        await self.create(file_details, _file, project['id'], user['id'], now, description)
+            await self.create(file_details, upload, project['id'], user['id'], now, description)
 
         display_data.update({'success': 'Se ha subido el archivo {} exitosamente.'.format(file.filename)})
         return display_data
@@ -905,20 +843,22 @@ class UploadFile(Project):
             ['Descripción', description, 'len:16,256']
         ])
 
-    async def create(self, file_details: list, file_content: bytearray, project: int, uploaded_by: int,
+    async def create(self, file_details: list, upload: Upload, project: int, uploaded_by: int,
                      upload_date: datetime, description: str):
         statement = '''
             WITH archivo AS (
-                INSERT INTO archivo (nombre, ext, contenido, fecha_subido)
-                VALUES ($1, $2, $3, $6)
+                INSERT INTO archivo (nombre, ext, hash, tamano, fecha_subido)
+                VALUES ($1, $2, $3, $4, $7)
                 RETURNING id
             )
             INSERT INTO archivo_proyecto (archivo_id, proyecto_id, subido_por, descripcion)
-            VALUES ((SELECT id FROM archivo), $4, $5, $7)
+            VALUES ((SELECT id FROM archivo), $5, $6, $8)
         '''
+        digest = await self.request.app.blobs.put_upload(upload)
+
         async with self.request.app.db.acquire() as connection:
-            return await connection.execute(statement, *file_details, file_content, project, uploaded_by, upload_date,
-                                            description)
+            return await execute(connection, statement, *file_details, digest, upload.size, project, uploaded_by,
+                                 upload_date, description)
 
 
 class DownloadFile(Project):
@@ -932,33 +872,13 @@ class DownloadFile(Project):
         if not file:
             raise HTTPNotFound
 
-        headers = {
-            'Content-Type': parse_data_key(file['ext'], 'files'),
-            'Content-Disposition': 'attachment; filename={file}'.format(file=file['nombre'])
-        }
-
-        response = StreamResponse(status=200, reason='OK', headers=headers)
-
-        chunks = tuple(get_chunks(file['contenido']))
-
-        await response.prepare(self.request)
-
-        for i in range(0, len(chunks)):
-            try:
-                response.write(chunks[i])
-
-                await response.drain()
-            except Exception as e:
-                print(repr(e))
-
-        del file, chunks
-
-        return response
+        return await send_file(self.request, file)
 
     async def fetch_file(self, project: int, file: int):
         query = '''
             SELECT CONCAT(archivo.nombre, '.', archivo.ext) as nombre,
-                   archivo.contenido, archivo.ext
+                   archivo.hash, archivo.ext, archivo.fecha_subido,
+                   CASE WHEN archivo.hash IS NULL THEN archivo.contenido END as contenido
             FROM archivo_proyecto
             INNER JOIN archivo
                     ON archivo.id = archivo_proyecto.archivo_id
@@ -967,7 +887,7 @@ class DownloadFile(Project):
             LIMIT 1
         '''
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetchrow(project, file)
+            return await fetchrow(connection, query, project, file)
 
 
 class ProjectPresentation(Project):
@@ -1002,12 +922,12 @@ class ProjectPresentation(Project):
 
     async def fetch_presentation(self, project: int):
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare('''
+            return await fetchrow(connection, '''
                 SELECT *
                 FROM presentacion_proyecto
                 WHERE proyecto_id = $1
                 LIMIT 1
-            ''')).fetchrow(project)
+            ''', project)
 
 
 class GetDecisionPanel(Project):
@@ -1068,11 +988,11 @@ class AssignReviewer(Project):
     async def create(self, project: int, reviewers: list):
         async with self.request.app.db.acquire() as connection:
             async with connection.transaction():
-                for reviewer in reviewers:
-                    await connection.execute('''
-                        INSERT INTO observacion_proyecto (proyecto_id, usuario_id, finalizado)
-                        VALUES ($1, $2, $3)
-                    ''', project, int(reviewer), False)
+                await insert_many(connection, 'observacion_proyecto', ('proyecto_id', 'usuario_id', 'finalizado'),
+                                  [(project, int(reviewer), False) for reviewer in reviewers])
+
+        invalidate_auth_data(*(int(reviewer) for reviewer in reviewers))
+        invalidate_project_fragments()
 
     async def validate(self, reviewers: list, school: int):
         def _get_validation_rules(reviewers_, school_):
@@ -1098,7 +1018,7 @@ class AssignReviewer(Project):
             LIMIT 1
         '''
         async with dbi.acquire() as connection:
-            if not await (await connection.prepare(query)).fetchval(int(value), school):
+            if not await fetchval(connection, query, int(value), school):
                 return '{}:{} no existe...'.format(name, value)
 
 
@@ -1149,25 +1069,24 @@ class AssignPresentationDate(Project):
     async def create(self, project: int, date_: datetime, decision_panel: list):
         async with self.request.app.db.acquire() as connection:
             async with connection.transaction():
-                await connection.execute('''
+                await execute(connection, '''
                     INSERT INTO presentacion_proyecto (proyecto_id, fecha)
                     VALUES ($1, $2)
                 ''', project, date_)
 
-                for dp in decision_panel:
-                    await connection.execute('''
-                        INSERT INTO jurado_presentacion (presentacion_id, jurado_id)
-                        VALUES ($1, $2)
-                    ''', project, int(dp))
+                await insert_many(connection, 'jurado_presentacion', ('presentacion_id', 'jurado_id'),
+                                  [(project, int(dp)) for dp in decision_panel])
+
+        invalidate_project_fragments()
 
     async def check_presentation_exists(self, project: int):
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare('''
+            return await fetchval(connection, '''
                 SELECT true
                 FROM presentacion_proyecto
                 WHERE proyecto_id = $1
                 LIMIT 1
-            ''')).fetchval(project) or False
+            ''', project) or False
 
     @staticmethod
     async def _validate_decision_panel(name: str, value: str, pos: int, elems: list, dbi: PoolConnectionHolder, school: int):
@@ -1184,7 +1103,7 @@ class AssignPresentationDate(Project):
             LIMIT 1
         '''
         async with dbi.acquire() as connection:
-            if not await (await connection.prepare(query)).fetchval(int(value), school):
+            if not await fetchval(connection, query, int(value), school):
                 return '{}:{} no existe...'.format(name, value)
 
     @staticmethod
@@ -1230,14 +1149,14 @@ class AcceptInvite(Project):
     async def update(self, project: int, student: int):
         async with self.request.app.db.acquire() as connection:
             async with connection.transaction():
-                await connection.execute('''
+                await execute(connection, '''
                     DELETE FROM integrante_proyecto
                     WHERE proyecto_id != $1 AND
                           usuario_id = $2 AND
                           aceptado = FALSE
                 ''', project, student)
 
-                await connection.execute('''
+                await execute(connection, '''
                     UPDATE integrante_proyecto
                     SET aceptado = TRUE
                     WHERE proyecto_id = $1 AND
@@ -1245,6 +1164,9 @@ class AcceptInvite(Project):
                           aceptado = FALSE
                 ''', project, student)
 
+        invalidate_auth_data(student)
+        invalidate_project_fragments()
+
 
 routes = {
     'projects': {
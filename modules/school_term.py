@@ -5,8 +5,14 @@ from aiohttp.web import View, HTTPFound
 from datetime import datetime, timedelta
 from asyncpg.pool import PoolConnectionHolder
 
+from utils.queries import fetch, fetchval, execute
 from utils.map import map_users
 from utils.validator import validator
+from utils.auth import clear_auth_data
+from utils.users_count import invalidate_users_count
+from utils.school_terms import calendar
+from utils.bulk import insert_many
+from utils.fragments import fragments
 from utils.helpers import view, humanize_datetime, permission_required, pass_user
 
 
@@ -53,6 +59,9 @@ class CreateSchoolTerm(View):
 
             _e = []
 
+            # Validar contra los ciclos de la BD y no contra los que se tengan en memoria
+            await calendar.load(self.request.app.db)
+
             if await self.fetch_school_term(start_date, user['escuela'], self.request.app.db):
                 _e.append('La fecha de comienzo ya se encuentra en el rango que abarca otro ciclo académico')
 
@@ -90,37 +99,25 @@ class CreateSchoolTerm(View):
         ], self.request.app.db)
 
     async def create(self, groups: list, data: dict, school: int, dbi: PoolConnectionHolder):
-        query = '''
-            WITH ciclo_acad AS (
-                INSERT INTO ciclo_academico (fecha_comienzo, fecha_fin, escuela)
-                VALUES ($1, $2, $3)
-                RETURNING id
-            )
-            
-            INSERT INTO horario_profesor (ciclo_id, profesor_id, dia_clase, hora_comienzo, hora_fin)
-            VALUES {values}            
-        '''
+        async with dbi.acquire() as connection:
+            async with connection.transaction():
+                school_term = await fetchval(connection, '''
+                    INSERT INTO ciclo_academico (fecha_comienzo, fecha_fin, escuela)
+                    VALUES ($1, $2, $3)
+                    RETURNING id
+                ''', datetime.strptime(data['beginning_date'], df), datetime.strptime(data['ending_date'], df), school)
 
-        values = ''
-        for group in groups:
-            values = values + await self._build_group_query(group, data)
+                await insert_many(connection, 'horario_profesor',
+                                  ('ciclo_id', 'profesor_id', 'dia_clase', 'hora_comienzo', 'hora_fin'),
+                                  [self._build_schedule(school_term, group, data) for group in groups])
 
-        values = values[:-2]
-        query = query.format(values=values)
+        # Cambia el ciclo académico actual de la escuela, y con ello los contadores de todos los usuarios
+        calendar.invalidate()
+        clear_auth_data()
 
-        async with dbi.acquire() as connection:
-            async with connection.transaction():
-                await connection.execute(query,
-                                         datetime.strptime(data['beginning_date'], df),
-                                         datetime.strptime(data['ending_date'], df),
-                                         school)
-
-    async def _build_group_query(self, group: list, data: dict) -> str:
-        query = '''((SELECT id FROM ciclo_acad), {0}, {1}, {2}, {3}), '''.format(int(data[group[0]]),
-                                                                               int(data[group[1]]),
-                                                                               self._parse_time(data[group[2]]),
-                                                                               self._parse_time(data[group[3]]))
-        return query
+    def _build_schedule(self, school_term: int, group: list, data: dict) -> tuple:
+        return (school_term, int(data[group[0]]), int(data[group[1]]),
+                self._parse_time(data[group[2]]), self._parse_time(data[group[3]]))
 
     @staticmethod
     def _parse_time(time: str) -> int:
@@ -230,7 +227,7 @@ class CreateSchoolTerm(View):
         '''
 
         async with dbi.acquire() as connection:
-            teacher_exists = await (await connection.prepare(query)).fetchval(int(value))
+            teacher_exists = await fetchval(connection, query, int(value))
 
         if not teacher_exists:
             return 'El profesor seleccionado en {name} no fue encontrado o está deshabilitado'.format(name=name)
@@ -250,20 +247,13 @@ class CreateSchoolTerm(View):
                   escuela = $2
         '''
         async with dbi.acquire() as connection:
-            return await (await connection.prepare(query)).fetch(role_id, school)
+            return await fetch(connection, query, role_id, school)
 
     @staticmethod
     async def fetch_school_term(date: datetime, school: int, dbi: PoolConnectionHolder):
-        query = '''
-            SELECT id
-            FROM ciclo_academico
-            WHERE $1 >= fecha_comienzo AND
-                  $1 <= fecha_fin AND
-                  escuela = $2
-            LIMIT 1
-        '''
-        async with dbi.acquire() as connection:
-            return await (await connection.prepare(query)).fetchval(date, school)
+        school_term = await calendar.current(dbi, school, date)
+
+        return school_term['id'] if school_term else None
 
 
 class DisableStudents(View):
@@ -278,23 +268,25 @@ class DisableStudents(View):
         raise HTTPFound('/users/list')
 
     async def update(self, school: int):
+        school_term = await calendar.current(self.request.app.db, school, datetime.utcnow() - timedelta(hours=5))
+
+        if not school_term:
+            return None
+
         async with self.request.app.db.acquire() as connection:
-            return await connection.execute('''
-                WITH ciclo_academico AS (
-                    SELECT ciclo_academico.id
-                    FROM ciclo_academico
-                    WHERE ciclo_academico.fecha_comienzo <= $1 AND
-                          ciclo_academico.fecha_fin >= $1 AND
-                          ciclo_academico.escuela = $2
-                )
-                
+            status = await execute(connection, '''
                 UPDATE usuario
                 SET deshabilitado = true
                 FROM matricula
-                WHERE matricula.ciclo_acad_id = (SELECT id FROM ciclo_academico) AND
+                WHERE matricula.ciclo_acad_id = $1 AND
                       matricula.estudiante_id = usuario.id AND
                       usuario.rol_id = 1
-            ''', datetime.utcnow() - timedelta(hours=5), school)
+            ''', school_term['id'])
+
+        clear_auth_data()
+        invalidate_users_count(school)
+
+        return status
 
 
 class CreateGradingStructure(View):
@@ -370,26 +362,27 @@ class CreateGradingStructure(View):
     async def create(self, data: dict, school_term: int):
         async with self.request.app.db.acquire() as connection:
             async with connection.transaction():
+                grades = list()
+
                 for k, v in data.items():
-                    group = await connection.fetchval('''
+                    group = await fetchval(connection, '''
                         INSERT INTO grupo_notas (descripcion)
                         VALUES ($1)
                         RETURNING id
                     ''', v['name'])
 
-                    for grade in enumerate(v['grades']):
-                        _grade = await connection.fetchval('''
-                            INSERT INTO nota (grupo_id, descripcion, porcentaje)
-                            VALUES ($1, $2, $3)
-                            RETURNING id
-                        ''', group, grade[1][0], Decimal(grade[1][1]))
-
-                        await connection.execute('''
-                            INSERT INTO estructura_notas (ciclo_acad_id, nota_id)
-                            VALUES ($1, $2)
-                        ''', school_term, _grade)
+                    # Las notas del grupo en una sola sentencia, solo interesan los ids generados
+                    grades.extend(await fetch(connection, '''
+                        INSERT INTO nota (grupo_id, descripcion, porcentaje)
+                        SELECT $1, descripcion, porcentaje
+                        FROM UNNEST($2::varchar[], $3::smallint[]) AS n (descripcion, porcentaje)
+                        RETURNING id
+                    ''', group, [g[0] for g in v['grades']], [int(Decimal(g[1])) for g in v['grades']]))
 
+                await insert_many(connection, 'estructura_notas', ('ciclo_acad_id', 'nota_id'),
+                                  [(school_term, g['id']) for g in grades])
 
+        fragments.invalidate('class_report', school_term)
 
     @staticmethod
     async def _hacky_sum(name: str, value: str, pos: int, elems: list, dbi: PoolConnectionHolder,
@@ -435,30 +428,22 @@ class CreateGradingStructure(View):
         return True
 
     async def fetch_current_school_term(self, school: int):
-        query = '''
-            SELECT id, fecha_comienzo, fecha_fin
-            FROM ciclo_academico
-                WHERE $1 >= fecha_comienzo AND
-                      $1 <= fecha_fin AND
-                      escuela = $2
-                LIMIT 1
-        '''
-        async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetchrow(datetime.utcnow(), school)
+        return await calendar.current(self.request.app.db, school)
 
     async def school_term(self, school: int):
-        query = '''            
+        school_term = await calendar.current(self.request.app.db, school, datetime.utcnow() - timedelta(hours=5))
+
+        if not school_term:
+            return None
+
+        query = '''
             SELECT true
-            FROM ciclo_academico
-            RIGHT JOIN estructura_notas
-                    ON estructura_notas.ciclo_acad_id = ciclo_academico.id
-            WHERE ciclo_academico.fecha_comienzo <= $1 AND
-                  ciclo_academico.fecha_fin >= $1 AND
-                  ciclo_academico.escuela = $2
+            FROM estructura_notas
+            WHERE estructura_notas.ciclo_acad_id = $1
             LIMIT 1
         '''
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetchval(datetime.utcnow() - timedelta(hours=5), school)
+            return await fetchval(connection, query, school_term['id'])
 
 
 routes = {
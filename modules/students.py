@@ -1,9 +1,13 @@
 from typing import Generator
 from aiohttp.web import View
-from datetime import datetime
 from asyncpg.pool import PoolConnectionHolder
 
+from utils.queries import fetch, execute
+from utils.school_terms import calendar
+from utils.bulk import insert_many
+from utils.fragments import fragments
 from utils.map import map_users
+from utils.auth import invalidate_auth_data
 from utils.helpers import view, permission_required
 
 
@@ -52,33 +56,25 @@ class AuthorizeStudents(View):
                 yield student['id']
 
     async def get_school_term(self, school: int):
-        async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare('''
-                SELECT id
-                FROM ciclo_academico
-                WHERE escuela = $2 AND
-                      fecha_comienzo <= $1 AND
-                      fecha_fin >= $1
-                LIMIT 1
-            ''')).fetchval(datetime.utcnow(), school)
+        school_term = await calendar.current(self.request.app.db, school)
+
+        return school_term['id'] if school_term else None
 
     @staticmethod
     async def authorize_students(data: list, dbi: PoolConnectionHolder):
-        query = ('''
-            UPDATE usuario
-            SET autorizado = true
-            WHERE id = $1;
-        ''', '''
-            INSERT INTO matricula (estudiante_id, ciclo_acad_id)
-            VALUES ($1, $2);
-        ''')
-
         async with dbi.acquire() as connection:
             async with connection.transaction():
-                for user in data:
-                    await connection.execute(query[0], user[0])
-                    await connection.execute(query[1], *user)
+                await execute(connection, '''
+                    UPDATE usuario
+                    SET autorizado = true
+                    WHERE id = ANY($1::bigint[])
+                ''', [user[0] for user in data])
+                await insert_many(connection, 'matricula', ('estudiante_id', 'ciclo_acad_id'), data)
+
+        invalidate_auth_data(*(user[0] for user in data))
 
+        for school_term in {user[1] for user in data}:
+            fragments.invalidate('class_report', school_term)
 
     @staticmethod
     async def _fetch_students(school: int, dbi: PoolConnectionHolder):
@@ -98,8 +94,7 @@ class AuthorizeStudents(View):
             ORDER BY apellidos ASC
         '''
         async with dbi.acquire() as connection:
-            stmt = await connection.prepare(query)
-            return await stmt.fetch(school)
+            return await fetch(connection, query, school)
 
 
 routes = {
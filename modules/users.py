@@ -1,14 +1,36 @@
-from base64 import b64encode
+import re
+import json
+import binascii
+from math import ceil
+from functools import lru_cache
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 from aiohttp_jinja2 import template
-from aiohttp_session import get_session
+from aiohttp_session import get_session, new_session
 from datetime import datetime, timedelta
-from bcrypt import hashpw, checkpw, gensalt
 from asyncpg.pool import PoolConnectionHolder
-from aiohttp.web import View, web_request, HTTPFound, HTTPNotFound
+from aiohttp.web import View, Response, web_request, json_response, HTTPFound, HTTPNotFound
 
+from utils.queries import fetch, fetchrow, fetchval, execute
 from utils.validator import validator
+from utils.auth import invalidate_auth_data
+from utils.passwords import hasher, PasswordQueueFull, BUSY_MESSAGE
+from utils.school_terms import calendar
+from utils.users_count import count_users, invalidate_users_count
+from utils.fragments import fragments
+from utils.eligibility import eligible_projects
+from utils.avatars import create_thumbnail
+from utils.storage import etag, not_modified
+from utils.upload import Upload, UploadTooLarge, UnsupportedType, receive
 from utils.map import map_users, parse_data_key, data_map
-from utils.helpers import pass_user, view, logged_out, check_form_data, pagination, permission_required, flatten
+from utils.helpers import pass_user, view, logged_out, check_form_data, permission_required, flatten
+
+
+def invalidate_user_names():
+    # Los nombres de los usuarios aparecen en los reportes y listados de todos los ciclos
+    for fragment in ('class_report', 'projects_list', 'eligible_projects'):
+        fragments.invalidate(fragment)
+
+    eligible_projects.clear()
 
 
 class FailedAuth(Exception):
@@ -53,7 +75,8 @@ class Login(View):
         return display_data
 
     async def init_session(self, id_: int):
-        session = await get_session(self.request)
+        # Sesión nueva, para no reutilizar el identificador que se tenía antes de autenticarse
+        session = await new_session(self.request)
         session['id'] = id_
 
     @staticmethod
@@ -74,12 +97,17 @@ class Login(View):
         '''
 
         async with self.request.app.db.acquire() as connection:
-            user = await (await connection.prepare(query)).fetchrow(id_)
+            user = await fetchrow(connection, query, id_)
 
         if not user:
             raise FailedAuth('No existe usuario registrado con el DNI o Carné de extrajería dado')
 
-        if not checkpw(password.encode('utf-8'), user['credencial'].encode('utf-8')):
+        try:
+            valid = await hasher.verify(password, user['credencial'])
+        except PasswordQueueFull:
+            raise FailedAuth(BUSY_MESSAGE)
+
+        if not valid:
             raise FailedAuth('Contraseña incorrecta. Intentalo otra vez')
 
         if user['deshabilitado']:
@@ -129,10 +157,17 @@ class Registration(View):
             display_data.update({'errors': errors, 'data': data})
             return display_data
 
+        try:
+            password = await hasher.hash(data['password'])
+        except PasswordQueueFull:
+            display_data.update({'error': BUSY_MESSAGE, 'data': data})
+            return display_data
+
         await self.create(int(data['id']), int(data['id_type']),
-                          hashpw(data['password'].encode('utf-8'), gensalt()).decode('utf-8'),
+                          password,
                           data['name'], data['last_name'], data['email'], int(data['school']),
                           file_id)
+        invalidate_users_count(int(data['school']))
 
         del session['app']
 
@@ -192,9 +227,9 @@ class Registration(View):
             VALUES ((SELECT id FROM estudiante), $8, $9)
         '''
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetch(id_, id_type, password, name, last_name, email, school,
-                                                                 datetime.utcnow() - timedelta(hours=5),
-                                                                 file_id)
+            return await fetch(connection, query, id_, id_type, password, name, last_name, email, school,
+                               datetime.utcnow() - timedelta(hours=5),
+                               file_id)
 
 
 class UploadApplication(View):
@@ -211,37 +246,17 @@ class UploadApplication(View):
             display_data.update({'error': 'No se envió el parámetro necesario...'})
             return display_data
 
-        if file.headers['Content-Type'] not in data_map['files'].values():
+        try:
+            upload = await receive(file, 3 * 1024 * 1024, data_map['files'].values())
+        except UnsupportedType:
             display_data.update({'error': 'El archivo debe de ser un PDF o Windows Office Doc.'})
             return display_data
-
-        file_size = 0
-        _file = None
-        size_error = False
-
-        while True:
-            chunk = await file.read_chunk()
-
-            if not chunk:
-                break
-
-            if _file is None:
-                _file = chunk
-            else:
-                _file = _file + chunk
-
-            file_size += len(chunk)
-
-            if file_size > 3 * 1024 * 1024:
-                size_error = True
-                break
-
-        if size_error:
-            del _file, file_size
+        except UploadTooLarge:
             display_data.update({'error': 'El archivo no puede pesar más de 3MBs.'})
             return display_data
 
-        file_id = await self.create(file.filename.rsplit('.', 1), _file)
+        with upload:
+            file_id = await self.create(file.filename.rsplit('.', 1), upload)
 
         session = await get_session(self.request)
 
@@ -249,15 +264,17 @@ class UploadApplication(View):
 
         raise HTTPFound('/register')
 
-    async def create(self, file_details: list, file: bytearray):
+    async def create(self, file_details: list, upload: Upload):
         statement = '''
-            INSERT INTO archivo (nombre, ext, contenido, fecha_subido)
-            VALUES ($1, $2, $3, $4)
+            INSERT INTO archivo (nombre, ext, hash, tamano, fecha_subido)
+            VALUES ($1, $2, $3, $4, $5)
             RETURNING id
         '''
+        digest = await self.request.app.blobs.put_upload(upload)
+
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(statement)).fetchval(*file_details, file,
-                                                                        datetime.utcnow() - timedelta(hours=5))
+            return await fetchval(connection, statement, *file_details, digest, upload.size,
+                                  datetime.utcnow() - timedelta(hours=5))
 
 
 class RecoverPassword(View):
@@ -299,99 +316,301 @@ class UpdateAvatar(View):
                     'districts': data_map['districts'],
                     'nationalities': data_map['nationalities']}
 
-        if avatar.headers['Content-Type'] not in ('image/png', 'image/jpeg'):
+        try:
+            upload = await receive(avatar, 2 * 1024 * 1024, ('image/png', 'image/jpeg'))
+        except UnsupportedType:
             return {'errors': ['Solo se soporta los formatos jpeg y png']}
-
-        size = 0
-        size_error = False
-        _avatar = None
-
-        while True:
-            chunk = await avatar.read_chunk()
-
-            if not chunk:
-                break
-
-            if _avatar is None:
-                _avatar = chunk
-            else:
-                _avatar = _avatar + chunk
-
-            size += len(chunk)
-
-            if size > 2 * 1024 * 1024:  # 5 MiB
-                del _avatar
-                size_error = True
-                break
-
-        if size_error:
+        except UploadTooLarge:
             return {'errors': ['El avatar no puede pesar más de 2MBs'],
                     'districts': data_map['districts'],
                     'nationalities': data_map['nationalities']}
 
-        await self.update(user['id'], bytearray(b64encode(_avatar)))
+        with upload:
+            try:
+                thumbnail = await create_thumbnail(upload.read())
+            except (IOError, ValueError):
+                return {'errors': ['No se pudo leer la imagen'],
+                        'districts': data_map['districts'],
+                        'nationalities': data_map['nationalities']}
+
+        await self.update(user['id'], await self.request.app.blobs.put(thumbnail))
 
         return {'success': 'Se ha actualizado tu avatar',
                 'districts': data_map['districts'],
                 'nationalities': data_map['nationalities']}
 
-    async def update(self, id_: int, chunk: bytearray):
+    async def update(self, id_: int, version: str):
         query = '''
             UPDATE usuario
-            SET avatar = $2
+            SET avatar = NULL,
+                avatar_version = $2
             WHERE id = $1
         '''
         async with self.request.app.db.acquire() as connection:
-            return await connection.execute(query, id_, chunk)
+            await execute(connection, query, id_, version)
+
+        invalidate_auth_data(id_)
+
+
+class Avatar(View):
+    """
+        Miniatura del avatar de un usuario. La versión es el hash de la miniatura, así que una URL nunca cambia de
+        contenido y se puede guardar en caché indefinidamente.
+    """
+    @pass_user
+    async def get(self, user: dict):
+        version = self.request.match_info['version']
+        headers = {'Cache-Control': 'private, max-age=31536000, immutable'}
+
+        if not_modified(self.request, version, None):
+            headers['ETag'] = etag(version)
+            return Response(status=304, headers=headers)
+
+        if not await self.has_version(int(self.request.match_info['user']), version):
+            raise HTTPNotFound
+
+        headers['Content-Type'] = 'image/jpeg'
+
+        # La respuesta del almacén envía la versión (el hash de la miniatura) como ETag
+        return await self.request.app.blobs.response(self.request, version, headers)
+
+    async def has_version(self, user: int, version: str) -> bool:
+        query = '''
+            SELECT true
+            FROM usuario
+            WHERE id = $1 AND
+                  avatar_version = $2
+            LIMIT 1
+        '''
+        async with self.request.app.db.acquire() as connection:
+            return bool(await fetchval(connection, query, user, version))
 
 
 class UsersList(View):
+    """
+        Listado paginado por clave (rol_id DESC, deshabilitado, id): cada página se pide con el cursor de la primera
+        o última fila de la anterior, así cualquier página, incluida la última, cuesta lo mismo que la primera. Los
+        usuarios sin rol (rol_id nulo) se ordenan como rol 0, al final.
+    """
+    per_page = 20
+    cursor_format = re.compile(r'([0-9]+)\.([01])\.([1-9][0-9]*)')
+
+    columns = '''
+        SELECT usuario.id, usuario.rol_id, COALESCE(usuario.rol_id, 0) as orden_rol, tipo_documento, nombres,
+               apellidos, rol_usuario.desc as rol, sexo, deshabilitado, autorizado, escuela
+        FROM usuario
+        LEFT JOIN rol_usuario
+               ON rol_usuario.id = usuario.rol_id
+        WHERE usuario.escuela = $1
+    '''
+    forward = '''
+        ORDER BY COALESCE(usuario.rol_id, 0) DESC, usuario.deshabilitado ASC, usuario.id ASC
+        LIMIT $2
+    '''
+    backward = '''
+        ORDER BY COALESCE(usuario.rol_id, 0) ASC, usuario.deshabilitado DESC, usuario.id DESC
+        LIMIT $2
+    '''
+    queries = {
+        'first': columns + forward,
+        'last': columns + backward,
+        'after': columns + '''
+              AND (COALESCE(usuario.rol_id, 0) < $3 OR
+                   (COALESCE(usuario.rol_id, 0) = $3 AND (usuario.deshabilitado > $4 OR
+                                             (usuario.deshabilitado = $4 AND usuario.id > $5))))
+        ''' + forward,
+        'before': columns + '''
+              AND (COALESCE(usuario.rol_id, 0) > $3 OR
+                   (COALESCE(usuario.rol_id, 0) = $3 AND (usuario.deshabilitado < $4 OR
+                                             (usuario.deshabilitado = $4 AND usuario.id < $5))))
+        ''' + backward
+    }
+
     @view('user.list')
     @permission_required('mantener_usuarios')
     async def get(self, user: dict):
-        if 'page' in self.request.match_info:
-            page = int(self.request.match_info['page'])
-        else:
-            page = 1
+        users_amount = await count_users(self.request.app.db, user['escuela'])
+        pages = max(int(ceil(users_amount / self.per_page)), 1)
+        query = self.request.query
 
-        offset = (page - 1) * 20
-        users = await self.fetch_users(user['escuela'], offset)
-        users = map_users(users)
+        try:
+            page = min(max(int(query.get('page', 1)), 1), pages)
+        except ValueError:
+            raise HTTPNotFound
+
+        if 'after' in query:
+            cursor = self.parse_cursor(query['after'])
+            users = await self.fetch_users(user['escuela'], 'after', self.per_page + 1, cursor)
+            has_previous, has_next = True, len(users) > self.per_page
+            users = users[:self.per_page]
+        elif 'before' in query:
+            cursor = self.parse_cursor(query['before'])
+            users = await self.fetch_users(user['escuela'], 'before', self.per_page + 1, cursor)
+            has_previous, has_next = len(users) > self.per_page, True
+            users = users[:self.per_page][::-1]
+        elif 'last' in query:
+            # La última página tiene el resto, así las páginas coinciden con las que se recorren desde el inicio
+            last_page = users_amount - (pages - 1) * self.per_page
+            users = (await self.fetch_users(user['escuela'], 'last', last_page))[::-1]
+            page, has_previous, has_next = pages, pages > 1, False
+        else:
+            users = await self.fetch_users(user['escuela'], 'first', self.per_page + 1)
+            page, has_previous, has_next = 1, False, len(users) > self.per_page
+            users = users[:self.per_page]
 
         if not users:
             raise HTTPNotFound
 
-        users_amount = await self.get_users_amount(user['escuela'])
-
-        return {'users': users,
+        return {'users': map_users(users),
                 'page': page,
+                'pages': pages,
                 'users_amount': users_amount,
-                'pagination': pagination(page, users_amount)}
+                'previous_cursor': self.cursor(users[0]) if has_previous else None,
+                'next_cursor': self.cursor(users[-1]) if has_next else None}
 
-    async def fetch_users(self, school: int, offset: int):
-        query = '''
-            SELECT usuario.id, tipo_documento, nombres, apellidos, rol_usuario.desc as rol, sexo, deshabilitado,
-                   autorizado, escuela
-            FROM usuario
-            LEFT JOIN rol_usuario
-                   ON rol_usuario.id = usuario.rol_id
-            WHERE usuario.escuela = $1
-            ORDER BY rol_usuario.id DESC, usuario.deshabilitado ASC
-            LIMIT 20 OFFSET $2
-        '''
+    def parse_cursor(self, cursor: str) -> tuple:
+        match = self.cursor_format.fullmatch(cursor)
+
+        if match is None:
+            raise HTTPNotFound
+
+        return int(match.group(1)), match.group(2) == '1', int(match.group(3))
+
+    @staticmethod
+    def cursor(user) -> str:
+        return '{}.{}.{}'.format(user['orden_rol'], int(user['deshabilitado']), user['id'])
 
+    async def fetch_users(self, school: int, direction: str, limit: int, cursor: tuple = ()):
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetch(school, offset)
+            return await fetch(connection, self.queries[direction], school, limit, *cursor)
+
+
+class SearchUsers(View):
+    """
+        Búsqueda de usuarios de la escuela, en JSON. Parámetros opcionales: q (id, o parte de los nombres y apellidos
+        o del correo), role, authorized y disabled (0 ó 1), school_term (matriculados en el ciclo), limit y after (el
+        cursor 'next' de la página anterior). Sin el permiso mantener_usuarios solo se buscan estudiantes.
+    """
+    default_limit = 20
+    max_limit = 100
+
+    # Filtro y su condición, {0}.. son sus parámetros
+    filters = (
+        ('id', 'usuario.id = {0}'),
+        ('q', '((usuario.nombres || \' \' || usuario.apellidos) ILIKE {0} OR usuario.correo_electronico ILIKE {0})'),
+        ('role', 'usuario.rol_id = {0}'),
+        ('authorized', 'usuario.autorizado = {0}'),
+        ('disabled', 'usuario.deshabilitado = {0}'),
+        ('school_term', '''EXISTS (SELECT true
+                                FROM matricula
+                                WHERE matricula.estudiante_id = usuario.id AND
+                                      matricula.ciclo_acad_id = {0})'''),
+        ('after', '(COALESCE(usuario.apellidos, \'\'), COALESCE(usuario.nombres, \'\'), usuario.id) > ({0}, {1}, {2})')
+    )
+    permissions = ('mantener_usuarios', 'autorizar_estudiantes', 'ver_listado_alumnos')
 
-    async def get_users_amount(self, school: int):
-        query = '''
-            SELECT COUNT(true)
+    @pass_user
+    async def get(self, user: dict):
+        if not any(user['permissions'].get(p) for p in self.permissions):
+            return json_response({'message': 'No tienes los permisos suficientes para ver esta página.'}, status=401)
+
+        try:
+            filters, limit = self.parse_filters(self.request.query)
+        except ValueError:
+            return json_response({'message': 'Parámetros de búsqueda incorrectos'}, status=400)
+
+        if not user['permissions'].get('mantener_usuarios'):
+            filters['role'] = 1
+
+        users = await self.search(user['escuela'], filters, limit + 1)
+
+        return json_response({'users': [dict(u) for u in users[:limit]],
+                              'next': self.cursor(users[limit - 1]) if len(users) > limit else None})
+
+    def parse_filters(self, query) -> tuple:
+        filters = dict()
+        q = query.get('q', '').strip()
+
+        if q.isdigit():
+            filters['id'] = int(q)
+        elif q:
+            # Las palabras en orden, con lo que sea entre ellas: 'juan perez' encuentra a 'Juan Carlos Perez'
+            filters['q'] = '%' + '%'.join(self.escape_like(w) for w in q.split()) + '%'
+
+        for key in ('role', 'school_term'):
+            if key in query:
+                filters[key] = int(query[key])
+
+        for key in ('authorized', 'disabled'):
+            if key in query:
+                if query[key] not in ('0', '1'):
+                    raise ValueError
+
+                filters[key] = query[key] == '1'
+
+        if 'after' in query:
+            filters['after'] = self.parse_cursor(query['after'])
+
+        limit = int(query.get('limit', self.default_limit))
+
+        return filters, min(max(limit, 1), self.max_limit)
+
+    @staticmethod
+    def escape_like(value: str) -> str:
+        return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+    @staticmethod
+    def cursor(user) -> str:
+        # Los nombres nulos se ordenan como '', igual que en la consulta
+        return urlsafe_b64encode(json.dumps([user['apellidos'] or '', user['nombres'] or '',
+                                             user['id']]).encode()).decode()
+
+    @staticmethod
+    def parse_cursor(cursor: str) -> tuple:
+        try:
+            last_name, name, id_ = json.loads(urlsafe_b64decode(cursor.encode()).decode())
+        except (TypeError, binascii.Error, UnicodeDecodeError, json.JSONDecodeError):
+            raise ValueError
+
+        if not (isinstance(last_name, str) and isinstance(name, str) and isinstance(id_, int)):
+            raise ValueError
+
+        return last_name, name, id_
+
+    @classmethod
+    @lru_cache(maxsize=None)
+    def build_query(cls, keys: tuple) -> str:
+        conditions, i = ['usuario.escuela = $1'], 2
+
+        for key, condition in cls.filters:
+            if key in keys:
+                params = 3 if key == 'after' else 1
+                conditions.append(condition.format(*('${}'.format(i + n) for n in range(params))))
+                i += params
+
+        return '''
+            SELECT usuario.id, nombres, apellidos, correo_electronico, rol_id, rol_usuario.desc as rol, autorizado,
+                   deshabilitado, avatar_version
             FROM usuario
-            WHERE usuario.escuela = $1
-            LIMIT 1
-        '''
+            LEFT JOIN rol_usuario
+                   ON rol_usuario.id = usuario.rol_id
+            WHERE {}
+            ORDER BY COALESCE(usuario.apellidos, '') ASC, COALESCE(usuario.nombres, '') ASC, usuario.id ASC
+            LIMIT ${}
+        '''.format(' AND\n                  '.join(conditions), i)
+
+    async def search(self, school: int, filters: dict, limit: int):
+        keys = tuple(key for key, _ in self.filters if key in filters)
+        args = list()
+
+        for key in keys:
+            if key == 'after':
+                args.extend(filters[key])
+            else:
+                args.append(filters[key])
+
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetchval(school)
+            return await fetch(connection, self.build_query(keys), school, *args, limit)
 
 
 class ChangePassword(View):
@@ -411,7 +630,12 @@ class ChangePassword(View):
         if errors:
             return {'errors': errors}
 
-        await self.update(user['id'], hashpw(data['new_password'].encode('utf-8'), gensalt()))
+        try:
+            password = await hasher.hash(data['new_password'])
+        except PasswordQueueFull:
+            return {'errors': [BUSY_MESSAGE]}
+
+        await self.update(user['id'], password)
 
         return {'success': 'Se ha cambiado tu contraseña exitosamente'}
 
@@ -422,21 +646,24 @@ class ChangePassword(View):
             ['Repetir nueva contraseña', data['repeat_new_password'], 'repeat']
         ], self.request.app.db)
 
-    async def update(self, user: int, new_password: bytes):
+    async def update(self, user: int, new_password: str):
         async with self.request.app.db.acquire() as connection:
-            await connection.execute('''
+            await execute(connection, '''
                 UPDATE usuario SET credencial = $2 WHERE id = $1
-            ''', user, new_password.decode('utf-8'))
+            ''', user, new_password)
 
     @staticmethod
     async def _validate_password(name: str, value: str, pos: int, elems: list, dbi: PoolConnectionHolder,
                                  user: int):
         async with dbi.acquire() as connection:
-            current_password = (await (
-                await connection.prepare('SELECT credencial FROM usuario WHERE id = $1 LIMIT 1')
-            ).fetchval(user)).encode('utf-8')
+            current_password = await fetchval(connection, 'SELECT credencial FROM usuario WHERE id = $1 LIMIT 1', user)
+
+        try:
+            valid = await hasher.verify(value, current_password)
+        except PasswordQueueFull:
+            return BUSY_MESSAGE
 
-        if not checkpw(value.encode('utf-8'), current_password):
+        if not valid:
             return '{} ingresada incorrecta'.format(name)
 
 
@@ -460,13 +687,13 @@ class ReadProfile(View):
         query = '''
             SELECT id, tipo_documento, nombres, apellidos,
                    direccion, correo_electronico, nro_telefono, nacionalidad,
-                   escuela, distrito, sexo, avatar
+                   escuela, distrito, sexo, avatar_version
             FROM usuario
             WHERE id = $1
             LIMIT 1
         '''
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetchrow(user_id)
+            return await fetchrow(connection, query, user_id)
 
 
 class EditProfile(View):
@@ -533,8 +760,7 @@ class EditProfile(View):
         '''
 
         async with dbi.acquire() as connection:
-            statement = await connection.prepare(query)
-            status = await statement.fetchval(user_id, value)
+            status = await fetchval(connection, query, user_id, value)
 
         status = status or False
 
@@ -565,22 +791,25 @@ class EditProfile(View):
             WHERE id = $1
         '''
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare(query)).fetch(id_, name, last_name,
-                                                                 address, email, phone,
-                                                                 nationality, district, gender)
+            await fetch(connection, query, id_, name, last_name,
+                        address, email, phone,
+                        nationality, district, gender)
+
+        invalidate_auth_data(id_)
+        invalidate_user_names()
 
 
 class User(View):
     async def fetch_user(self, user: int, school: int):
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare('''
+            return await fetchrow(connection, '''
                 SELECT id, nombres, apellidos, rol_id, sexo, tipo_documento, nacionalidad, correo_electronico,
-                       escuela, nro_telefono, distrito, direccion, avatar, autorizado, deshabilitado
+                       escuela, nro_telefono, distrito, direccion, avatar_version, autorizado, deshabilitado
                 FROM usuario
                 WHERE id = $1 AND
                       escuela = $2
                 LIMIT 1
-            ''')).fetchrow(user, school)
+            ''', user, school)
 
     async def get_user(self, user: int, school: int):
         _user = await self.fetch_user(user, school)
@@ -592,20 +821,20 @@ class User(View):
 
     async def fetch_roles(self):
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare('''
+            return await fetch(connection, '''
                 SELECT *
                 FROM rol_usuario
-            ''')).fetch()
+            ''')
 
     async def get_roles(self):
         return flatten(await self.fetch_roles() or [], {})
 
     async def get_titles(self):
         async with self.request.app.db.acquire() as connection:
-            return await (await connection.prepare('''
+            return await fetch(connection, '''
                 SELECT *
                 FROM titulo_usuario
-            ''')).fetch()
+            ''')
 
     @staticmethod
     async def _validate_email(name: str, value: str, pos: int, elems: list, dbi: PoolConnectionHolder, user_id: int):
@@ -617,8 +846,7 @@ class User(View):
             '''
 
         async with dbi.acquire() as connection:
-            statement = await connection.prepare(query)
-            status = await statement.fetchval(user_id, value)
+            status = await fetchval(connection, query, user_id, value)
 
         status = status or False
 
@@ -635,10 +863,10 @@ class User(View):
             return 'No tienes permisos suficientes para asignar este rol'
 
         async with dbi.acquire() as connection:
-            roles = await (await connection.prepare('''
+            roles = await fetch(connection, '''
                 SELECT *
                 FROM rol_usuario
-            ''')).fetch()
+            ''')
 
         roles = flatten(roles, {}) if roles else []
 
@@ -753,7 +981,11 @@ class EditUser(User):
                 errors.extend(_p_errors)
                 password = None
             else:
-                password = hashpw(data['password'].encode('utf-8'), gensalt()).decode('utf-8')
+                try:
+                    password = await hasher.hash(data['password'])
+                except PasswordQueueFull:
+                    errors.append(BUSY_MESSAGE)
+                    password = None
         else:
             password = None
 
@@ -765,6 +997,9 @@ class EditUser(User):
                           int(data['sex']), int(data['phone']), int(data['district']), data['nationality'],
                           int(data['authorized']), int(data['disabled']), data['address'], _user['id'],
                           password=password)
+        invalidate_users_count(user['escuela'])
+
+        invalidate_user_names()
 
         display_data.update({'success': 'Se ha actualizado al usuario exitosamente',
                              '_user': await self.get_user(int(self.request.match_info['user']), user['escuela'])})
@@ -799,7 +1034,9 @@ class EditUser(User):
             parameters.append(password)
 
         async with self.request.app.db.acquire() as connection:
-            await connection.execute(statement, *parameters)
+            await execute(connection, statement, *parameters)
+
+        invalidate_auth_data(user)
 
     async def validate(self, data: dict, user_id: int, user_role: int, self_role: int):
         return await validator.validate([
@@ -865,25 +1102,32 @@ class AdminRegisterUser(User):
             display_data.update({'errors': errors})
             return display_data
 
-        await self.create(data, user)
+        try:
+            password = await hasher.hash(data['password'])
+        except PasswordQueueFull:
+            display_data.update({'error': BUSY_MESSAGE})
+            return display_data
+
+        await self.create(data, user, password)
+        invalidate_users_count(user['escuela'])
 
         display_data.update({'success': 'Se ha creado al usuario exitosamente'})
         return display_data
 
-    async def create(self, data: dict, user: dict):
+    async def create(self, data: dict, user: dict, password: str):
         statement = '''
             INSERT INTO usuario
             VALUES($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15, $16, $17, $18, $19)
         '''
         now = datetime.utcnow() - timedelta(hours=5)
         async with self.request.app.db.acquire() as connection:
-            return await connection.execute(statement, int(data['id']), int(data['role']), data['email'],
-                                            hashpw(data['password'].encode('utf-8'), gensalt()).decode('utf-8'),
-                                            data['name'], data['last_name'], int(data['sex']), int(data['id_type']),
-                                            data['nationality'], user['escuela'], int(data['phone']),
-                                            int(data['district']), data['address'], None, now, now,
-                                            bool(int(data['authorized'])), bool(int(data['disabled'])),
-                                            int(data['title']))
+            return await execute(connection, statement, int(data['id']), int(data['role']), data['email'],
+                                 password,
+                                 data['name'], data['last_name'], int(data['sex']), int(data['id_type']),
+                                 data['nationality'], user['escuela'], int(data['phone']),
+                                 int(data['district']), data['address'], None, now, now,
+                                 bool(int(data['authorized'])), bool(int(data['disabled'])),
+                                 int(data['title']))
 
     async def validate(self, data: dict, user_role: int, self_role: int):
         return await validator.validate([
@@ -917,12 +1161,15 @@ class RemoveAvatar(User):
 
     async def update(self, user: int):
         async with self.request.app.db.acquire() as connection:
-            return await connection.execute('''
+            await execute(connection, '''
                 UPDATE usuario
-                SET avatar = NULL
+                SET avatar = NULL,
+                    avatar_version = NULL
                 WHERE id = $1
             ''', user)
 
+        invalidate_auth_data(user)
+
 
 class RegisterStudent(User):
     @pass_user
@@ -941,20 +1188,20 @@ class RegisterStudent(User):
         raise HTTPFound('/users/{user}/edit'.format(user=_user['id']))
 
     async def update(self, user: int, school: int):
+        school_term = await calendar.current(self.request.app.db, school, datetime.utcnow() - timedelta(hours=5))
+
+        if school_term is None:
+            return
+
         async with self.request.app.db.acquire() as connection:
-            return await connection.execute('''
-                WITH ciclo_academico AS (
-                    SELECT *
-                    FROM ciclo_academico
-                    WHERE escuela = $1 AND
-                          fecha_comienzo <= $2 AND
-                          fecha_fin >= $2
-                    LIMIT 1
-                )
-                
+            status = await execute(connection, '''
                 INSERT INTO matricula (estudiante_id, ciclo_acad_id)
-                VALUES ($3, (SELECT id FROM ciclo_academico))
-            ''', school, datetime.utcnow() - timedelta(hours=5), user)
+                VALUES ($1, $2)
+            ''', user, school_term['id'])
+
+        fragments.invalidate('class_report', school_term['id'])
+
+        return status
 
 
 class Welcome(View):
@@ -974,9 +1221,10 @@ routes = {
         'edit-profile': EditProfile
     },
     'users/list':  UsersList,
-    'users/list/page-{page:[1-9][0-9]*}': UsersList,
+    'users/search': SearchUsers,
     'users/{user:[1-9][0-9]*}/edit': EditUser,
     'users/{user:[1-9][0-9]*}/remove-avatar': RemoveAvatar,
+    'avatars/{user:[1-9][0-9]*}/{version:[0-9a-f]{64}}': Avatar,
     'users/{user:[1-9][0-9]*}/register-student': RegisterStudent,
     'users/create-new': AdminRegisterUser,
     'profile/{_user_id:[0-9]+}': ReadProfile,
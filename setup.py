@@ -1,12 +1,18 @@
+import csv
+import json
 import asyncio
-import bcrypt
 from pathlib import Path
-from ryoken.json import JSON
+from time import perf_counter
 from datetime import datetime
-from asyncpg.pool import PoolConnectionHolder
+from itertools import islice
+from argparse import ArgumentParser
+from typing import Callable, Iterable, Iterator
 from asyncpg import create_pool
+from asyncpg.connection import Connection
 
 from config import db_dsn
+from utils.bulk import insert_many
+from utils.passwords import PasswordHasher
 
 students_data = './_setup/students.json'
 students_data = Path(students_data)
@@ -14,98 +20,275 @@ students_data = Path(students_data)
 roles_data = './_setup/roles.json'
 roles_data = Path(roles_data)
 
+titles = [
+    {'id': 1, 'descripcion': 'Dr'},
+    {'id': 2, 'descripcion': 'Dra'},
+    {'id': 3, 'descripcion': 'Mg.'},
+    {'id': 4, 'descripcion': 'Ing.'}
+]
 
-async def get_data(path: Path) -> list:
-    with open(str(path), 'rb') as f:
-        return await JSON.decode(f.read().decode('utf-8'))
 
+def to_bool(value) -> bool:
+    if isinstance(value, bool):
+        return value
 
-def parse_data(data: list):
+    return str(value).strip().lower() in ('1', 't', 'true', 'si', 'sí')
+
+
+def to_datetime(value) -> datetime:
+    if isinstance(value, datetime):
+        return value
+
+    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+
+
+permissions = ('ver_listado_alumnos', 'ver_reportes_personales', 'ver_notas_de_clase', 'ver_listado_proyectos',
+               'asignar_notas', 'registrar_asistencia', 'crear_proyecto', 'gestionar_asistencias', 'gestionar_notas',
+               'gestionar_proyectos', 'revisar_proyectos', 'autorizar_estudiantes', 'mantener_usuarios',
+               'mantener_roles')
+
+# Columnas de cada tabla que se importa y cómo convertir los valores leídos, el COPY binario necesita el tipo exacto
+tables = {
+    'rol_usuario': {'id': int, 'desc': str, **{p: to_bool for p in permissions}},
+    'titulo_usuario': {'id': int, 'descripcion': str},
+    'ciclo_academico': {'escuela': int, 'fecha_comienzo': to_datetime, 'fecha_fin': to_datetime},
+    'usuario': {'id': int, 'tipo_documento': int, 'nombres': str, 'apellidos': str, 'sexo': int,
+                'correo_electronico': str, 'credencial': str, 'escuela': int, 'rol_id': int,
+                'fecha_creacion': to_datetime, 'fecha_ultima_actualizacion': to_datetime, 'autorizado': to_bool,
+                'deshabilitado': to_bool},
+    'matricula': {'estudiante_id': int, 'ciclo_acad_id': int}
+}
+
+
+def read_records(path: Path) -> Iterator[dict]:
+    """
+        Registros de un archivo .csv (con cabecera), .jsonl (un objeto por línea) o .json (una lista de objetos). Los
+        dos primeros se leen de a una línea; el .json se carga completo.
+    """
+    with open(str(path), encoding='utf-8', newline='') as f:
+        if path.suffix == '.csv':
+            yield from csv.DictReader(f)
+        elif path.suffix == '.jsonl':
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from json.load(f)
+
+
+def chunked(records: Iterable, size: int) -> Iterator[list]:
+    records = iter(records)
+
+    while True:
+        chunk = list(islice(records, size))
+
+        if not chunk:
+            return
+
+        yield chunk
+
+
+def to_row(record: dict, table: str) -> tuple:
+    try:
+        return tuple(convert(record[column]) if record.get(column) not in (None, '') else None
+                     for column, convert in tables[table].items())
+    except (KeyError, ValueError) as e:
+        raise ValueError('{}: registro inválido {!r} ({})'.format(table, record, e))
+
+
+class Progress:
+    def __init__(self, table: str):
+        self.table = table
+        self.rows = 0
+        self.start = perf_counter()
+
+    @property
+    def rate(self) -> float:
+        elapsed = perf_counter() - self.start
+        return self.rows / elapsed if elapsed else 0.0
+
+    def add(self, rows: int):
+        self.rows += rows
+        print('{}: {} filas ({:.0f} filas/s)'.format(self.table, self.rows, self.rate))
+
+    def done(self):
+        print('{}: {} filas en {:.2f}s ({:.0f} filas/s)'.format(self.table, self.rows, perf_counter() - self.start,
+                                                              self.rate))
+
+
+async def copy_table(connection: Connection, table: str, records: Iterable[dict], chunk_size: int) -> int:
+    progress = Progress(table)
+    columns = tuple(tables[table])
+
+    for chunk in chunked(records, chunk_size):
+        progress.add(await insert_many(connection, table, columns, [to_row(r, table) for r in chunk]))
+
+    progress.done()
+    return progress.rows
+
+
+async def sync_sequence(connection: Connection, table: str):
+    # Los ids se cargaron explícitamente, la secuencia debe continuar desde el mayor
+    await connection.execute('''
+        SELECT setval(pg_get_serial_sequence('{0}', 'id'), GREATEST((SELECT MAX(id) FROM {0}), 1))
+    '''.format(table))
+
+
+def student_record(student: dict, credential: str, school: int, now: datetime) -> dict:
+    return {'tipo_documento': 0,
+            'correo_electronico': student['nombres'].replace(' ', '_').lower() + '@usmp.pe',
+            'escuela': school,
+            'rol_id': 1,
+            'fecha_creacion': now,
+            'fecha_ultima_actualizacion': now,
+            'autorizado': True,
+            'deshabilitado': False,
+            **student,
+            'credencial': credential}
+
+
+async def copy_students(connection: Connection, students: Iterable[dict], hasher: PasswordHasher, chunk_size: int,
+                        school: int, school_term: int = None) -> int:
+    """
+        Importa estudiantes y, si se indica el ciclo académico, los matricula en él. Si un estudiante no trae
+        'password', su contraseña son sus nombres. Las contraseñas de la siguiente tanda se calculan en el pool de
+        procesos mientras se escribe la tanda actual.
+    """
+    progress = Progress('usuario')
     now = datetime.utcnow()
-    for s in data:
-        yield {**s,
-               'tipo_documento': 0,
-               'correo_electronico': s['nombres'].replace(' ', '_').lower() + '@usmp.pe',
-               'credencial': bcrypt.hashpw(s['nombres'].encode('utf-8'), bcrypt.gensalt()).decode('utf-8'),
-               'escuela': 1,
-               'rol_id': 1,
-               'fecha_creacion': now,
-               'fecha_ultima_actualizacion': now,
-               'autorizado': True,
-               'deshabilitado': False}
-
-
-async def do_transaction(data: list, table: str, returning: str, dbi: PoolConnectionHolder) -> str:
-    columns = data[0].keys()
-    values = list()
-
-    for u in data:
-        _u = []
-        for c in columns:
-            _u.append(str(u[c]))
-        _u = '(\'' + '\', \''.join(_u) + '\')'
-        values.append(_u)
-
-    if values:
-        values = ', '.join(values)
-
-    query = '''
-        INSERT INTO {table} {columns}
-        VALUES {values}
-        RETURNING {returning};
-    '''.format(table=table, columns='("' + '", "'.join(columns) + '")', values=values, returning=returning)
-
-    async with dbi.acquire() as connection:
-        async with connection.transaction():
-            return await connection.fetch(query)
+
+    def _hash(chunk: list):
+        passwords = [s.pop('password', None) or s['nombres'] for s in chunk]
+        return asyncio.ensure_future(hasher.hash_many(passwords))
+
+    async def _write(chunk: list, credentials: list):
+        rows = [to_row(student_record(s, c, school, now), 'usuario') for s, c in zip(chunk, credentials)]
+        progress.add(await insert_many(connection, 'usuario', tables['usuario'], rows))
+
+        if school_term is not None:
+            await insert_many(connection, 'matricula', tables['matricula'], [(r[0], school_term) for r in rows])
+
+    previous = None
+
+    for chunk in chunked(students, chunk_size):
+        hashing = _hash(chunk)
+
+        if previous is not None:
+            await _write(*previous)
+
+        previous = chunk, await hashing
+
+    if previous is not None:
+        await _write(*previous)
+
+    progress.done()
+    return progress.rows
+
+
+async def import_roles(connection: Connection, args):
+    await copy_table(connection, 'rol_usuario', read_records(args.file), args.chunk_size)
+    await sync_sequence(connection, 'rol_usuario')
+
+
+async def import_school_terms(connection: Connection, args):
+    await copy_table(connection, 'ciclo_academico', read_records(args.file), args.chunk_size)
+
+
+async def import_students(connection: Connection, args):
+    hasher = PasswordHasher(mode='process', workers=args.workers, max_pending=args.chunk_size)
+
+    try:
+        await copy_students(connection, read_records(args.file), hasher, args.chunk_size, args.school,
+                            args.school_term)
+    finally:
+        hasher.shutdown()
+
+
+async def import_enrollments(connection: Connection, args):
+    await copy_table(connection, 'matricula', read_records(args.file), args.chunk_size)
+
+
+async def seed(connection: Connection, args):
+    """
+        Datos iniciales: roles, títulos, un ciclo académico y los estudiantes de ejemplo matriculados en él.
+    """
+    await copy_table(connection, 'rol_usuario', read_records(roles_data), args.chunk_size)
+    await sync_sequence(connection, 'rol_usuario')
+    await copy_table(connection, 'titulo_usuario', titles, args.chunk_size)
+    await sync_sequence(connection, 'titulo_usuario')
+
+    school_term = await connection.fetchval('''
+        INSERT INTO ciclo_academico (escuela, fecha_comienzo, fecha_fin)
+        VALUES ($1, $2, $3)
+        RETURNING id
+    ''', args.school, datetime(2017, 10, 1), datetime(2017, 12, 31, 23, 59))
+
+    hasher = PasswordHasher(mode='process', workers=args.workers, max_pending=args.chunk_size)
+
+    try:
+        await copy_students(connection, read_records(students_data), hasher, args.chunk_size, args.school,
+                            school_term)
+    finally:
+        hasher.shutdown()
+
+
+commands = {
+    'seed': seed,
+    'roles': import_roles,
+    'school-terms': import_school_terms,
+    'students': import_students,
+    'enrollments': import_enrollments
+}
+
+
+def get_parser() -> ArgumentParser:
+    parser = ArgumentParser(description='Carga inicial e importación masiva de datos de Genesis')
+    parser.add_argument('--chunk-size', type=int, default=2000,
+                        help='Filas por tanda de COPY')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Procesos para calcular las contraseñas, por defecto la cantidad de núcleos')
+    parser.add_argument('--school', type=int, default=1,
+                        help='Escuela de los estudiantes y del ciclo académico de seed')
+    subparsers = parser.add_subparsers(dest='command')
+
+    subparsers.add_parser('seed', help='Roles, títulos, un ciclo académico y estudiantes de _setup/')
+
+    for command, help_ in (('roles', 'Importa roles (rol_usuario)'),
+                           ('school-terms', 'Importa ciclos académicos (escuela, fecha_comienzo, fecha_fin)'),
+                           ('students', 'Importa estudiantes (id, nombres, apellidos, sexo[, password])'),
+                           ('enrollments', 'Importa matrículas (estudiante_id, ciclo_acad_id)')):
+        _parser = subparsers.add_parser(command, help=help_)
+        _parser.add_argument('file', type=Path, help='Archivo .csv, .jsonl o .json')
+
+        if command == 'students':
+            _parser.add_argument('--school-term', type=int, default=None,
+                                 help='Matricular a los estudiantes en este ciclo académico')
+
+    return parser
+
+
+async def run(command: Callable, args):
+    pool = await create_pool(dsn=db_dsn, min_size=1, max_size=1)
+
+    try:
+        # Todo o nada, una importación fallida se puede repetir tal cual
+        async with pool.acquire() as connection:
+            async with connection.transaction():
+                await command(connection, args)
+    finally:
+        await pool.close()
 
 
 def main():
+    parser = get_parser()
+    args = parser.parse_args()
+    command = commands[args.command or 'seed']
+
+    start = perf_counter()
     loop = asyncio.get_event_loop()
-    _students_data = loop.run_until_complete(get_data(students_data))
-    _students_data = list(parse_data(_students_data))
-
-    _roles_data = list(loop.run_until_complete(get_data(roles_data)))
-
-    pool = loop.run_until_complete(create_pool(dsn=db_dsn))
-
-    school_term = loop.run_until_complete(do_transaction([{
-        'escuela': 1,
-        'fecha_comienzo': '2017-10-01 00:00:00',
-        'fecha_fin': '2017-12-31 23:59:00'
-    }], 'ciclo_academico', 'id', pool))
-
-    roles = loop.run_until_complete(do_transaction(_roles_data, 'rol_usuario', 'id', pool))
-    titles = loop.run_until_complete(do_transaction([
-        {
-            'id': 1,
-            'descripcion': 'Dr'
-        },
-        {
-            'id': 2,
-            'descripcion': 'Dra'
-        },
-        {
-            'id': 3,
-            'descripcion': 'Mg.'
-        },
-        {
-            'id': 4,
-            'descripcion': 'Ing.'
-        },
-    ], 'titulo_usuario', 'id', pool))
-    students = loop.run_until_complete(do_transaction(_students_data, 'usuario', 'id', pool))
-
-    def map_registration(student: dict) -> dict:
-        return {
-            'estudiante_id': student['id'],
-            'ciclo_acad_id': school_term[0]['id']
-        }
-
-    registrations = loop.run_until_complete(do_transaction(list(map(map_registration, students)),
-                                                           'matricula', 'estudiante_id, ciclo_acad_id', pool))
-
-    print(list(registrations))
+    loop.run_until_complete(run(command, args))
+
+    print('Listo en {:.2f}s'.format(perf_counter() - start))
 
 
 if __name__ == '__main__':
@@ -1,7 +1,14 @@
-from datetime import datetime
 from aiohttp_session import get_session
 from aiohttp.web import Request, HTTPFound
 
+from utils.queries import fetchrow
+from utils.cache import TTLCache
+from utils.school_terms import calendar
+
+
+# Datos de identidad por usuario, se invalidan explícitamente desde las vistas que los modifican
+auth_cache = TTLCache(ttl=15, maxsize=4096)
+
 
 class NotAuthenticated(Exception):
     pass
@@ -13,13 +20,39 @@ async def get_auth_data(request: Request) -> dict:
     if 'id' not in session:
         raise NotAuthenticated
 
+    user_id = int(session['id'])
+    user = auth_cache.get(user_id)
+
+    if user is None:
+        user = await fetch_auth_data(request, user_id)
+        auth_cache.set(user_id, user)
+
+    if not user['autorizado'] or user['deshabilitado']:
+        del session['id']
+        raise HTTPFound('/')
+
+    return user
+
+
+def invalidate_auth_data(*users: int):
+    auth_cache.invalidate(*users)
+
+
+def clear_auth_data():
+    auth_cache.clear()
+
+
+async def fetch_auth_data(request: Request, user_id: int):
+    # Ciclo vigente de cada escuela; la consulta usa el de la escuela del usuario
+    school_terms = await calendar.current_by_school(request.app.db)
+
     async with request.app.db.acquire() as connection:
         query = '''
             SELECT usuario.id, rol_id, rol_usuario.desc as rol, correo_electronico,
                    nombres, apellidos, sexo,
                    tipo_documento, nacionalidad, escuela,
                    nro_telefono, distrito, direccion,
-                   deshabilitado, avatar, autorizado,
+                   deshabilitado, avatar_version, autorizado,
                    rol_usuario.ver_listado_alumnos as perm_ver_listado_alumnos,
                    rol_usuario.ver_reportes_personales as perm_ver_reportes_personales,
                    rol_usuario.ver_notas_de_clase as perm_ver_notas_de_clase,
@@ -40,11 +73,7 @@ async def get_auth_data(request: Request) -> dict:
                             ON integrante_proyecto.proyecto_id = proyecto.id AND
                                integrante_proyecto.usuario_id = usuario.id AND
                                integrante_proyecto.aceptado = true
-                    WHERE proyecto.ciclo_acad_id = (SELECT id FROM ciclo_academico
-                                                    WHERE ciclo_academico.fecha_comienzo <= $2 AND
-                                                          ciclo_academico.fecha_fin >= $2 AND
-                                                          ciclo_academico.escuela = usuario.escuela
-                                                    LIMIT 1) AND
+                    WHERE proyecto.ciclo_acad_id = ciclo_vigente.id AND
                           integrante_proyecto.usuario_id = usuario.id
                    ) as has_project,
                    (SELECT COUNT(true)
@@ -53,38 +82,28 @@ async def get_auth_data(request: Request) -> dict:
                            ON proyecto.id = integrante_proyecto.proyecto_id
                     WHERE integrante_proyecto.usuario_id = usuario.id AND
                           integrante_proyecto.aceptado = FALSE AND
-                          proyecto.ciclo_acad_id = (SELECT id FROM ciclo_academico
-                                                    WHERE ciclo_academico.fecha_comienzo <= $2 AND
-                                                          ciclo_academico.fecha_fin >= $2 AND
-                                                          ciclo_academico.escuela = usuario.escuela
-                                                    LIMIT 1)
+                          proyecto.ciclo_acad_id = ciclo_vigente.id
                     LIMIT 1
                    ) as invitaciones,
                    (SELECT COUNT(true)
                     FROM observacion_proyecto
                     LEFT JOIN proyecto
                            ON proyecto.id = observacion_proyecto.proyecto_id
-                    WHERE proyecto.ciclo_acad_id = (SELECT id FROM ciclo_academico
-                                                    WHERE ciclo_academico.fecha_comienzo <= $2 AND
-                                                          ciclo_academico.fecha_fin >= $2 AND
-                                                          ciclo_academico.escuela = usuario.escuela
-                                                    LIMIT 1) AND
+                    WHERE proyecto.ciclo_acad_id = ciclo_vigente.id AND
                           finalizado = FALSE AND
                           observacion_proyecto.usuario_id = usuario.id
                    ) as observaciones_pendientes,
                    titulo_usuario.descripcion as titulo
             FROM usuario
+            LEFT JOIN LATERAL (
+                SELECT vigente.id
+                FROM UNNEST($2::int[], $3::int[]) AS vigente (escuela, id)
+                WHERE vigente.escuela = usuario.escuela
+            ) AS ciclo_vigente ON true
             LEFT JOIN rol_usuario
                    ON rol_usuario.id = usuario.rol_id
             LEFT JOIN titulo_usuario
                    ON titulo_usuario.id = usuario.titulo_id
             WHERE usuario.id = $1
         '''
-        stmt = await connection.prepare(query)
-        user = await stmt.fetchrow(int(session['id']), datetime.utcnow())
-
-        if not user['autorizado'] or user['deshabilitado']:
-            del session['id']
-            raise HTTPFound('/')
-
-        return user
+        return await fetchrow(connection, query, user_id, list(school_terms), list(school_terms.values()))
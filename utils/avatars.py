@@ -0,0 +1,34 @@
+import asyncio
+from io import BytesIO
+from PIL import Image
+
+# Lado máximo, en píxeles, de las miniaturas de avatar
+thumbnail_size = 256
+
+
+def make_thumbnail(data: bytes, size: int = thumbnail_size) -> bytes:
+    """
+        Reduce la imagen para que su lado mayor no pase de size píxeles y la guarda como JPEG. Las transparencias se
+        rellenan de blanco.
+    """
+    with Image.open(BytesIO(data)) as image:
+        image.thumbnail((size, size), Image.LANCZOS)
+
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.split()[-1])
+            image = background
+        elif image.mode != 'RGB':
+            image = image.convert('RGB')
+
+        output = BytesIO()
+        image.save(output, 'JPEG', quality=85, optimize=True)
+
+        return output.getvalue()
+
+
+async def create_thumbnail(data: bytes, loop=None) -> bytes:
+    loop = loop or asyncio.get_event_loop()
+
+    return await loop.run_in_executor(None, make_thumbnail, data)
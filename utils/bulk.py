@@ -0,0 +1,40 @@
+from functools import lru_cache
+from typing import Iterable, Sequence
+from asyncpg.connection import Connection
+
+from utils.queries import register, executemany, copy_records
+
+# Desde cuántas filas conviene un COPY binario en vez de un INSERT preparado ejecutado por fila
+COPY_THRESHOLD = 32
+
+
+@lru_cache(maxsize=None)
+def insert_statement(table: str, columns: tuple) -> str:
+    sql = 'INSERT INTO {} ({}) VALUES ({})'.format(table, ', '.join(columns),
+                                                   ', '.join('${}'.format(i) for i in range(1, len(columns) + 1)))
+    register(sql, 'utils.bulk.insert:{}'.format(table))
+
+    return sql
+
+
+async def insert_many(connection: Connection, table: str, columns: Sequence[str], records: Iterable[Sequence],
+                      copy_threshold: int = COPY_THRESHOLD) -> int:
+    """
+        Inserta records (tuplas en el orden de columns) en table y retorna la cantidad de filas. Los lotes pequeños
+        van por executemany con una única sentencia preparada; desde copy_threshold filas se usa COPY. Los valores
+        deben tener ya el tipo de la columna (int, str, datetime...), el COPY binario no convierte tipos.
+
+        No abre transacción, para que la escritura sea parte de la del que llama.
+    """
+    columns = tuple(columns)
+    records = [tuple(r) for r in records]
+
+    if not records:
+        return 0
+
+    if len(records) >= copy_threshold:
+        await copy_records(connection, table, columns, records)
+    else:
+        await executemany(connection, insert_statement(table, columns), records)
+
+    return len(records)
@@ -0,0 +1,51 @@
+from time import monotonic
+from typing import Hashable, Any
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+        Caché en memoria del proceso, con expiración por entrada (ttl en segundos, None para no expirar) y
+        desalojo LRU cuando se supera maxsize.
+    """
+    def __init__(self, ttl: float = 30.0, maxsize: int = 1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        try:
+            expires, value = self._data[key]
+        except KeyError:
+            return default
+
+        if expires is not None and expires <= monotonic():
+            del self._data[key]
+            return default
+
+        self._data.move_to_end(key)
+
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        self._data[key] = (monotonic() + self.ttl if self.ttl is not None else None, value)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, *keys: Hashable):
+        for key in keys:
+            self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _missing) is not _missing
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+_missing = object()
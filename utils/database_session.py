@@ -1,18 +1,56 @@
+import asyncio
+import logging
 from uuid import uuid4
 from ryoken.json import JSON
-from aiohttp.web import Request, Response
+from datetime import datetime, timedelta
+from aiohttp.web import Request, Response, Application
 from aiohttp_session import AbstractStorage, Session
 
+from utils.cache import TTLCache
+from utils.queries import fetchrow, execute
+
+logger = logging.getLogger(__name__)
+
 get_sess_query = '''
-    SELECT *
+    SELECT data, fecha_ultimo_acceso
     FROM session
-    WHERE id = $1
+    WHERE id = $1 AND
+          fecha_expiracion > $2
     LIMIT 1
 '''
 
 create_sess_query = '''
-    INSERT INTO session (id, data)
-    VALUES ($1, $2)
+    INSERT INTO session (id, data, fecha_ultimo_acceso, fecha_expiracion)
+    VALUES ($1, $2, $3, $4)
+    ON CONFLICT (id)
+    DO UPDATE SET data = EXCLUDED.data,
+                  fecha_ultimo_acceso = EXCLUDED.fecha_ultimo_acceso,
+                  fecha_expiracion = EXCLUDED.fecha_expiracion
+'''
+
+create_sess_many_query = '''
+    INSERT INTO session (id, data, fecha_ultimo_acceso, fecha_expiracion)
+    SELECT *
+    FROM UNNEST($1::varchar[], $2::json[], $3::timestamp[], $4::timestamp[])
+    ON CONFLICT (id)
+    DO UPDATE SET data = EXCLUDED.data,
+                  fecha_ultimo_acceso = EXCLUDED.fecha_ultimo_acceso,
+                  fecha_expiracion = EXCLUDED.fecha_expiracion
+'''
+
+touch_sess_query = '''
+    UPDATE session
+    SET fecha_ultimo_acceso = $2,
+        fecha_expiracion = $3
+    WHERE id = $1
+'''
+
+delete_expired_sess_query = '''
+    DELETE FROM session
+    WHERE id IN (SELECT id
+                 FROM session
+                 WHERE fecha_expiracion <= $1
+                 LIMIT $2)
 '''
 
 
@@ -21,12 +59,18 @@ def gen_session_id() -> str:
 
 
 class DatabaseStorage(AbstractStorage):
+    """
+        Las sesiones expiran ttl segundos después de su último acceso. El último acceso solo se vuelve a escribir
+        cuando tiene más de touch_interval segundos, para no escribir en cada request.
+    """
     def __init__(self, connection_pool, cookie_name: str = 'GENESIS_APP', domain=None, max_age=None, path='/',
-                 secure=None, httponly=True, encoder=JSON):
+                 secure=None, httponly=True, encoder=JSON, ttl: int = 7 * 24 * 60 * 60, touch_interval: int = 600):
         super().__init__(cookie_name=cookie_name, domain=domain, max_age=max_age, path=path, secure=secure,
                          httponly=httponly)
         self._encoder = encoder
         self._db = connection_pool
+        self.ttl = timedelta(seconds=ttl)
+        self.touch_interval = timedelta(seconds=touch_interval)
 
     async def load_session(self, request: Request):
         cookie = self.load_cookie(request)
@@ -34,19 +78,20 @@ class DatabaseStorage(AbstractStorage):
         if not cookie:
             return Session(None, data=None, new=True, max_age=self.max_age)
 
-        async with self._db.acquire() as connection:
-            stmt = await connection.prepare(get_sess_query)
+        session_id = str(cookie)
+        data = await self._fetch_session(session_id)
 
-            data = await stmt.fetchrow(str(cookie))
+        if data is None:
+            return Session(None, data=None, new=True, max_age=self.max_age)
 
-            if not data:
-                return Session(None, data=None, new=True, max_age=self.max_age)
+        return Session(session_id, data=data, new=False, max_age=self.max_age)
 
-            data = await self._encoder.decode(data['data'])
+    async def save_session(self, request: Request, response: Response, session: Session):
+        session_id = self._save_session_cookie(response, session)
 
-            return Session(None, data=data, new=False, max_age=self.max_age)
+        await self._store_session(session_id, self._get_session_data(session))
 
-    async def save_session(self, request: Request, response: Response, session: Session):
+    def _save_session_cookie(self, response: Response, session: Session) -> str:
         session_id = session.identity
 
         if not session_id:
@@ -59,9 +104,191 @@ class DatabaseStorage(AbstractStorage):
             else:
                 self.save_cookie(response, session_id, max_age=session.max_age)
 
-        data = await self._encoder.encode(self._get_session_data(session))
+        return session_id
+
+    async def _fetch_session(self, session_id: str):
+        now = datetime.utcnow()
 
         async with self._db.acquire() as connection:
-            stmt = await connection.prepare(create_sess_query)
+            data = await fetchrow(connection, get_sess_query, session_id, now)
+
+            if not data:
+                return None
+
+            if now - data['fecha_ultimo_acceso'] >= self.touch_interval:
+                await execute(connection, touch_sess_query, session_id, now, now + self.ttl)
+
+        return await self._encoder.decode(data['data'])
+
+    async def _store_session(self, session_id: str, data: dict):
+        now = datetime.utcnow()
+        data = await self._encoder.encode(data)
+
+        async with self._db.acquire() as connection:
+            await execute(connection, create_sess_query, session_id, data, now, now + self.ttl)
+
+
+class CachedDatabaseStorage(DatabaseStorage):
+    """
+        Mantiene las sesiones decodificadas en un LRU en memoria y las escribe a la BD en lote, cada
+        flush_interval milisegundos, solo si cambiaron o si hay que renovar su último acceso. Pensado para un único
+        proceso de la app: otro proceso no vería las sesiones que aún no se escribieron.
+    """
+    def __init__(self, connection_pool, *args, cache_size: int = 10000, flush_interval: int = 500, **kwargs):
+        super().__init__(connection_pool, *args, **kwargs)
+        self._sessions = TTLCache(ttl=None, maxsize=cache_size)
+        self._dirty = dict()
+        self._flush_interval = flush_interval / 1000
+        self._flusher = None
+
+    async def _fetch_session(self, session_id: str):
+        now = datetime.utcnow()
+        cached = self._sessions.get(session_id)
+
+        if cached is not None:
+            data, last_seen = cached
+
+            if now - last_seen >= self.ttl:
+                self._sessions.invalidate(session_id)
+                return None
+
+            if now - last_seen >= self.touch_interval:
+                self._sessions.set(session_id, (data, now))
+                self._dirty[session_id] = (data, now)
+
+            return data
+
+        data = await super()._fetch_session(session_id)
+
+        if data is not None:
+            self._sessions.set(session_id, (data, now))
+
+        return data
+
+    async def _store_session(self, session_id: str, data: dict):
+        cached = self._sessions.get(session_id)
+
+        if cached is not None and cached[0] == data:
+            return
+
+        now = datetime.utcnow()
+
+        self._sessions.set(session_id, (data, now))
+        self._dirty[session_id] = (data, now)
+
+    async def flush(self):
+        if not self._dirty:
+            return
+
+        dirty, self._dirty = self._dirty, dict()
+
+        try:
+            ids, data, last_seen, expires = list(), list(), list(), list()
+
+            for session_id, (d, seen) in dirty.items():
+                ids.append(session_id)
+                data.append(await self._encoder.encode(d))
+                last_seen.append(seen)
+                expires.append(seen + self.ttl)
+
+            async with self._db.acquire() as connection:
+                await execute(connection, create_sess_many_query, ids, data, last_seen, expires)
+        except Exception:
+            # Las que se volvieron a modificar mientras tanto ya tienen una versión más reciente pendiente
+            for session_id, d in dirty.items():
+                self._dirty.setdefault(session_id, d)
+            raise
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self._flush_interval)
+
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('No se pudieron escribir las sesiones pendientes')
+
+    async def start(self, app: Application):
+        if self._flusher is None:
+            self._flusher = asyncio.ensure_future(self._flush_periodically())
+
+    async def stop(self, app: Application):
+        if self._flusher is not None:
+            self._flusher.cancel()
+
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+
+            self._flusher = None
+
+        await self.flush()
+
+
+class SessionSweeper:
+    """
+        Elimina periódicamente las sesiones expiradas, en lotes de batch_size filas para no bloquear la tabla.
+        Si se indica vacuum_threshold, se ejecuta VACUUM ANALYZE sobre la tabla cuando un barrido elimina al menos
+        esa cantidad de filas.
+    """
+    def __init__(self, connection_pool, interval: int = 60 * 60, batch_size: int = 1000, vacuum_threshold: int = None):
+        self._db = connection_pool
+        self.interval = interval
+        self.batch_size = batch_size
+        self.vacuum_threshold = vacuum_threshold
+        self._task = None
+
+    async def sweep(self) -> int:
+        now = datetime.utcnow()
+        total = 0
+
+        while True:
+            async with self._db.acquire() as connection:
+                status = await execute(connection, delete_expired_sess_query, now, self.batch_size)
+
+            deleted = int(status.split()[-1])
+            total += deleted
+
+            if deleted < self.batch_size:
+                break
+
+            # Ceder el loop entre lotes
+            await asyncio.sleep(0.1)
+
+        if self.vacuum_threshold is not None and total >= self.vacuum_threshold:
+            async with self._db.acquire() as connection:
+                await connection.execute('VACUUM ANALYZE session')
+
+        return total
+
+    async def _sweep_periodically(self):
+        while True:
+            try:
+                deleted = await self.sweep()
+
+                if deleted:
+                    logger.info('Se eliminaron %d sesiones expiradas', deleted)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('No se pudieron eliminar las sesiones expiradas')
+
+            await asyncio.sleep(self.interval)
+
+    async def start(self, app: Application):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._sweep_periodically())
+
+    async def stop(self, app: Application):
+        if self._task is not None:
+            self._task.cancel()
+
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
 
-            await stmt.fetchrow(session_id, data)
+            self._task = None
@@ -0,0 +1,60 @@
+import json
+from decimal import Decimal
+
+from utils.cache import TTLCache
+from utils.queries import fetch
+
+# Nota mínima de promedio del ciclo para que un integrante sea apto a sustentación
+PASSING_GRADE = Decimal('10.5')
+
+# Proyectos del ciclo con sus integrantes y promedios, por ciclo académico. Se invalida cuando cambian los promedios
+# (FinalGrade.invalidate) o los integrantes; el ttl solo cubre lo que se cambie fuera de la app
+eligible_projects = TTLCache(ttl=600, maxsize=32)
+
+
+async def fetch_eligible_projects(dbi, school_term: int) -> list:
+    """
+        Todos los proyectos del ciclo en una sola consulta: integrantes aceptados con su promedio (0.0 si aún no tiene)
+        y, por proyecto, el promedio mínimo, la media y si todos los integrantes aprueban.
+    """
+    projects = eligible_projects.get(school_term)
+
+    if projects is None:
+        records = await fetch(dbi, '''
+            SELECT proyecto.id, proyecto.titulo,
+                   json_agg(json_build_object('usuario_id', integrante_proyecto.usuario_id,
+                                              'nombres', usuario.nombres,
+                                              'apellidos', usuario.apellidos,
+                                              'promedio', COALESCE(promedio_notas_ciclo.valor, 0.0))
+                            ORDER BY usuario.apellidos, usuario.nombres) as members,
+                   MIN(COALESCE(promedio_notas_ciclo.valor, 0.0)) as min_grade,
+                   AVG(COALESCE(promedio_notas_ciclo.valor, 0.0)) as mean_grade,
+                   bool_and(COALESCE(promedio_notas_ciclo.valor, 0.0) >= $2) as eligible
+            FROM proyecto
+            INNER JOIN integrante_proyecto
+                    ON integrante_proyecto.proyecto_id = proyecto.id AND
+                       integrante_proyecto.aceptado = TRUE
+            INNER JOIN usuario
+                    ON usuario.id = integrante_proyecto.usuario_id
+            LEFT JOIN promedio_notas_ciclo
+                   ON promedio_notas_ciclo.estudiante_id = integrante_proyecto.usuario_id AND
+                      promedio_notas_ciclo.ciclo_acad_id = proyecto.ciclo_acad_id
+            WHERE proyecto.ciclo_acad_id = $1
+            GROUP BY proyecto.id
+            ORDER BY proyecto.titulo, proyecto.id
+        ''', school_term, PASSING_GRADE)
+
+        projects = list()
+
+        for record in records:
+            project = dict(record)
+            project['members'] = json.loads(project['members'], parse_float=Decimal)
+            projects.append(project)
+
+        eligible_projects.set(school_term, projects)
+
+    return projects
+
+
+def invalidate_eligible_projects(*school_terms: int):
+    eligible_projects.invalidate(*school_terms)
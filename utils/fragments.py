@@ -0,0 +1,68 @@
+from typing import Hashable, Callable
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+from utils.cache import TTLCache
+
+
+class FragmentCache:
+    """
+        HTML ya renderizado de partes de templates, por (template, nombre del fragmento, claves, versión). Las
+        escrituras que cambian los datos de un fragmento llaman a invalidate, que sube la versión del fragmento para
+        un ámbito (la primera clave, normalmente el ciclo académico) o para todos; las entradas viejas no se vuelven
+        a leer y salen por LRU o por ttl.
+    """
+    def __init__(self, ttl: float = 300.0, maxsize: int = 512):
+        self.entries = TTLCache(ttl=ttl, maxsize=maxsize)
+        self._versions = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def version(self, name: str, scope: Hashable = None) -> tuple:
+        return self._versions.get((name, None), 0), self._versions.get((name, scope), 0)
+
+    def invalidate(self, name: str, scope: Hashable = None):
+        key = (name, scope)
+        self._versions[key] = self._versions.get(key, 0) + 1
+
+    def render(self, template: str, name: str, keys: tuple, caller: Callable[[], str]) -> str:
+        key = (template, name, keys, self.version(name, keys[0] if keys else None))
+        html = self.entries.get(key)
+
+        if html is None:
+            self.misses += 1
+            html = caller()
+            self.entries.set(key, html)
+        else:
+            self.hits += 1
+
+        return html
+
+
+fragments = FragmentCache()
+
+
+class FragmentCacheExtension(Extension):
+    """
+        {% cache 'nombre', clave1, clave2 %} ... {% endcache %}
+
+        Las claves deben incluir todo lo que cambia el HTML del bloque, por ejemplo los permisos del usuario.
+    """
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        name = parser.parse_expression()
+        keys = list()
+
+        while parser.stream.skip_if('comma'):
+            keys.append(parser.parse_expression())
+
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        args = [nodes.Const(parser.name), name, nodes.Tuple(keys, 'load')]
+
+        return nodes.CallBlock(self.call_method('_render', args), [], [], body).set_lineno(lineno)
+
+    @staticmethod
+    def _render(template: str, name: str, keys: tuple, caller: Callable[[], str]) -> str:
+        return fragments.render(template, name, keys, caller)
@@ -0,0 +1,112 @@
+import os
+import asyncio
+import logging
+from typing import Iterable, List
+from bcrypt import hashpw, checkpw, gensalt
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class PasswordQueueFull(Exception):
+    pass
+
+
+# Lo que ven los usuarios cuando se rechaza una operación por PasswordQueueFull
+BUSY_MESSAGE = 'El servidor está ocupado. Intentalo otra vez en unos segundos'
+
+
+# Funciones de módulo para que puedan enviarse a un ProcessPoolExecutor
+def _hash(password: bytes, rounds: int) -> bytes:
+    return hashpw(password, gensalt(rounds))
+
+
+def _verify(password: bytes, hashed: bytes) -> bool:
+    return checkpw(password, hashed)
+
+
+class PasswordHasher:
+    """
+        Ejecuta bcrypt fuera del loop, en un pool de hilos ('thread') o de procesos ('process') con workers
+        trabajadores. Como máximo se aceptan max_pending operaciones entre las que se ejecutan y las que esperan; por
+        encima de eso se lanza PasswordQueueFull en vez de seguir encolando.
+    """
+    def __init__(self, mode: str = 'thread', workers: int = None, max_pending: int = 256, rounds: int = 12):
+        self._executor = None
+        self.pending = 0
+        self.peak = 0
+        self.completed = 0
+        self.rejected = 0
+        self.configure(mode, workers, max_pending, rounds)
+
+    def configure(self, mode: str = 'thread', workers: int = None, max_pending: int = 256, rounds: int = 12):
+        if mode not in ('thread', 'process'):
+            raise ValueError('mode debe ser \'thread\' o \'process\'')
+
+        self.shutdown()
+
+        self.mode = mode
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.rounds = rounds
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            if self.mode == 'process':
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers)
+
+        return self._executor
+
+    @property
+    def stats(self) -> dict:
+        return {'pending': self.pending,
+                'peak': self.peak,
+                'max_pending': self.max_pending,
+                'workers': self.workers,
+                'completed': self.completed,
+                'rejected': self.rejected}
+
+    async def hash(self, password: str) -> str:
+        return (await self._run(_hash, password.encode('utf-8'), self.rounds)).decode('utf-8')
+
+    async def hash_many(self, passwords: Iterable[str]) -> List[str]:
+        passwords = list(passwords)
+        hashed = list()
+
+        # Por tandas de max_pending, para no llenar la cola
+        for i in range(0, len(passwords), self.max_pending):
+            hashed.extend(await asyncio.gather(*[self.hash(p) for p in passwords[i:i + self.max_pending]]))
+
+        return hashed
+
+    async def verify(self, password: str, hashed: str) -> bool:
+        return await self._run(_verify, password.encode('utf-8'), hashed.encode('utf-8'))
+
+    async def _run(self, func, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            logger.warning('Cola de contraseñas llena (%d pendientes)', self.pending)
+            raise PasswordQueueFull
+
+        self.pending += 1
+        self.peak = max(self.peak, self.pending)
+
+        try:
+            result = await asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            self.pending -= 1
+
+        self.completed += 1
+
+        return result
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+hasher = PasswordHasher()
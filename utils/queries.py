@@ -0,0 +1,167 @@
+import sys
+from time import perf_counter
+from asyncpg import Record
+from typing import Any, List, Optional, Union
+from asyncpg.pool import Pool, PoolConnectionHolder
+from asyncpg.connection import Connection
+
+# Un pool, una conexión adquirida o lo que se pase como dbi a los métodos de datos
+Executor = Union[Pool, PoolConnectionHolder, Connection]
+
+
+class Statement:
+    """
+        Sentencia SQL registrada, con la cantidad de llamadas, errores y el tiempo acumulado de sus ejecuciones.
+    """
+    __slots__ = ('name', 'sql', 'calls', 'errors', 'total_time', 'max_time')
+
+    def __init__(self, name: str, sql: str):
+        self.name = name
+        self.sql = sql
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def record(self, elapsed: float, failed: bool = False):
+        self.calls += 1
+        self.total_time += elapsed
+
+        if elapsed > self.max_time:
+            self.max_time = elapsed
+
+        if failed:
+            self.errors += 1
+
+    @property
+    def stats(self) -> dict:
+        return {'name': self.name,
+                'calls': self.calls,
+                'errors': self.errors,
+                'total_ms': self.total_time * 1000,
+                'mean_ms': self.total_time * 1000 / self.calls if self.calls else 0.0,
+                'max_ms': self.max_time * 1000}
+
+
+# Sentencias por texto SQL. Las constantes de cadena de un método son siempre el mismo objeto, así que la búsqueda no
+# vuelve a calcular el hash del texto.
+statements = dict()
+_names = set()
+
+
+def register(sql: str, name: str) -> Statement:
+    """
+        Registra una sentencia con nombre explícito. Las que no se registran se nombran automáticamente la primera vez
+        que se ejecutan, a partir del módulo, clase y método que las llama.
+    """
+    statement = statements.get(sql)
+
+    if statement is None:
+        statement = statements[sql] = Statement(_unique_name(name), sql)
+
+    return statement
+
+
+def _unique_name(name: str) -> str:
+    unique, i = name, 1
+
+    while unique in _names:
+        i += 1
+        unique = '{}#{}'.format(name, i)
+
+    _names.add(unique)
+
+    return unique
+
+
+def _caller_name(frame) -> str:
+    code = frame.f_code
+    name = getattr(code, 'co_qualname', None)
+
+    if name is None:
+        name = code.co_name
+        owner = frame.f_locals.get('self')
+
+        if owner is not None:
+            name = '{}.{}'.format(type(owner).__name__, name)
+
+    return '{}.{}'.format(frame.f_globals.get('__name__', '?'), name)
+
+
+def _lookup(sql: str) -> Statement:
+    statement = statements.get(sql)
+
+    if statement is None:
+        # 0: _lookup, 1: _run, 2: fetch/fetchrow/..., 3: quien ejecuta la sentencia
+        statement = register(sql, _caller_name(sys._getframe(3)))
+
+    return statement
+
+
+async def _run(method: str, dbi: Executor, sql: str, args: tuple) -> Any:
+    statement = _lookup(sql)
+    start = perf_counter()
+    failed = True
+
+    try:
+        # fetch, fetchrow, fetchval y execute de asyncpg usan la caché de sentencias preparadas de la conexión
+        result = await getattr(dbi, method)(sql, *args)
+        failed = False
+        return result
+    finally:
+        statement.record(perf_counter() - start, failed)
+
+
+async def fetch(dbi: Executor, sql: str, *args) -> List[Record]:
+    return await _run('fetch', dbi, sql, args)
+
+
+async def fetchrow(dbi: Executor, sql: str, *args) -> Optional[Record]:
+    return await _run('fetchrow', dbi, sql, args)
+
+
+async def fetchval(dbi: Executor, sql: str, *args) -> Any:
+    return await _run('fetchval', dbi, sql, args)
+
+
+async def execute(dbi: Executor, sql: str, *args) -> str:
+    return await _run('execute', dbi, sql, args)
+
+
+async def executemany(dbi: Executor, sql: str, args: list):
+    return await _run('executemany', dbi, sql, (args,))
+
+
+async def copy_records(connection: Connection, table: str, columns: tuple, records: list) -> str:
+    """
+        COPY binario de records a la tabla. Se registra como sentencia 'COPY tabla (columnas)' para que aparezca en
+        el reporte junto a las demás.
+    """
+    sql = 'COPY {} ({})'.format(table, ', '.join(columns))
+    statement = statements.get(sql) or register(sql, _caller_name(sys._getframe(1)))
+    start = perf_counter()
+    failed = True
+
+    try:
+        result = await connection.copy_records_to_table(table, records=records, columns=columns)
+        failed = False
+        return result
+    finally:
+        statement.record(perf_counter() - start, failed)
+
+
+def cursor(connection: Connection, sql: str, *args, prefetch: int = None):
+    """
+        Cursor sobre la sentencia, dentro de una transacción. Solo se cuentan las llamadas, no el tiempo.
+    """
+    statement = statements.get(sql) or register(sql, _caller_name(sys._getframe(1)))
+    statement.record(0.0)
+
+    if prefetch is None:
+        return connection.cursor(sql, *args)
+
+    return connection.cursor(sql, *args, prefetch=prefetch)
+
+
+def report() -> List[dict]:
+    return sorted((s.stats for s in statements.values()), key=lambda s: s['total_ms'], reverse=True)
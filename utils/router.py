@@ -1,7 +1,15 @@
-from inspect import ismodule
+import re
+from inspect import ismodule, isclass
 from typing import Dict, Generator, Tuple, List, Union
 
-from aiohttp.web import Application
+from aiohttp import hdrs
+from aiohttp.web import Application, View
+
+# {nombre} o {nombre:regex} en una ruta
+PARAMETER = re.compile(r'\{(\w+)(?::((?:[^{}]|\{[^{}]*\})+))?\}')
+
+# Valores de ejemplo para los parámetros de las rutas, el primero que cumpla el regex
+SAMPLE_VALUES = ('1', 'my-project', 'my-own', '0' * 64, 'a')
 
 
 class Router:
@@ -15,8 +23,48 @@ class Router:
             self._register_module(m)
 
     def register(self):
-        for route, view in self.routes.items():
-            self.app.router.add_route('*', route, view)
+        """
+            Registra las rutas estáticas primero y luego las que tienen parámetros, en el orden en que se declararon;
+            así las rutas más usadas se resuelven por comparación de texto antes de probar los regex. Cada vista se
+            registra solo con los métodos HTTP que implementa, los demás responden 405 sin instanciarla.
+        """
+        for path, view, methods in self.table():
+            resource = self.app.router.add_resource(path)
+
+            for method in methods:
+                resource.add_route(method, view)
+
+    def table(self) -> List[Tuple[str, object, Tuple[str, ...]]]:
+        routes = [(path, view, self.methods(view)) for path, view in self.routes.items()]
+
+        return sorted(routes, key=lambda r: self.is_dynamic(r[0]))
+
+    @staticmethod
+    def methods(view) -> Tuple[str, ...]:
+        if isclass(view) and issubclass(view, View):
+            return tuple(m for m in sorted(hdrs.METH_ALL) if hasattr(view, m.lower()))
+
+        return hdrs.METH_ANY,
+
+    @staticmethod
+    def is_dynamic(path: str) -> bool:
+        return PARAMETER.search(path) is not None
+
+    @staticmethod
+    def sample_path(path: str) -> str:
+        """
+            Una ruta concreta que coincide con path, para medir cuánto cuesta resolverla.
+        """
+        def _sample(match) -> str:
+            pattern = match.group(2) or '[^{}/]+'
+
+            for value in SAMPLE_VALUES:
+                if re.fullmatch(pattern, value):
+                    return value
+
+            raise ValueError('No hay un valor de ejemplo para {} en {}'.format(match.group(0), path))
+
+        return PARAMETER.sub(_sample, path)
 
     def _get_map(self, module_) -> Dict:
         try:
@@ -0,0 +1,103 @@
+import asyncio
+from time import monotonic
+from bisect import bisect_right
+from datetime import datetime
+from typing import Optional, List, Dict
+
+from utils.queries import fetch
+
+
+class SchoolTermCalendar:
+    """
+        Ciclos académicos de todas las escuelas en memoria, ordenados por fecha de comienzo, para resolver el ciclo
+        vigente a una fecha con una búsqueda binaria. Se recargan cada ttl segundos o cuando se invalidan
+        explícitamente al crear un ciclo.
+    """
+    query = '''
+        SELECT id, escuela, fecha_comienzo, fecha_fin
+        FROM ciclo_academico
+        ORDER BY escuela, fecha_comienzo
+    '''
+
+    def __init__(self, ttl: float = 300.0):
+        self.ttl = ttl
+        self._loaded_at = None
+        self._lock = None
+        self._by_id = dict()
+        self._by_school = dict()
+
+    def invalidate(self):
+        self._loaded_at = None
+
+    async def load(self, dbi):
+        terms = await fetch(dbi, self.query)
+        by_id, by_school = dict(), dict()
+
+        for t in terms:
+            term = dict(t)
+            by_id[term['id']] = term
+            starts, _terms = by_school.setdefault(term['escuela'], (list(), list()))
+            starts.append(term['fecha_comienzo'])
+            _terms.append(term)
+
+        self._by_id, self._by_school = by_id, by_school
+        self._loaded_at = monotonic()
+
+    async def _ensure_loaded(self, dbi):
+        if self._loaded_at is not None and monotonic() - self._loaded_at < self.ttl:
+            return
+
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        # Una sola recarga aunque varias requests la pidan a la vez
+        async with self._lock:
+            if self._loaded_at is None or monotonic() - self._loaded_at >= self.ttl:
+                await self.load(dbi)
+
+    async def current(self, dbi, school: int, date: datetime = None) -> Optional[dict]:
+        await self._ensure_loaded(dbi)
+
+        return self._at(school, date or datetime.utcnow())
+
+    async def current_by_school(self, dbi, date: datetime = None) -> Dict[int, int]:
+        # {escuela: id del ciclo vigente}, solo las escuelas que tienen uno
+        await self._ensure_loaded(dbi)
+
+        date = date or datetime.utcnow()
+        terms = ((school, self._at(school, date)) for school in self._by_school)
+
+        return {school: t['id'] for school, t in terms if t is not None}
+
+    async def get(self, dbi, school_term: int, school: int = None) -> Optional[dict]:
+        await self._ensure_loaded(dbi)
+
+        term = self._by_id.get(school_term)
+
+        if term is None or (school is not None and term['escuela'] != school):
+            return None
+
+        return term
+
+    async def recent(self, dbi, school: int, amount: int = 10) -> List[dict]:
+        await self._ensure_loaded(dbi)
+
+        _, terms = self._by_school.get(school, ((), ()))
+
+        return sorted(terms, key=lambda t: t['id'], reverse=True)[:amount]
+
+    def _at(self, school: int, date: datetime) -> Optional[dict]:
+        try:
+            starts, terms = self._by_school[school]
+        except KeyError:
+            return None
+
+        i = bisect_right(starts, date) - 1
+
+        if i < 0 or terms[i]['fecha_fin'] < date:
+            return None
+
+        return terms[i]
+
+
+calendar = SchoolTermCalendar()
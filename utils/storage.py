@@ -0,0 +1,180 @@
+import os
+import shutil
+import asyncio
+from hashlib import sha256
+from pathlib import Path
+from typing import Optional
+from email.utils import format_datetime
+from tempfile import NamedTemporaryFile
+from datetime import datetime, timedelta, timezone
+from aiohttp.web import Request, Response, StreamResponse, FileResponse, HTTPRequestRangeNotSatisfiable
+
+from utils.upload import Upload
+from utils.map import parse_data_key
+from utils.helpers import get_chunks
+
+
+# Los archivos de una URL nunca cambian, pero solo los puede ver quien tenga sesión
+cache_control = 'private, max-age=3600'
+
+# fecha_subido se guarda en hora de Lima
+upload_timezone = timezone(timedelta(hours=-5))
+
+
+def etag(digest: str) -> str:
+    return '"{}"'.format(digest)
+
+
+def not_modified(request: Request, digest: Optional[str], last_modified: Optional[datetime]) -> bool:
+    if_none_match = request.headers.get('If-None-Match')
+
+    # If-None-Match tiene prioridad sobre If-Modified-Since
+    if if_none_match is not None:
+        if digest is None:
+            return False
+
+        tags = [t.strip() for t in if_none_match.split(',')]
+
+        return '*' in tags or etag(digest) in tags or 'W/' + etag(digest) in tags
+
+    if_modified_since = request.if_modified_since
+
+    if if_modified_since is None or last_modified is None:
+        return False
+
+    return last_modified.replace(microsecond=0) <= if_modified_since
+
+
+async def stream_bytes(request: Request, data: bytes, headers: dict = None) -> StreamResponse:
+    headers = dict(headers or {})
+    headers['Accept-Ranges'] = 'bytes'
+    size = len(data)
+    status = 200
+
+    try:
+        range_ = request.http_range
+    except ValueError:
+        raise HTTPRequestRangeNotSatisfiable(headers={'Content-Range': 'bytes */{}'.format(size)})
+
+    if range_.start is not None or range_.stop is not None:
+        start, stop, _ = range_.indices(size)
+
+        if start >= stop:
+            raise HTTPRequestRangeNotSatisfiable(headers={'Content-Range': 'bytes */{}'.format(size)})
+
+        headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, stop - 1, size)
+        data = memoryview(data)[start:stop]
+        status = 206
+
+    response = StreamResponse(status=status, headers=headers)
+    response.content_length = len(data)
+
+    await response.prepare(request)
+
+    for chunk in get_chunks(data):
+        await response.write(chunk)
+
+    await response.write_eof()
+
+    return response
+
+
+async def send_file(request: Request, file) -> StreamResponse:
+    """
+        Responde con un archivo de la tabla archivo (nombre, ext, hash, contenido, fecha_subido), con ETag, Range y
+        respuestas 304. Los que aún no se movieron al almacén (hash nulo) se siguen sirviendo desde la columna
+        contenido. Con ?inline el navegador lo abre en vez de descargarlo.
+    """
+    last_modified = file['fecha_subido'].replace(tzinfo=upload_timezone)
+    headers = {'Cache-Control': cache_control}
+
+    if file['hash'] is not None:
+        headers['ETag'] = etag(file['hash'])
+
+    if not_modified(request, file['hash'], last_modified):
+        return Response(status=304, headers=headers)
+
+    headers.update({
+        'Content-Type': parse_data_key(file['ext'], 'files'),
+        'Content-Disposition': '{disposition}; filename={file}'.format(
+            disposition='inline' if 'inline' in request.query else 'attachment', file=file['nombre'])
+    })
+
+    if file['hash'] is None:
+        headers['Last-Modified'] = format_datetime(last_modified.astimezone(timezone.utc), usegmt=True)
+        return await stream_bytes(request, file['contenido'] or b'', headers)
+
+    return await request.app.blobs.response(request, file['hash'], headers)
+
+
+class BlobFileResponse(FileResponse):
+    """
+        FileResponse con el hash del contenido como ETag. FileResponse asigna el suyo (fecha de modificación y tamaño
+        del archivo) al preparar la respuesta; aquí se ignora, así el cliente recibe siempre el hash y not_modified
+        puede compararlo.
+    """
+    def __init__(self, path: Path, digest: str, headers: dict = None):
+        self.digest = digest
+        super().__init__(path, headers=headers)
+        self.headers['ETag'] = etag(digest)
+
+    @property
+    def etag(self):
+        return super().etag
+
+    @etag.setter
+    def etag(self, value):
+        self.headers['ETag'] = etag(self.digest)
+
+
+class LocalBlobStore:
+    """
+        Almacén de archivos direccionado por contenido: cada archivo se identifica por el sha256 de su contenido, así
+        que subir dos veces el mismo archivo solo lo guarda una vez y un mismo archivo puede estar referenciado por
+        varias filas. Se guardan en el sistema de archivos local, repartidos en dos niveles de directorios según los
+        primeros caracteres del hash. Las operaciones de disco se ejecutan en el executor del loop.
+    """
+    def __init__(self, path: str, loop=None):
+        self.root = Path(path)
+        self._loop = loop
+
+    @property
+    def loop(self):
+        return self._loop or asyncio.get_event_loop()
+
+    def path(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest[2:4] / digest
+
+    async def put(self, data: bytes) -> str:
+        return await self.loop.run_in_executor(None, self._write, self.digest(data), lambda f: f.write(data))
+
+    async def put_upload(self, upload: Upload) -> str:
+        # El hash ya se calculó mientras se recibía; se copia desde el temporal sin leerlo entero a memoria
+        upload.file.seek(0)
+
+        return await self.loop.run_in_executor(None, self._write, upload.digest,
+                                               lambda f: shutil.copyfileobj(upload.file, f))
+
+    async def response(self, request: Request, digest: str, headers: dict = None) -> StreamResponse:
+        # sendfile directamente desde el disco; FileResponse atiende Range e If-Modified-Since
+        return BlobFileResponse(self.path(digest), digest, headers=headers)
+
+    def _write(self, digest: str, writer) -> str:
+        path = self.path(digest)
+
+        if path.is_file():
+            return digest
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Escribir a un temporal en el mismo directorio y moverlo, para que nunca se lea un archivo a medias
+        with NamedTemporaryFile(dir=str(path.parent), delete=False) as f:
+            writer(f)
+
+        os.replace(f.name, str(path))
+
+        return digest
+
+    @staticmethod
+    def digest(data: bytes) -> str:
+        return sha256(data).hexdigest()
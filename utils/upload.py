@@ -0,0 +1,111 @@
+from hashlib import sha256
+from typing import Optional, Iterable
+from tempfile import SpooledTemporaryFile
+from aiohttp.multipart import BodyPartReader
+
+# Firmas de los formatos que se aceptan, por sus primeros bytes
+signatures = (
+    (b'%PDF-', 'application/pdf'),
+    (b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', 'application/msword'),
+    (b'PK\x03\x04', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg')
+)
+
+sniff_size = max(len(s[0]) for s in signatures)
+
+
+class UploadError(Exception):
+    pass
+
+
+class UploadTooLarge(UploadError):
+    pass
+
+
+class UnsupportedType(UploadError):
+    pass
+
+
+def sniff_mime(head: bytes) -> Optional[str]:
+    for signature, mime in signatures:
+        if head.startswith(signature):
+            return mime
+
+    return None
+
+
+class Upload:
+    """
+        Archivo recibido en un temporal, en memoria mientras no pase de spool_size bytes. Se cierra con close() o al
+        salir del bloque with.
+    """
+    def __init__(self, file: SpooledTemporaryFile, filename: str, size: int, digest: str, mime: Optional[str]):
+        self.file = file
+        self.filename = filename
+        self.size = size
+        self.digest = digest
+        self.mime = mime
+
+    def read(self) -> bytes:
+        self.file.seek(0)
+        return self.file.read()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+async def receive(part: BodyPartReader, max_size: int, allowed: Iterable[str] = None,
+                  spool_size: int = 1024 * 1024) -> Upload:
+    """
+        Lee una parte multipart por chunks a un temporal, calculando su sha256 y tamaño a medida que llega. El tipo se
+        detecta por los primeros bytes y no por el Content-Type que envía el cliente.
+    """
+    file = SpooledTemporaryFile(max_size=spool_size)
+    hash_ = sha256()
+    head = b''
+    mime = None
+    size = 0
+
+    try:
+        while True:
+            chunk = await part.read_chunk()
+
+            if not chunk:
+                break
+
+            size += len(chunk)
+
+            if size > max_size:
+                raise UploadTooLarge
+
+            if mime is None and len(head) < sniff_size:
+                head += chunk[:sniff_size - len(head)]
+
+                if len(head) >= sniff_size:
+                    mime = sniff_mime(head)
+
+                    if allowed is not None and mime not in allowed:
+                        raise UnsupportedType
+
+            hash_.update(chunk)
+            file.write(chunk)
+
+        if mime is None:
+            mime = sniff_mime(head)
+
+            if allowed is not None and mime not in allowed:
+                raise UnsupportedType
+    except Exception:
+        file.close()
+        raise
+
+    file.seek(0)
+
+    return Upload(file, part.filename, size, hash_.hexdigest(), mime)
@@ -0,0 +1,24 @@
+from utils.cache import TTLCache
+from utils.queries import fetchval
+
+# Cantidad de usuarios por escuela para el paginado del listado. Se invalida al crear, modificar o deshabilitar
+# usuarios; el ttl solo cubre lo que se cambie fuera de la app
+users_count = TTLCache(ttl=600, maxsize=64)
+
+
+async def count_users(dbi, school: int) -> int:
+    amount = users_count.get(school)
+
+    if amount is None:
+        amount = await fetchval(dbi, '''
+            SELECT COUNT(true)
+            FROM usuario
+            WHERE usuario.escuela = $1
+        ''', school)
+        users_count.set(school, amount)
+
+    return amount
+
+
+def invalidate_users_count(*schools: int):
+    users_count.invalidate(*schools)
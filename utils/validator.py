@@ -1,9 +1,11 @@
 import re
-from typing import Union, Tuple, List
-from ryoken.regexes import Regexinator
+from typing import Union, Tuple, List, Callable, Optional
+from ryoken.regexes import EMAIL_FORMAT, PASSWORD_STRENGTH
 from inspect import iscoroutinefunction
 from asyncpg.pool import PoolConnectionHolder
 
+from utils.queries import fetchval
+
 
 DIGITS = r'[0-9]+'
 NUMERIC = r'[0-9]+\.?[0-9]*'
@@ -32,7 +34,9 @@ class Validator:
         self.unique_rule = re.compile(UNIQUE_RULE)
         self.restricted_value = re.compile(RESTRICTED_VALUE)
         self.column = re.compile(COLUMN)
-        self.regexinator = Regexinator()
+        self.email = re.compile(EMAIL_FORMAT)
+        self.password = re.compile(PASSWORD_STRENGTH)
+        self.plans = dict()
 
     async def validate(self, elems: Union[List[Union[List, Tuple]], Tuple[Union[List, Tuple]]],
                        dbi: PoolConnectionHolder = None) -> Union[List[str], bool]:
@@ -41,145 +45,140 @@ class Validator:
                 [$name, $value, $rules, $custom_val_func?],
                 ...
             ])
+
+            Primero se revisan las reglas síncronas de todos los campos; las que son coroutines (unique, custom) solo
+            se esperan para los campos que pasaron las síncronas. Por campo se retorna el primer error.
         """
-        errors = list()
+        errors = [None] * len(elems)
+        pending = list()
 
         for pos, elem in enumerate(elems):
-            name, value, rules = elem[0], elem[1], elem[2]
-            rules = rules.split('|') if '|' in rules else [rules]
+            name, value = elem[0], elem[1]
+
+            if not value:
+                errors[pos] = '{} no puede ser dejado en blanco'.format(name)
+                continue
 
-            for rule in rules:
-                error = await self._check(value, name, rule, pos, dbi, elems)
+            checks, coroutines = self.plan(elem[2])
 
-                if error:
-                    errors.append(error)
+            for check in checks:
+                errors[pos] = check(value, name, pos, elems, dbi)
 
-                    # Si la verificación de una regla falla, pasar al siguiente elemento
+                if errors[pos]:
                     break
+            else:
+                if coroutines:
+                    pending.append((pos, coroutines))
 
-        return errors or False
+        for pos, coroutines in pending:
+            for check in coroutines:
+                errors[pos] = await check(elems[pos][1], elems[pos][0], pos, elems, dbi)
 
-    async def _check(self, value: str, name: str, rule: str, pos: int, dbi: PoolConnectionHolder,
-                     elems: Union[List[Union[List, Tuple]], Tuple[Union[List, Tuple]]]) -> str:
-        if not value:
-            return '{} no puede ser dejado en blanco'.format(name)
+                if errors[pos]:
+                    break
+
+        return [error for error in errors if error] or False
+
+    def plan(self, rules: str) -> Tuple[Tuple[Callable, ...], Tuple[Callable, ...]]:
+        """
+            Las reglas de rules compiladas una sola vez por texto de reglas: (síncronas, coroutines), cada grupo en el
+            orden en que se escribieron.
+        """
+        plan = self.plans.get(rules)
 
+        if plan is None:
+            checks = [self._compile(rule) for rule in rules.split('|')]
+            plan = (tuple(c for c in checks if not iscoroutinefunction(c)),
+                    tuple(c for c in checks if iscoroutinefunction(c)))
+            self.plans[rules] = plan
+
+        return plan
+
+    def _compile(self, rule: str) -> Callable:
+        # Cada regla se convierte en una función (value, name, pos, elems, dbi) que retorna el mensaje de error o None
         if rule in ('digits', 'DIGITS'):
-            if not self._only_digits(value):
-                return '{} solo puede contener dígitos'.format(name)
+            return self._pattern_check(self.digits, '{} solo puede contener dígitos')
         elif rule in ('letters', 'LETTERS'):
-            if not self._only_letters(value):
-                return '{} solo puede contener letras'.format(name)
+            return self._pattern_check(self.letters, '{} solo puede contener letras')
         elif rule in ('numeric', 'NUMERIC'):
-            if not self._numeric(value):
-                return '{} debe ser un número flotante o entero'.format(name)
+            return self._pattern_check(self.numeric, '{} debe ser un número flotante o entero')
         elif rule in ('email', 'EMAIL'):
-            if not await self.regexinator.validate(value, strategy='EMAIL'):
-                return '{} debe ser de formato john@example.com'.format(name)
+            return self._pattern_check(self.email, '{} debe ser de formato john@example.com')
         elif rule in ('password', 'PASSWORD'):
-            if not await self.regexinator.validate(value, strategy='PASSWORD'):
-                return '{} ingresada debe tener 3 caracteres y 3 dígitos por lo menos'.format(name)
+            return self._pattern_check(self.password, '{} ingresada debe tener 3 caracteres y 3 dígitos por lo menos')
         elif self.length_rule.fullmatch(rule):
-            len_range = rule[4:]
-            len_range = tuple(map(lambda x: int(x), len_range.split(','))) if ',' in len_range else int(len_range)
-
-            if not self._len(value, len_range):
-                if isinstance(len_range, tuple):
-                    return '{0} debe tener entre {1[0]} y {1[1]} caracteres'.format(name, len_range)
-                return '{0} debe tener {1} caracteres'.format(name, len_range)
+            return self._length_check(*map(int, rule[4:].split(',')))
         elif self.unique_rule.fullmatch(rule):
-            column, table = rule[7:].split(',')
-
-            if not (await self._unique(value, table, column, dbi)):
-                return 'El {0} ingresado, {1}, ya se encuentra en uso'.format(name, value)
+            return self._unique_check(*rule[7:].split(','))
         elif rule in ('repeat', 'REPEAT'):
-            if not self._repeated_value(value, pos, elems):
-                return 'El valor ingresado en {} no es lo mismo que el ingresado en el ' \
-                       'campo {}'.format(name, elems[pos - 1][0])
+            return self._repeat_check
         elif rule in ('custom', 'CUSTOM'):
-            _args = elems[pos][3:]
-
-            val_func = _args[0]
-
-            _args = _args[1:]
-
-            if not (callable(val_func) and iscoroutinefunction(val_func)):
-                raise ValueError('Función de validación debe de ser una coroutine')
-
-            try:
-                val = await val_func(name, value, pos, elems, dbi, *_args)
+            return self._custom_check
 
-                if isinstance(val, str):
-                    return val
-            except TypeError:
-                raise TypeError('La función de validación recibe 5 argumentos: name, value, pos, elems, dbi')
-        else:
-            raise ValueError('Regla de validación no soportada.')
-
-    def _only_digits(self, value: str) -> bool:
-        if self.digits.fullmatch(value):
-            return True
-
-        return False
-
-    def _numeric(self, value: str) -> bool:
-        if self.numeric.fullmatch(value):
-            return True
-
-        return False
-
-    def _only_letters(self, value: str) -> bool:
-        if self.letters.fullmatch(value):
-            return True
-
-        return False
+        raise ValueError('Regla de validación no soportada.')
 
     @staticmethod
-    def _repeated_value(value: str, pos: int, elements: Union[List[Union[List, Tuple]], Tuple[Union[List, Tuple]]]):
-        if value == elements[pos - 1][1]:
-            return True
+    def _pattern_check(pattern, message: str) -> Callable:
+        def check(value: str, name: str, *args) -> Optional[str]:
+            if not pattern.fullmatch(value):
+                return message.format(name)
 
-        return False
+        return check
 
     @staticmethod
-    def _len(value: str, range_: Union[Tuple, List, int]) -> bool:
-        val_len = len(value)
-
-        if isinstance(range_, int):
-            if val_len >= range_:
-                return True
-            else:
-                return False
+    def _length_check(minimum: int, maximum: int = None) -> Callable:
+        def check(value: str, name: str, *args) -> Optional[str]:
+            if maximum is None:
+                if len(value) < minimum:
+                    return '{0} debe tener {1} caracteres'.format(name, minimum)
+            elif not minimum <= len(value) <= maximum:
+                return '{0} debe tener entre {1} y {2} caracteres'.format(name, minimum, maximum)
 
-        if range_[0] <= val_len <= range_[1]:
-            return True
+        return check
 
-        return False
+    def _unique_check(self, column: str, table: str) -> Callable:
+        _column = self.column.fullmatch(column)
 
-    async def _unique(self, value: str, table: str, column: str, dbi: PoolConnectionHolder):
-        if not self.restricted_value.fullmatch(table):
+        if not self.restricted_value.fullmatch(table) or not _column:
             raise ValueError
 
-        _column = self.column.fullmatch(column)
+        _type = _column.group(2)
 
-        if not _column:
+        if _type and _type not in Cast:
             raise ValueError
 
-        _type = _column.group(2)
+        query = UNIQUE.format(table, _column.group(1))
+
+        async def check(value: str, name: str, pos: int, elems, dbi: PoolConnectionHolder) -> Optional[str]:
+            if _type:
+                value = Cast[_type](value)
 
-        if _type:
-            if _type not in Cast:
-                raise ValueError
+            async with dbi.acquire() as connection:
+                if await fetchval(connection, query, value) > 0:
+                    return 'El {0} ingresado, {1}, ya se encuentra en uso'.format(name, value)
 
-            value = Cast[_type](value)
+        return check
+
+    @staticmethod
+    def _repeat_check(value: str, name: str, pos: int, elems, dbi) -> Optional[str]:
+        if value != elems[pos - 1][1]:
+            return 'El valor ingresado en {} no es lo mismo que el ingresado en el ' \
+                   'campo {}'.format(name, elems[pos - 1][0])
+
+    @staticmethod
+    async def _custom_check(value: str, name: str, pos: int, elems, dbi: PoolConnectionHolder) -> Optional[str]:
+        val_func, _args = elems[pos][3], elems[pos][4:]
 
-        async with dbi.acquire() as connection:
-            result = await (await connection.prepare(UNIQUE.format(table, _column.group(1)))).fetchval(value)
+        if not (callable(val_func) and iscoroutinefunction(val_func)):
+            raise ValueError('Función de validación debe de ser una coroutine')
 
-            if result > 0:
-                return False
+        try:
+            val = await val_func(name, value, pos, elems, dbi, *_args)
+        except TypeError:
+            raise TypeError('La función de validación recibe 5 argumentos: name, value, pos, elems, dbi')
 
-        return True
+        if isinstance(val, str):
+            return val
 
 
 validator = Validator()